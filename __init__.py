@@ -5,8 +5,19 @@ base things...
 """
 from myloggingbase import MyLoggingBase
 from mydb import MyDb
+from mymemdb import MyMemDb
 from myapibase import MyAPIBase
 from myjson2csv import MyJSON2CSV
 from mythread import MyThread
+from mythreadpool import MyThreadPool
+from mymetrics import MyHistogram,MyJobMetrics
 
-__all__ = ['MyLoggingBase','MyJSON2CSV','MyAPIBase','MyDb','MyThread']
+__all__ = ['MyLoggingBase','MyJSON2CSV','MyAPIBase','MyDb','MyMemDb','MyThread',
+           'MyThreadPool','MyHistogram','MyJobMetrics']
+
+# gevent is optional
+try:
+    from mygeventthread import MyGeventThread
+    from mygeventapibase import MyGeventAPIBase
+except ImportError: pass
+else: __all__.extend(['MyGeventThread','MyGeventAPIBase'])
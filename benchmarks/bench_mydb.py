@@ -0,0 +1,244 @@
+"""
+2026-10-18
+benchmarks for mydb.  Run from this folder: python bench_mydb.py
+"""
+import os
+import sys
+import time
+import tempfile
+import random
+import threading
+from collections import deque
+if '..' not in sys.path: sys.path.append('..')
+from mydb import MyDb,QUEUE_LIFO
+from mydb import _JobQueue
+from mymemdb import MyMemDb
+
+#===============================================================================
+# Helpers
+#===============================================================================
+def _new_db(filename=None,**keys):
+    """returns a new MyDb; a temp file db if filename is True."""
+    if filename is True:
+        filename = os.path.join(tempfile.mkdtemp(),'bench.db')
+    return MyDb(filename or ':memory:',**keys)
+
+def _remove_db(db):
+    """closes the db and deletes the temp file (if there is one)."""
+    filename = db.get_filename()
+    db.close()
+    if filename and filename != ':memory:' and os.path.exists(filename):
+        os.remove(filename)
+        os.rmdir(os.path.dirname(filename))
+
+def _report(name,n,t):
+    print '{:<32} {:>11,} jobs {:>9.3f}s {:>12,.0f} jobs/sec'.format(
+                                                        name,n,t,n/(t or 1e-9))
+
+#===============================================================================
+# Add Jobs
+#===============================================================================
+def bench_add_jobs(sizes=(10000,100000,1000000)):
+    """jobs/sec for MyDb.add_jobs (new jobs and all duplicates)."""
+    for to_file in (False,True):
+        for n in sizes:
+            db = _new_db(to_file)
+
+            t = time.time()
+            job_ids = db.add_jobs((str(i),'main') for i in xrange(n))
+            _report('add_jobs {}'.format('file' if to_file else 'memory'),
+                    len(job_ids),time.time()-t)
+
+            # nothing should be added - the jobs are already waiting
+            t = time.time()
+            db.add_jobs((str(i),'main') for i in xrange(n))
+            _report('add_jobs duplicates {}'.format('file' if to_file else 'memory'),
+                    n,time.time()-t)
+
+            _remove_db(db)
+
+#===============================================================================
+# Queues
+#===============================================================================
+def bench_queue(sizes=(10000,100000,1000000)):
+    """dequeue throughput: the priority heap vs a plain deque (what the queues
+    used to be), then get_next_jobs (batches of 100) end to end."""
+    for n in sizes:
+        jobs = [(i,str(i),None,None,None,random.randint(0,9)) for i in xrange(n)]
+
+        q = deque()
+        q.extend(i[:5] for i in jobs)
+        t = time.time()
+        try:
+            while True: q.popleft()
+        except IndexError: pass
+        _report('deque popleft',n,time.time()-t)
+
+        q = _JobQueue()
+        q.push_many(jobs)
+        t = time.time()
+        try:
+            while True: q.pop()
+        except IndexError: pass
+        _report('priority heap pop',n,time.time()-t)
+
+        db = _new_db()
+        db.add_jobs((str(i),'main',None,random.randint(0,9)) for i in xrange(n))
+        t = time.time()
+        try:
+            while True: db.get_next_jobs('main',count=100)
+        except StopIteration: pass
+        _report('get_next_jobs (priority)',n,time.time()-t)
+        _remove_db(db)
+
+#===============================================================================
+# MyMemDb
+#===============================================================================
+def _worker(db,stop):
+    """mydb.main()'s worker (without the printing)"""
+    while True:
+        try: items = db.get_next_jobs('main',count=100)
+        except StopIteration:
+            if stop: break
+            db.wait_for_jobs('main',until=lambda: bool(stop))
+        else: db.remove_jobs(tuple(i[0] for i in items))
+
+def bench_memdb(workers=50):
+    """mydb.main()'s scenario (50 workers, queue_max=500, LIFO, 11k jobs)
+    with MyDb(':memory:') vs MyMemDb."""
+    for name,db in (('MyDb :memory:',MyDb(':memory:',queue_max=500,queue_type=QUEUE_LIFO)),
+                    ('MyMemDb',MyMemDb(queue_max=500,queue_type=QUEUE_LIFO))):
+        stop = []
+        threads = [threading.Thread(target=_worker,args=(db,stop))
+                   for _ in xrange(workers)]
+        for w in threads: w.start()
+        
+        t = time.time()
+        db.add_jobs(((i,'main') for i in xrange(10000)))
+        db.add_jobs(((i,'main') for i in xrange(10000,11000)))
+        stop.append(True)
+        db.wake_up('main')
+        for w in threads: w.join()
+        _report(name,11000,time.time()-t)
+        db.close()
+
+#===============================================================================
+# Reopen
+#===============================================================================
+def bench_reopen(sizes=(5000000,),queue_max=1000):
+    """reopening a file with n jobs left over (all queued by the last run, as
+    if it crashed) and getting the first job, vs the old reset (UPDATE every
+    queued job's in_queue to 0)."""
+    for n in sizes:
+        db = _new_db(True)
+        filename = db.get_filename()
+        t = time.time()
+        with db.get_db() as conn:
+            conn.execute('''WITH RECURSIVE i(x) AS (SELECT 1 UNION ALL
+                    SELECT x+1 FROM i WHERE x<?)
+                INSERT INTO jobs (item_id,job_type,in_queue) SELECT x,'main',1 FROM i''',(n,))
+        _report('fill file',n,time.time()-t)
+        db.close()
+        
+        t = time.time()
+        db = MyDb(filename,queue_max=queue_max)
+        db.get_next_job('main')
+        _report('reopen + first job',n,time.time()-t)
+        
+        t = time.time()
+        with db.get_db() as conn: conn.execute('UPDATE jobs SET in_queue=0 WHERE in_queue<>0')
+        _report('old reset (UPDATE in_queue)',n,time.time()-t)
+        _remove_db(db)
+
+#===============================================================================
+# Delayed Jobs
+#===============================================================================
+def bench_run_at(n=1000,spread=2.):
+    """time-to-dispatch: how long after their run_at parked jobs are handed
+    out to a waiting worker (jobs due over spread seconds)."""
+    db = _new_db()
+    now = time.time()
+    db.add_jobs((str(i),'main',None,0,now+random.random()*spread) for i in xrange(n))
+    
+    late = []
+    while len(late) < n:
+        try: items = db.get_next_jobs('main',count=100)
+        except StopIteration:
+            db.wait_for_jobs('main',timeout=spread)
+            continue
+        t = time.time()
+        ids = set(i[0] for i in items)
+        late.extend(t-i[1] for i in db.iter_jobs(columns=('id','run_at')) if i[0] in ids)
+        db.remove_jobs(ids)
+    late.sort()
+    print '{:<32} {:>11,} jobs  late p50 {:.1f}ms p99 {:.1f}ms max {:.1f}ms'.format(
+        'run_at dispatch',n,1000*late[n//2],1000*late[int(n*.99)],1000*late[-1])
+    _remove_db(db)
+
+#===============================================================================
+# Dependencies
+#===============================================================================
+def bench_deps(parents=200000,fan_in=5):
+    """removing parents (batches of 1000) with parents*fan_in edges pending:
+    every child waits on fan_in random parents."""
+    db = _new_db(True)
+    t = time.time()
+    ids = db.add_jobs((str(i),'fetch') for i in xrange(parents))
+    db.add_jobs((str(i),'export',None,0,None,random.sample(ids,fan_in))
+                for i in xrange(parents))
+    _report('add parents + children',2*parents,time.time()-t)
+    
+    random.shuffle(ids)
+    t = time.time()
+    for n in xrange(0,parents,1000): db.remove_jobs(ids[n:n+1000])
+    _report('remove parents (release children)',parents,time.time()-t)
+    print '{:<32} {:>11,} released'.format('',db._jobs_unblocked_count)
+    _remove_db(db)
+
+#===============================================================================
+# Failing Jobs
+#===============================================================================
+def bench_poison(n=20000,poison=.05,seconds=3.):
+    """healthy jobs done in a few seconds when poison of the jobs always
+    fail: retrying right away (the old failed_job) vs max_attempts with
+    retry_backoff."""
+    for name,keys in (('retry right away',{}),
+                      ('max_attempts=3 retry_backoff=.5',
+                       dict(max_attempts=3,retry_backoff=.5))):
+        db = _new_db(queue_max=1000,**keys)
+        bad = set(random.sample(xrange(n),int(n*poison)))
+        db.add_jobs((str(i),'main') for i in xrange(n))
+        
+        done = failed = 0
+        t = time.time()
+        while time.time()-t < seconds and done < n-len(bad):
+            try: items = db.get_next_jobs('main',count=100)
+            except StopIteration:
+                db.wait_for_jobs('main',timeout=.1)
+                continue
+            for i in items:
+                if int(i[1]) in bad:
+                    db.failed_job(i[0])
+                    failed += 1
+                else:
+                    db.remove_job(i[0])
+                    done += 1
+        _report('poison: {} ({:,} failures)'.format(name,failed),done,time.time()-t)
+        _remove_db(db)
+
+#===============================================================================
+# Run Benchmarks
+#===============================================================================
+def run_bench(*names):
+    """runs the benchmarks passed by name (all if none are)"""
+    benches = [v for k,v in sorted(globals().iteritems())
+               if k.startswith('bench_') and (not names or k[6:] in names)]
+    for bench in benches:
+        print '=== {} ==='.format(bench.__name__)
+        bench()
+
+#===============================================================================
+# Main
+#===============================================================================
+if __name__ == '__main__':
+    run_bench(*sys.argv[1:])
@@ -0,0 +1,236 @@
+"""
+2026-10-18
+benchmarks for mythread.  Run from this folder: python bench_mythread.py
+"""
+import sys
+import time
+import multiprocessing
+if '..' not in sys.path: sys.path.append('..')
+from mydb import MyDb
+from mythread import MyThread
+from mythreadpool import MyThreadPool, drain_threads
+try:
+    import gevent
+    from mygeventthread import MyGeventThread
+except ImportError: gevent = None
+
+#===============================================================================
+# Helpers
+#===============================================================================
+class CpuThread(MyThread):
+    """a CPU-bound synthetic job: init_data rounds of integer math with a
+    checkpoint every 1000 (module level so processes=N can pickle it)."""
+    def _process_item(self,item_id,init_data=None,start_value=None,end_value=None):
+        x = 0
+        for i in xrange(init_data):
+            x = (x*31+i) % 1000003
+            if i % 1000 == 0 and self._thread_block(i): return False,0
+        return True,1
+
+class IoThread(MyThread):
+    """an I/O-bound synthetic job: waits init_data seconds (a request)."""
+    def _process_item(self,item_id,init_data=None,start_value=None,end_value=None):
+        time.sleep(init_data)
+        return not self._thread_block(1),1
+
+if gevent is not None:
+    class GeventIoThread(MyGeventThread):
+        """IoThread with the wait on the thread's hub."""
+        def _process_item(self,item_id,init_data=None,start_value=None,end_value=None):
+            gevent.sleep(init_data)
+            return not self._thread_block(1),1
+
+def _run(n,work,threads=1,cls=CpuThread,**keys):
+    """processes n jobs with threads cls workers - returns the seconds it took."""
+    db = MyDb(':memory:',queue_max=max(1000,n))
+    db.add_jobs((str(i),'main',work) for i in xrange(n))
+    workers = [cls('main',db,**keys) for _ in xrange(threads)]
+    t = time.time()
+    for w in workers: w.start()
+    for w in workers: w.stop()
+    for w in workers: w.join()
+    t = time.time()-t
+    assert db.get_job_count() == 0
+    db.close()
+    return t
+
+def _report(name,n,t,base):
+    print '{:<32} {:>7,} jobs {:>9.3f}s {:>9,.1f} jobs/sec {:>6.2f}x'.format(
+                                                name,n,t,n/(t or 1e-9),base/t)
+
+#===============================================================================
+# Process Pool
+#===============================================================================
+def bench_processes(n=200,work=200000):
+    """a CPU-bound job with threads (the GIL holds them to one core) vs
+    processes=N, for N up to the number of cores."""
+    cores = multiprocessing.cpu_count()
+    base = _run(n,work)
+    _report('threads=1',n,base,base)
+    t = _run(n,work,threads=cores)
+    _report('threads={}'.format(cores),n,t,base)
+
+    p = 1
+    while True:
+        t = _run(n,work,processes=p)
+        _report('threads=1 processes={}'.format(p),n,t,base)
+        if p >= cores: break
+        p = min(p*2,cores)
+
+#===============================================================================
+# Checkpoints
+#===============================================================================
+class BlockThread(MyThread):
+    """init_data records, calling _thread_block for each (if blocking)."""
+    blocking = True
+    def _process_item(self,item_id,init_data=None,start_value=None,end_value=None):
+        if self.blocking:
+            for i in xrange(init_data):
+                if self._thread_block(i): return False,0
+        else:
+            for i in xrange(init_data): pass
+        return True,init_data
+
+def bench_thread_block(records=2000000):
+    """per-record cost of _thread_block in a tight loop: looking at the
+    clock every call vs checkpoint_every=N."""
+    for name,keys in (('no _thread_block',dict(blocking=False)),
+                      ('checkpoint_every=1',{}),
+                      ('checkpoint_every=100',dict(checkpoint_every=100)),
+                      ('checkpoint_every=1000',dict(checkpoint_every=1000))):
+        db = MyDb(':memory:')
+        db.add_job('1','main',records)
+        blocking = keys.pop('blocking',True)
+        w = BlockThread('main',db,**keys)
+        w.blocking = blocking
+        t = time.time()
+        w.start()
+        w.stop()
+        w.join()
+        t = time.time()-t
+        print '{:<32} {:>11,} records {:>9.3f}s {:>8.3f}us/record'.format(
+                                            name,records,t,1e6*t/records)
+        db.close()
+
+#===============================================================================
+# Batch Sizes
+#===============================================================================
+def bench_batch(n=20000,work=100,threads=4):
+    """small jobs with a few threads: fixed batch sizes vs batch_target
+    (sized from the time per job)."""
+    base = _run(n,work,threads=threads)
+    _report('batch=1',n,base,base)
+    for keys in (dict(batch=10),dict(batch=1000),dict(batch_target=.05)):
+        t = _run(n,work,threads=threads,**keys)
+        _report(' '.join('{}={}'.format(*i) for i in keys.iteritems()),n,t,base)
+    
+    # slow (waiting) jobs: a big batch leaves the other threads idle
+    n,wait = n//50,.01
+    base = _run(n,wait,threads=threads,cls=IoThread)
+    _report('slow jobs batch=1',n,base,base)
+    for keys in (dict(batch=1000),dict(batch_target=.05)):
+        t = _run(n,wait,threads=threads,cls=IoThread,**keys)
+        _report('slow jobs '+' '.join('{}={}'.format(*i) for i in keys.iteritems()),
+                n,t,base)
+
+#===============================================================================
+# Thread Pool
+#===============================================================================
+def bench_pool(n=2000,wait=.01,threads=16):
+    """slow (waiting) jobs: a fixed number of threads vs a MyThreadPool
+    scaling 1 to threads."""
+    base = _run(n,wait,threads=1,cls=IoThread)
+    _report('threads=1',n,base,base)
+    t = _run(n,wait,threads=threads,cls=IoThread)
+    _report('threads={}'.format(threads),n,t,base)
+    
+    db = MyDb(':memory:',queue_max=n)
+    db.add_jobs((str(i),'main',wait) for i in xrange(n))
+    pool = MyThreadPool(db,interval=.1,drain_time=1)
+    pool.add_workers('main',IoThread,max_threads=threads)
+    t = time.time()
+    pool.start()
+    pool.stop()
+    pool.join()
+    t = time.time()-t
+    _report('MyThreadPool 1-{} (peak {})'.format(threads,pool._types['main'].peak),
+            n,t,base)
+    db.close()
+
+def bench_drain(threads=16,records=10**9):
+    """how long draining threads mid-job takes (each job saves itself at its
+    next _thread_block): with checkpoint_every=N and async_checkpoints."""
+    for name,keys in (('checkpoint_every=1',{}),
+                      ('checkpoint_every=1000',dict(checkpoint_every=1000)),
+                      ('async_checkpoints',dict(async_checkpoints=True))):
+        db = MyDb(':memory:',checkpoint_delay=.5)
+        db.add_jobs((str(i),'main',records) for i in xrange(threads))
+        workers = [BlockThread('main',db,**keys) for _ in xrange(threads)]
+        for w in workers: w.start()
+        time.sleep(.5)
+        report = drain_threads(workers,db,timeout=10)
+        print '{:<32} {:>3} threads {:>9.3f}s drain {:>3} saved {:>3} in progress'.format(
+                name,threads,report['seconds'],len(report['saved']),
+                len(report['in_progress']))
+        db.close()
+
+#===============================================================================
+# Several Job Types
+#===============================================================================
+def bench_job_types(n=1000,wait=.005,threads=4):
+    """a burst of one job_type (n 'a' jobs, n//10 'b'): threads split
+    between the job_types vs every thread doing both."""
+    def run(job_types):
+        db = MyDb(':memory:',queue_max=n)
+        db.add_jobs((str(i),'a',wait) for i in xrange(n))
+        db.add_jobs((str(i),'b',wait) for i in xrange(n//10))
+        workers = [IoThread(j,db) for j in job_types]
+        t = time.time()
+        for w in workers: w.start()
+        for w in workers: w.stop()
+        for w in workers: w.join()
+        t = time.time()-t
+        assert db.get_job_count() == 0
+        db.close()
+        return t
+    m = n+n//10
+    base = run(['a','b']*(threads//2))
+    _report('{0} a threads, {0} b threads'.format(threads//2),m,base,base)
+    t = run([{'a':1,'b':1}]*threads)
+    _report('{} a+b threads'.format(threads),m,t,base)
+    t = run([{'a':10,'b':1}]*threads)
+    _report('{} a+b threads (weights 10:1)'.format(threads),m,t,base)
+
+#===============================================================================
+# Greenlets
+#===============================================================================
+def bench_greenlets(n=5000,wait=.2):
+    """I/O-bound jobs (each waits wait seconds): OS threads (one job each)
+    vs a few MyGeventThreads with 1,000+ jobs in flight."""
+    if gevent is None:
+        print 'gevent is not installed'
+        return
+    base = _run(n,wait,threads=50,cls=IoThread)
+    _report('threads=50',n,base,base)
+    t = _run(n,wait,threads=250,cls=IoThread)
+    _report('threads=250',n,t,base)
+    for threads,greenlets in ((1,1000),(4,250),(4,500)):
+        t = _run(n,wait,threads=threads,cls=GeventIoThread,greenlets=greenlets)
+        _report('threads={} greenlets={}'.format(threads,greenlets),n,t,base)
+
+#===============================================================================
+# Run Benchmarks
+#===============================================================================
+def run_bench(*names):
+    """runs the benchmarks passed by name (all if none are)"""
+    benches = [v for k,v in sorted(globals().iteritems())
+               if k.startswith('bench_') and (not names or k[6:] in names)]
+    for bench in benches:
+        print '=== {} ==='.format(bench.__name__)
+        bench()
+
+#===============================================================================
+# Main
+#===============================================================================
+if __name__ == '__main__':
+    run_bench(*sys.argv[1:])
@@ -9,16 +9,101 @@ CHANGELOG:
     unique index on item_id to optimize adding jobs
 """
 import os
+import csv
+import socket
 import sqlite3 as sql
 import threading
+import time
+import heapq
+from contextlib import contextmanager
 #from threading import Lock as Thread_Lock
 #from threading import Event as Thread_Event
-from collections import deque
 from myloggingbase import MyLoggingBase
 
 QUEUE_FIFO = True
 QUEUE_LIFO = False
 
+class _JobQueue(object):
+    """a job_type's queue (used by MyDb): a heap of jobs, highest priority
+    first, then by id (oldest first if FIFO, newest first if LIFO).  If maxlen
+    is set, the lowest priority jobs are dropped when there are too many."""
+    __slots__ = ('maxlen','_heap','_sign')
+    _ID_BITS = 40 # job ids must be less than 2**40 (keys stay ints, not longs)
+    
+    def __init__(self,maxlen=None,queue_type=QUEUE_FIFO):
+        self.maxlen = maxlen
+        self._heap = []
+        self._sign = 1 if queue_type==QUEUE_FIFO else -1
+    
+    def __len__(self): return len(self._heap)
+    
+    def __iter__(self):
+        """iterates the jobs in the order they'll be popped (not thread safe)"""
+        return (i[1] for i in sorted(self._heap))
+    
+    def pop(self):
+        """removes and returns the next job. Raises IndexError if empty."""
+        return heapq.heappop(self._heap)[1]
+    
+    def push_many(self,items):
+        """adds the jobs; items are job tuples with an optional priority at the
+        end (index 5).  Returns (ids added, ids dropped) - the dropped ids can
+        be new or ones that were already in the queue."""
+        # one int key sorts quicker than a tuple: priority then (signed) id
+        h,sign,shift = self._heap,self._sign,self._ID_BITS
+        entries = [((-(i[5] or 0) << shift if len(i)>5 else 0)+sign*i[0],i[:5])
+                   for i in items]
+        
+        # heapify is quicker when adding a lot
+        if len(entries) > len(h):
+            h.extend(entries)
+            heapq.heapify(h)
+        else:
+            for e in entries: heapq.heappush(h,e)
+        
+        # too many? keep the best
+        dropped = ()
+        if self.maxlen and len(h) > self.maxlen:
+            kept = heapq.nsmallest(self.maxlen,h)
+            cutoff = kept[-1][0]
+            dropped = tuple(e[1][0] for e in h if e[0] > cutoff)
+            h[:] = kept # a sorted list is a heap
+            
+            d = set(dropped)
+            return tuple(e[1][0] for e in entries if e[1][0] not in d),dropped
+        return tuple(e[1][0] for e in entries),dropped
+
+class _JobCondition(object):
+    """a job_type's Condition (on the queue lock, used by MyDb and MyMemDb).
+    Notifying it also notifies the groups of job_types it's in - the threads
+    waiting on any of several (see MyDb.wait_for_jobs)."""
+    __slots__ = ('_cond','groups')
+    
+    def __init__(self,lock):
+        self._cond = threading.Condition(lock)
+        self.groups = [] # _JobConditions of the groups it's in
+    
+    def wait(self,timeout=None): self._cond.wait(timeout)
+    
+    def notify(self,n=1):
+        self._cond.notify(n)
+        for g in self.groups: g.notify(n)
+    
+    def notify_all(self):
+        self._cond.notify_all()
+        for g in self.groups: g.notify_all()
+
+def _job_condition(conditions,lock,job_type):
+    """returns job_type's _JobCondition from conditions (creating it if
+    needed).  job_type can be a tuple of job_types: a group, notified
+    whenever one of them is.  Assumes you have the lock."""
+    try: return conditions[job_type]
+    except KeyError:
+        c = conditions[job_type] = _JobCondition(lock)
+        if isinstance(job_type,tuple):
+            for t in job_type: _job_condition(conditions,lock,t).groups.append(c)
+        return c
+
 class MyDb(MyLoggingBase):
     """
     db with jobs table.  Works closely with MyThread class which masks the using
@@ -31,14 +116,88 @@ class MyDb(MyLoggingBase):
             just run populate_queues.
             It'll go through all the remaining jobs and add them
             can add option in mythread to do this whenever the queue is empty.
+        wal=True switches the db to WAL and gives each thread its own
+            connection for reads (get_tables, get_job_count, iter_jobs), so
+            reads don't wait on the writer.  Writes still go through the one
+            connection and the lock.  ':memory:' dbs can't use WAL; they use
+            a shared-cache memory db instead: its readers read uncommitted
+            (they'd fail on the writer's table locks otherwise), so they
+            can see another thread's transaction(...) before it commits.
+            Reader connections are pooled (at most readers of them).
+        each job has a priority (default 0); higher priority jobs are queued
+            and handed out first.  queue_type only orders jobs of the same
+            priority.  If the queues are limited (queue_max), the lowest
+            priority jobs are the ones left in the db.
+        in_queue is the run (see meta) that queued the job: every open of an
+            existing db starts a new run, so jobs queued by an earlier run are
+            waiting again (0 <= in_queue < run) without rewriting them - opening
+            doesn't touch the jobs table.  0 is never queued.  -1 is parked:
+            waiting for its run_at (see add_jobs); a timer thread moves them
+            to waiting when they're due and wakes that job_type's waiters.
+            -2 is blocked: waiting for its parents (see add_jobs after).
+        job_deps holds the (parent_id,child_id) edges of blocked jobs.  When
+            parents are removed (done), their edges are deleted and the
+            children with none left are released - in the same transaction.
+            A dead or failed parent keeps its children blocked.
+        job_counts holds the number of jobs per job_type and in_queue state,
+            kept up to date by triggers on jobs, so counting jobs and
+            populating queues doesn't scan the jobs table.
+        each job_type has its own condition (on the queue lock) to wait on
+            for jobs - see wait_for_jobs(...) and wake_up(...).  Adding jobs
+            only wakes as many waiters of that job_type as jobs added.
+            .event is still set when jobs are added, for old code.
+        checkpoint_delay=N buffers update_job/failed_job calls (last one per
+            job wins) and writes them in one transaction within N seconds,
+            when checkpoint_max_pending are waiting, on flush_updates() or on
+            close().  Pass flush=True to update_job/failed_job to write before
+            returning.  The default (None) writes every call right away.
+        failed_job counts the job's attempts.  With retry_backoff=N the job
+            is parked (see run_at) for N seconds, doubling each attempt (up to
+            retry_backoff_max) instead of going straight back to waiting, and
+            with max_attempts=N it's moved to jobs_dead on its Nth failure so
+            poison jobs don't keep coming back.  See get_dead_jobs(...) and
+            requeue_dead(...).
+        lease_time=N lets several processes share one db file: jobs are
+            claimed in the db (claim_jobs) with an owner and a lease that
+            expires in N seconds instead of being put in in-memory queues.
+            get_next_jobs claims, update_job renews the lease, failed_job and
+            close() release them and expired leases are claimed again.
+            Every process sharing the file must use it.
+        low_watermark=N starts a refill thread: when a job_type's queue has
+            fewer than N jobs, it's topped back up (populate_queues) in the
+            background so get_next_jobs rarely has to go to the db itself.
+            Only worth it with queue_max.
+        archive=True moves jobs to jobs_history when they're removed (done),
+            with when they were completed, how long they took and how many
+            rows (from MyThread).  compact() applies the retention
+            (archive_max_age/archive_max_rows) and frees pages with
+            incremental_vacuum - it's run when a worker goes idle
+            (wait_for_jobs) every compact_interval seconds and on close().
+            An existing db opened with archive=True for the first time is
+            switched to incremental auto_vacuum with a one-time VACUUM
+            (it rewrites the file - slow for big dbs).
+            See iter_history(...)/export_history(...).
+        transaction() (or batch()) groups add_job(s)/update_job/remove_job(s)/
+            failed_job calls into one transaction and one lock hold.  Queue
+            side effects (pushes, wake ups) happen after it commits; nothing
+            is kept if it rolls back.
     """
-    #TODO: thread event per queue
     
     #===========================================================================
     # Class Constants
     #===========================================================================
     _JOBS_ID,_JOBS_IN_QUEUE,_JOBS_ITEM_ID,_JOBS_JOB_TYPE, = 0,1,2,3
-    _JOBS_INIT_DATA,_JOBS_START_VALUE,_JOBS_END_VALUE = 4,5,6
+    _JOBS_INIT_DATA,_JOBS_START_VALUE,_JOBS_END_VALUE,_JOBS_PRIORITY = 4,5,6,7
+    _JOBS_LEASE_OWNER,_JOBS_LEASE_EXPIRES,_JOBS_RUN_AT = 8,9,10
+    
+    # (name, definition) of columns added to jobs after it was first made
+    _JOBS_ADDED_COLUMNS = (('priority','INTEGER DEFAULT 0'),
+                           ('lease_owner','TEXT'),
+                           ('lease_expires','REAL DEFAULT 0'),
+                           ('run_at','REAL DEFAULT 0'),
+                           ('attempts','INTEGER DEFAULT 0'))
+    _PARKED = -1 # in_queue of jobs waiting for their run_at
+    _BLOCKED = -2 # in_queue of jobs waiting for their parents
     
     JOB_ID,ITEM_ID,INIT_DATA,START_VALUE,END_VALUE = 0,1,2,3,4
     
@@ -50,9 +209,59 @@ class MyDb(MyLoggingBase):
     queue_type = None
     _db = None # the database connection object
     _filename = None # the name of the db file
-    _lock = None # a thread lock to control read/writes
+    _lock = None # a (re-entrant) thread lock to control read/writes
+    _txn = None # thread local - the transaction() state (depth,after,undo)
     _queue_lock = None
-    event = None
+    _run = 1 # this run's id - what in_queue is set to for queued jobs
+    _conditions = None # job_type (or tuple of): _JobCondition to wait for jobs
+    _refill = None # job_type: False if the last populate found nothing more
+    event = None # deprecated: use wait_for_jobs(...) and wake_up(...)
+    
+    _wal = None # use WAL and a connection per thread for reads?
+    _reader_target = None # what readers connect to (None if no readers)
+    _readers = None # most reader connections open at once
+    _reader_slots = None # BoundedSemaphore - one per reader connection
+    _reader_idle = None # reader connections not in use
+    _reader_conns = None # all the reader connections (to close them)
+    _reader_gen = 0 # bumped on close so old reader connections aren't used
+    _reader_lock = None # for _reader_idle and _reader_conns
+    
+    _checkpoint_delay = None # None: no buffer, else seconds till flushed
+    _checkpoint_max = None # flush right away if this many are pending
+    _pending = None # job_id: [start_value,end_value,failed] to write
+    _pending_lock = None
+    _flusher = None # thread to flush the pending checkpoints
+    _flush_event = None
+    _flusher_stop = None # Event set to stop the flusher (cuts its sleep short)
+    
+    _low_watermark = None # None: refill when empty, else refill below this
+    _refill_wanted = None # job_type: time the refill was asked for
+    _refilling = None # job_types being refilled now
+    _refiller = None # thread to refill the queues
+    _refill_event = None
+    _refiller_stop = False
+    
+    _archive = None # move removed jobs to jobs_history?
+    _archive_max_age = None # seconds history is kept (None for forever)
+    _archive_max_rows = None # most history rows kept (None for no limit)
+    _compact_interval = None # min seconds between compacting when idle
+    _last_compact = 0
+    _started = None # job_id: time it was handed out (for the history)
+    
+    _timers = None # heap of (run_at,job_type) - when parked jobs are due
+    _timer_cond = None # Condition (on the queue lock) the timer thread waits on
+    _timer_thread = None
+    _timer_stop = False
+    
+    _deps = False # are there job_deps to check when jobs are removed?
+    
+    _max_attempts = None # failures before a job's dead (None: never)
+    _retry_backoff = None # seconds a failed job's parked (None: not parked)
+    _retry_backoff_max = None # most seconds a failed job's parked
+    
+    _lease_time = None # None: in-memory queues, else seconds a claim lasts
+    _lease_owner = None # who claims are made for (unique per MyDb)
+    _lease_poll = None # seconds to wait between looking for other's jobs
     
     #===========================================================================
     # Tracked Metrics
@@ -61,11 +270,50 @@ class MyDb(MyLoggingBase):
     _jobs_updated_count = None
     _jobs_removed_count = None
     _populate_count = None
+    _flush_count = None
+    _flushed_jobs_count = None
+    _jobs_claimed_count = None
+    _refill_count = None # background refills
+    _refill_latency = None # total seconds from asking for a refill to done
+    _refill_latency_max = None
+    _stall_count = None # get_next_jobs found the queue empty and populated
+    _jobs_archived_count = None
+    _jobs_released_count = None # parked jobs that came due
+    _jobs_failed_count = None
+    _jobs_dead_count = None # moved to jobs_dead (max_attempts)
+    _jobs_unblocked_count = None # blocked jobs whose parents are all done
+    _dispatch_delay = None # total seconds released after their run_at
+    _dispatch_delay_max = None
+    _compact_count = None
+    _pages_freed_count = None
     __total_changes = 0
     
-    def __init__(self,filename=None,queue_max=None,queue_type=QUEUE_FIFO):
+    def __init__(self,filename=None,queue_max=None,queue_type=QUEUE_FIFO,**keys):
         """filename if the file name for the db file. If no filename is passed,
-        no db will be created; you can then use either .new(...) or .open(...)."""
+        no db will be created; you can then use either .new(...) or .open(...).
+        keys:
+            wal=False: use WAL and pooled connections for reads.
+            readers=4: (wal) most reader connections - when they're all in
+                use, reads wait for one.
+            checkpoint_delay=None: seconds update_job/failed_job calls can
+                wait in the buffer (None to write right away).
+            checkpoint_max_pending=1000: flush when this many are buffered.
+            lease_time=None: seconds a claimed job is leased for (None to use
+                in-memory queues - only one process can use the db).
+            lease_owner=<host>:<pid>:<id>: who jobs are claimed for.
+            lease_poll=1: seconds wait_for_jobs waits before looking again for
+                jobs added by other processes.
+            low_watermark=None: refill a queue in the background when it has
+                fewer jobs than this (None to refill when empty).
+            archive=False: keep removed jobs in jobs_history.
+            archive_max_age=None: seconds to keep history (None for forever).
+            archive_max_rows=None: most history rows to keep (None for all).
+            compact_interval=60: seconds between compacting when idle.
+            max_attempts=None: failures before a job is moved to jobs_dead
+                (None to retry forever).
+            retry_backoff=None: seconds a failed job waits before it's retried,
+                doubled each attempt (None to retry right away).
+            retry_backoff_max=3600: most seconds a failed job waits."""
         
         super(MyDb,self).__init__()
         
@@ -73,15 +321,70 @@ class MyDb(MyLoggingBase):
         self._jobs_updated_count = 0
         self._jobs_removed_count = 0
         self._populate_count = 0
+        self._flush_count = 0
+        self._flushed_jobs_count = 0
+        self._jobs_claimed_count = 0
+        self._refill_count = 0
+        self._refill_latency = 0
+        self._refill_latency_max = 0
+        self._stall_count = 0
+        self._jobs_archived_count = 0
+        self._jobs_released_count = 0
+        self._jobs_failed_count = 0
+        self._jobs_dead_count = 0
+        self._jobs_unblocked_count = 0
+        self._dispatch_delay = 0
+        self._dispatch_delay_max = 0
+        self._compact_count = 0
+        self._pages_freed_count = 0
         
-        self._lock = threading.Lock()
+        self._lock = threading.RLock()
+        self._txn = threading.local()
         self._queue_lock = threading.Lock()
         self.event = threading.Event()
         self.event.clear()
         self._queues = {}
+        self._timers = []
+        self._timer_cond = threading.Condition(self._queue_lock)
+        self._conditions = {}
+        self._refill = {}
         self.queue_max = queue_max if queue_max else None
         self.queue_type = queue_type
         
+        self._wal = keys.pop('wal',False)
+        self._readers = keys.pop('readers',4)
+        self._reader_slots = threading.BoundedSemaphore(self._readers)
+        self._reader_idle = []
+        self._reader_conns = []
+        self._reader_lock = threading.Lock()
+        
+        self._checkpoint_delay = keys.pop('checkpoint_delay',None)
+        self._checkpoint_max = keys.pop('checkpoint_max_pending',1000)
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._flush_event = threading.Event()
+        self._flusher_stop = threading.Event()
+        
+        self._low_watermark = keys.pop('low_watermark',None)
+        self._refill_wanted = {}
+        self._refilling = set()
+        self._refill_event = threading.Event()
+        
+        self._archive = keys.pop('archive',False)
+        self._archive_max_age = keys.pop('archive_max_age',None)
+        self._archive_max_rows = keys.pop('archive_max_rows',None)
+        self._compact_interval = keys.pop('compact_interval',60)
+        self._started = {}
+        
+        self._max_attempts = keys.pop('max_attempts',None)
+        self._retry_backoff = keys.pop('retry_backoff',None)
+        self._retry_backoff_max = keys.pop('retry_backoff_max',3600)
+        
+        self._lease_time = keys.pop('lease_time',None)
+        self._lease_owner = keys.pop('lease_owner','{}:{}:{}'.format(
+                                    socket.gethostname(),os.getpid(),id(self)))
+        self._lease_poll = keys.pop('lease_poll',1)
+        
         if filename != None:
             self.open(filename)
             
@@ -114,13 +417,96 @@ class MyDb(MyLoggingBase):
             if self._is_open(): self._close()
             
             #                             ,isolation_level=self._isolation_level
-            try: db = sql.connect(filename,check_same_thread=False) #auto-commit
+            try: db = self._connect(filename) #auto-commit
             except sql.Error, e:
                 # log and return failure!
                 self.logger.critical('failed. %s: %r',e.__class__.__name__,e)
                 db = None
             
         return db
+    
+    def _connect(self,filename):
+        """opens the connection (the writer).  If using WAL, switches the db to
+        WAL and sets what the per-thread readers connect to."""
+        self._reader_target = None
+        if not self._wal:
+            db = sql.connect(filename,check_same_thread=False)
+        
+        # memory dbs can't use WAL, but readers can share the cache
+        elif filename==':memory:':
+            uri = 'file:mydb{}?mode=memory&cache=shared'.format(id(self))
+            db = sql.connect(uri,check_same_thread=False)
+            if db.execute('PRAGMA database_list').fetchone()[2]:
+                # URIs aren't supported... it made a file! go back to normal
+                self.logger.warning('shared-cache memory dbs not supported - no readers')
+                db.close()
+                if os.path.exists(uri): os.remove(uri)
+                db = sql.connect(filename,check_same_thread=False)
+            else: self._reader_target = uri
+        else:
+            db = sql.connect(filename,check_same_thread=False)
+            mode = db.execute('PRAGMA journal_mode=WAL').fetchone()[0]
+            if mode.lower() != 'wal':
+                self.logger.warning('failed to switch to WAL (%s) - no readers',mode)
+            else: self._reader_target = filename
+        
+        self._create_stage(db)
+        return db
+    
+    def _create_stage(self,conn):
+        """creates the (temp) table add_jobs stages its items in.  Done once
+        when connecting: DDL commits whatever transaction is open (python's
+        sqlite3), so it can't be run in add_jobs."""
+        conn.execute('''CREATE TEMP TABLE IF NOT EXISTS jobs_stage(
+                seq INTEGER PRIMARY KEY,
+                item_id TEXT NOT NULL,
+                job_type TEXT NOT NULL,
+                init_data INTEGER,
+                priority INTEGER NOT NULL,
+                run_at REAL,
+                blocked INTEGER NOT NULL)''')
+        
+    @contextmanager
+    def _reading(self):
+        """with self._reading() as conn: for reads. With readers, it's a
+        connection from the pool (made when needed, at most readers of them -
+        waits for one if they're all in use) and no lock; otherwise it's the
+        (shared) writer connection with the lock held. Assumes the db is open."""
+        if self._reader_target is None:
+            with self._lock: yield self._db
+            return
+        
+        with self._reader_slots:
+            with self._reader_lock:
+                gen = self._reader_gen
+                conn = self._reader_idle.pop() if self._reader_idle else None
+            if conn is None: conn = self._new_reader()
+            try: yield conn
+            finally:
+                with self._reader_lock:
+                    if gen == self._reader_gen: self._reader_idle.append(conn)
+                    else: conn.close() # the db was closed meanwhile
+    
+    def _new_reader(self):
+        """opens a reader connection (see _reading)."""
+        conn = sql.connect(self._reader_target,check_same_thread=False)
+        # shared-cache: don't fail on the writer's table locks - so reads see
+        # uncommitted writes (see wal in the class docs)
+        if self._reader_target != self._filename:
+            conn.execute('PRAGMA read_uncommitted=1')
+        with self._reader_lock: self._reader_conns.append(conn)
+        return conn
+    
+    def _close_readers(self):
+        """closes all the reader connections (assumes you have the lock)."""
+        with self._reader_lock:
+            self._reader_gen += 1
+            for conn in self._reader_conns:
+                try: conn.close()
+                except sql.Error as e:
+                    self.logger.warning('failed closing reader. %r',e)
+            del self._reader_conns[:]
+            del self._reader_idle[:]
         
     #===========================================================================
     # Open Db
@@ -137,7 +523,7 @@ class MyDb(MyLoggingBase):
         # open db if file exists...
         elif os.path.exists(filename):
             # init db - try
-            try: self._db = sql.connect(filename,check_same_thread=False)
+            try: self._db = self._connect(filename)
             except sql.Error, e:
                 # log and return failure!
                 self.logger.critical('failed. %s: %r',e.__class__.__name__,e)
@@ -147,7 +533,12 @@ class MyDb(MyLoggingBase):
             else:
                 self.logger.info('database opened')
                 self._filename = filename
-                self.populate_queues(first_call=True)
+                if not self._upgrade_db_structure(): return False
+                if self._archive: self._set_incremental_vacuum()
+                # jobs are claimed from the db when leasing - no queues
+                if self._lease_time is None:
+                    self.populate_queues(first_call=True)
+                    self._load_timers()
                 return True
             
         # create db only if it should be created!
@@ -173,17 +564,29 @@ class MyDb(MyLoggingBase):
     #===========================================================================
     def close(self,commit=True):
         """return true if db closed successfully.  The db commits every action;
-        the 'commit' argument is there for overriding and has no function."""
+        the 'commit' argument is there for overriding and has no function.
+        Pending (buffered) checkpoints are written first."""
+        self._stop_flusher()
+        self._stop_refiller()
+        self._stop_timer()
+        if self._archive and self.is_open(): self.compact()
         with self._lock: success = self._close(commit)
         return success
     
     def _close(self,commit=True):
         if self._db!=None:
             try:
+                with self._db as conn:
+                    self._flush_updates(conn)
+                    # let the jobs we didn't finish be claimed right away
+                    if self._lease_time is not None:
+                        conn.execute('''UPDATE jobs SET lease_owner=NULL,lease_expires=0
+                            WHERE lease_owner=?''',(self._lease_owner,))
                 # save changes if needed (never because using autocommit)
                 if commit: self._db.commit() # not necessary...
                 self.__total_changes = self._db.total_changes
-                # close db
+                # close db (readers first - memory dbs go with the writer)
+                self._close_readers()
                 self._db.close()
                 self._db = None
                 
@@ -223,39 +626,107 @@ class MyDb(MyLoggingBase):
     def get_tables(self):
         """returns the list of tables or None if something failed..."""
         tables = None
-        with self._lock:
-            if self._is_open():
+        if self._is_open():
+            with self._reading() as conn:
                 try:
-                    with self._db as conn:
-                        tables = conn.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()
+                    tables = conn.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()
                 except sql.Error as e:
                     self.logger.warning('failed!?!? %r',e)
         return tables
     
-    def get_job_count(self):
-        """returns the number of jobs in the db."""
+    def get_job_count(self,job_type=None):
+        """returns the number of jobs in the db (of job_type if passed)."""
         job_cnt = False
-        with self._lock:
-            if self._is_open():
+        if self._is_open():
+            with self._reading() as conn:
                 try:
-                    with self._db as conn:
-                        job_cnt = conn.execute('SELECT COUNT(id) FROM jobs').fetchone()[0]
+                    if job_type is None:
+                        job_cnt = conn.execute('SELECT ifnull(SUM(cnt),0) FROM job_counts').fetchone()[0]
+                    else:
+                        job_cnt = conn.execute('''SELECT ifnull(SUM(cnt),0) FROM job_counts
+                            WHERE job_type=?''',(job_type,)).fetchone()[0]
                 except sql.Error as e:
                     self.logger.warning('failed!?!? %r',e)
         return job_cnt
     
-    def iter_jobs(self):
-        """iterate through all the jobs.  NOTE: this locks the db!!!"""
-        with self._lock:
-            if self._is_open():
+    def get_job_counts(self):
+        """returns the number of jobs per job_type and in_queue state:
+        {job_type: {in_queue: count}}.  in_queue is 1 for jobs queued this
+        run, 0 for ones waiting (including ones queued by earlier runs), -1
+        for ones parked till their run_at and -2 for ones blocked by parents.
+        None if something failed..."""
+        counts = None
+        if self._is_open():
+            with self._reading() as conn:
                 try:
-                    with self._db as conn:
-                        for i in conn.execute('SELECT * FROM jobs'):
-                            yield i
+                    counts = {}
+                    for job_type,in_queue,cnt in conn.execute(
+                            'SELECT job_type,in_queue,cnt FROM job_counts WHERE cnt>0'):
+                        if in_queue > 0: in_queue = int(in_queue==self._run)
+                        c = counts.setdefault(job_type,{})
+                        c[in_queue] = c.get(in_queue,0)+cnt
                 except sql.Error as e:
                     self.logger.warning('failed!?!? %r',e)
+                    counts = None
+        return counts
+    
+    def iter_jobs(self,job_type=None,in_queue=None,started=None,columns=None,
+                  page_size=1000):
+        """iterate through the jobs (by id), a page (page_size rows) at a
+        time - the lock is only held while getting a page, so it's fine to
+        go slow or stop part way through.  Jobs changed while iterating may
+        or may not be seen.
+        Params:
+            job_type: only jobs of this job_type.
+            in_queue: 1 for only jobs queued this run, 0 for only ones waiting
+                (queued by earlier runs too).  Other values are matched as is.
+            started: True for only jobs with a start_value, False for only
+                ones without (None for both).
+            columns: list of column names to return (default is all)."""
+        if not self._is_open(): return
+        
+        where,params = ['id>?'],[]
+        if job_type is not None:
+            where.append('job_type=?'); params.append(job_type)
+        if in_queue == 1:
+            where.append('in_queue=?'); params.append(self._run)
+        elif in_queue == 0:
+            where.append('in_queue>=0 AND in_queue<?'); params.append(self._run)
+        elif in_queue is not None:
+            where.append('in_queue=?'); params.append(in_queue)
+        if started is not None:
+            where.append('start_value IS {}NULL'.format('NOT ' if started else ''))
+        
+        if columns is None: cols = '*'
+        else:
+            # only real column names (they go in the sql) - a SELECT, not a
+            # PRAGMA, so an open transaction on the writer isn't committed
+            with self._reading() as conn:
+                known = set(i[0] for i in conn.execute(
+                                        'SELECT * FROM jobs LIMIT 0').description)
+            bad = [c for c in columns if c not in known]
+            if bad: raise ValueError('not columns of jobs: {}'.format(bad))
+            cols = ','.join(columns)
+        # the id (last) is needed for the next page
+        query = 'SELECT {},id FROM jobs WHERE {} ORDER BY id LIMIT ?'.format(
+                                                    cols,' AND '.join(where))
+        
+        last_id = -1
+        while True:
+            with self._reading() as conn: # could've closed between pages
+                if not self._is_open(): return
+                try: rows = conn.execute(query,[last_id]+params+[page_size]).fetchall()
+                except sql.Error as e:
+                    self.logger.warning('failed!?!? %r',e)
+                    return
+            
+            for i in rows: yield i[:-1]
+            if len(rows) < page_size: return
+            last_id = rows[-1][-1]
     
     def get_event(self):
+        """deprecated: returns the event set whenever jobs are added (any
+        job_type).  Use wait_for_jobs(...) and wake_up(...)."""
         return self.event
     
     #===========================================================================
@@ -264,6 +735,8 @@ class MyDb(MyLoggingBase):
     def _init_db_structure(self):
         """creates job table. override to make the db more interesting!
         This method is called only when a new db is created."""
+        # so compact() can give back free pages (must be before any tables)
+        if self._archive: self._db.execute('PRAGMA auto_vacuum=INCREMENTAL')
         with self._db as conn:
             conn.execute('''
                 CREATE TABLE jobs(
@@ -274,10 +747,169 @@ class MyDb(MyLoggingBase):
                 init_data INTEGER,
                 start_value TEXT,
                 end_value TEXT,
+                priority INTEGER DEFAULT 0,
+                lease_owner TEXT,
+                lease_expires REAL DEFAULT 0,
+                run_at REAL DEFAULT 0,
+                attempts INTEGER DEFAULT 0,
                 CONSTRAINT jobs_itemId_jobType_initData_uni UNIQUE
                     (item_id,job_type,init_data))''')
             conn.execute('CREATE INDEX jobs_item_id_idx ON jobs (item_id)')
+            self._create_indexes(conn)
+            self._create_job_counts(conn)
+            self._create_meta(conn)
+            self._create_dead(conn)
+            self._create_deps(conn)
+            if self._archive: self._create_history(conn)
         return True
+    
+    def _create_indexes(self,conn):
+        """creates the jobs indexes added since the table was first made (if
+        they don't exist)."""
+        # refilling a queue: WHERE job_type=? AND in_queue=? ORDER BY priority DESC,id
+        conn.execute('''CREATE INDEX IF NOT EXISTS jobs_refill_idx
+            ON jobs (job_type,in_queue,priority DESC,id)''')
+        conn.execute('DROP INDEX IF EXISTS jobs_priority_idx') # replaced by ^
+        # claiming: WHERE job_type=? AND lease_expires=0 ORDER BY priority DESC,id
+        #  and expired: WHERE job_type=? AND lease_expires BETWEEN ...
+        conn.execute('''CREATE INDEX IF NOT EXISTS jobs_lease_idx
+            ON jobs (job_type,lease_expires,priority DESC,id)''')
+        # due parked jobs: WHERE in_queue=-1 AND run_at<=? (only parked are in it)
+        conn.execute('''CREATE INDEX IF NOT EXISTS jobs_timer_idx
+            ON jobs (run_at) WHERE in_queue=-1''')
+    
+    def _create_job_counts(self,conn):
+        """creates the job_counts table (and fills it if it's new) and the
+        triggers that keep it in sync with the jobs table."""
+        new = not conn.execute('''SELECT 1 FROM sqlite_master
+            WHERE type='table' AND name='job_counts\'''').fetchone()
+        conn.execute('''CREATE TABLE IF NOT EXISTS job_counts(
+                job_type TEXT NOT NULL,
+                in_queue INTEGER NOT NULL,
+                cnt INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (job_type,in_queue))''')
+        if new:
+            conn.execute('''INSERT INTO job_counts (job_type,in_queue,cnt)
+                SELECT job_type,in_queue,COUNT(*) FROM jobs GROUP BY job_type,in_queue''')
+        
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS jobs_count_insert
+            AFTER INSERT ON jobs BEGIN
+                INSERT OR IGNORE INTO job_counts (job_type,in_queue)
+                    VALUES (new.job_type,new.in_queue);
+                UPDATE job_counts SET cnt=cnt+1
+                    WHERE job_type=new.job_type AND in_queue=new.in_queue;
+            END''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS jobs_count_delete
+            AFTER DELETE ON jobs BEGIN
+                UPDATE job_counts SET cnt=cnt-1
+                    WHERE job_type=old.job_type AND in_queue=old.in_queue;
+            END''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS jobs_count_update
+            AFTER UPDATE OF job_type,in_queue ON jobs
+            WHEN old.job_type IS NOT new.job_type OR old.in_queue IS NOT new.in_queue
+            BEGIN
+                UPDATE job_counts SET cnt=cnt-1
+                    WHERE job_type=old.job_type AND in_queue=old.in_queue;
+                INSERT OR IGNORE INTO job_counts (job_type,in_queue)
+                    VALUES (new.job_type,new.in_queue);
+                UPDATE job_counts SET cnt=cnt+1
+                    WHERE job_type=new.job_type AND in_queue=new.in_queue;
+            END''')
+    
+    def _create_meta(self,conn):
+        """creates the meta table (key: value) if it doesn't exist and loads
+        the run.  An older db's jobs are all from run 1 (in_queue 0 or 1)."""
+        conn.execute('''CREATE TABLE IF NOT EXISTS meta(
+                key TEXT PRIMARY KEY,
+                value)''')
+        conn.execute("INSERT OR IGNORE INTO meta (key,value) VALUES ('run',1)")
+        self._run = conn.execute("SELECT value FROM meta WHERE key='run'").fetchone()[0]
+    
+    def _next_run(self,conn):
+        """starts a new run: everything queued before is waiting again."""
+        self._on_rollback(setattr,self,'_run',self._run)
+        conn.execute("UPDATE meta SET value=value+1 WHERE key='run'")
+        self._run = conn.execute("SELECT value FROM meta WHERE key='run'").fetchone()[0]
+        # the triggers leave a row per job_type and run - drop the empty ones
+        conn.execute('DELETE FROM job_counts WHERE cnt=0')
+        self.logger.debug('run %s started',self._run)
+    
+    def _create_history(self,conn):
+        """creates jobs_history (archived jobs) if it doesn't exist."""
+        conn.execute('''CREATE TABLE IF NOT EXISTS jobs_history(
+                id INTEGER PRIMARY KEY,
+                job_type TEXT NOT NULL,
+                item_id TEXT NOT NULL,
+                init_data INTEGER,
+                start_value TEXT,
+                end_value TEXT,
+                completed REAL NOT NULL,
+                duration REAL,
+                rows INTEGER)''')
+        # retention deletes the oldest
+        conn.execute('''CREATE INDEX IF NOT EXISTS jobs_history_completed_idx
+            ON jobs_history (completed)''')
+    
+    def _create_dead(self,conn):
+        """creates jobs_dead (jobs out of attempts) if it doesn't exist."""
+        conn.execute('''CREATE TABLE IF NOT EXISTS jobs_dead(
+                id INTEGER PRIMARY KEY,
+                item_id TEXT NOT NULL,
+                job_type TEXT NOT NULL,
+                init_data INTEGER,
+                start_value TEXT,
+                end_value TEXT,
+                priority INTEGER DEFAULT 0,
+                attempts INTEGER,
+                failed REAL NOT NULL)''')
+    
+    def _create_deps(self,conn):
+        """creates job_deps (parent,child edges) if it doesn't exist.  Keyed
+        by parent (releasing children) with an index by child (has it any
+        parents left?), so both stay cheap with millions of edges."""
+        conn.execute('''CREATE TABLE IF NOT EXISTS job_deps(
+                parent_id INTEGER NOT NULL,
+                child_id INTEGER NOT NULL,
+                PRIMARY KEY (parent_id,child_id)) WITHOUT ROWID''')
+        conn.execute('''CREATE INDEX IF NOT EXISTS job_deps_child_idx
+            ON job_deps (child_id)''')
+        self._deps = conn.execute('SELECT 1 FROM job_deps LIMIT 1').fetchone() is not None
+    
+    def _upgrade_db_structure(self):
+        """adds the columns and indexes an older db is missing. Called when an
+        existing db is opened. Returns False if it failed."""
+        try:
+            with self._lock,self._db as conn:
+                cols = set(i[1] for i in conn.execute('PRAGMA table_info(jobs)'))
+                for name,definition in self._JOBS_ADDED_COLUMNS:
+                    if name not in cols:
+                        self.logger.info('upgrading db: adding jobs.%s',name)
+                        conn.execute('ALTER TABLE jobs ADD COLUMN {} {}'.format(
+                                                            name,definition))
+                self._create_indexes(conn)
+                self._create_job_counts(conn)
+                self._create_meta(conn)
+                self._create_dead(conn)
+                self._create_deps(conn)
+                if self._archive: self._create_history(conn)
+        except sql.Error as e:
+            self.logger.critical('upgrading db failed. %s: %r',e.__class__.__name__,e)
+            return False
+        return True
+    
+    def _set_incremental_vacuum(self):
+        """(archive) switches an existing db to auto_vacuum=INCREMENTAL so
+        compact() can give back free pages.  A db with tables only switches
+        with a VACUUM (done once - it rewrites the file)."""
+        with self._lock:
+            try:
+                if self._db.execute('PRAGMA auto_vacuum').fetchone()[0] == 2: return
+                self.logger.info('switching to incremental auto_vacuum (one-time VACUUM)')
+                self._db.execute('PRAGMA auto_vacuum=INCREMENTAL')
+                self._db.execute('VACUUM')
+            except sql.Error as e:
+                self.logger.warning('switching to incremental auto_vacuum failed! %r',e)
+    
     #===========================================================================
     #============================= 'Queue' Things ==============================
     #===========================================================================
@@ -292,50 +924,76 @@ class MyDb(MyLoggingBase):
             idsAddedRemoved = self._put_many_in_queue(job_type, items,**keys)
         return idsAddedRemoved
     
+    def _get_condition(self,job_type):
+        """returns the condition to wait on for job_type jobs (creates it if
+        needed - see _job_condition). Assumes you have the queue lock."""
+        return _job_condition(self._conditions,self._queue_lock,job_type)
+    
+    def wait_for_jobs(self,job_type,until=None,timeout=None):
+        """waits till job_type jobs are added, wake_up(...) is called or
+        timeout (seconds) has passed.  Doesn't wait if there are jobs in the
+        queue (or maybe in the db) already.  until is an optional function,
+        called with the queue lock held, that returns True to not wait - use it
+        to check your stop flags so a wake_up(...) can't be missed.
+        job_type can be a tuple of job_types - waits till any of them have
+        jobs (wake_up(...) it with the same tuple).
+        Returns True if there are job_type jobs in the queue.
+        If archiving, it's a good time to compact() (if it's been a while)."""
+        if self._archive and time.time()-self._last_compact > self._compact_interval:
+            self._last_compact = time.time()
+            self.compact()
+        
+        with self._queue_lock:
+            # leasing: other processes add jobs too - look again every so often
+            if self._lease_time is not None:
+                if not (until is not None and until()):
+                    self._get_condition(job_type).wait(self._lease_poll if timeout
+                                is None else min(timeout,self._lease_poll))
+                return True # maybe...
+            
+            job_types = job_type if isinstance(job_type,tuple) else (job_type,)
+            if not (any(self._queues.get(t) or self._refill.get(t,True)
+                        for t in job_types) or (until is not None and until())):
+                self._get_condition(job_type).wait(timeout)
+            has_jobs = any(self._queues.get(t) for t in job_types)
+        return has_jobs
+    
+    def get_queue_size(self,job_type):
+        """returns the number of job_type jobs in the queue (there may be
+        more in the db), or None if leasing (there's no queue)."""
+        if self._lease_time is not None: return None
+        return len(self._queues.get(job_type) or ())
+    
+    def wake_up(self,job_type=None):
+        """wakes up everything waiting on job_type (all job_types if None, or
+        a tuple of job_types to wake what's waiting on all of them)."""
+        with self._queue_lock:
+            if job_type is None:
+                for c in self._conditions.itervalues(): c.notify_all()
+            else: self._get_condition(job_type).notify_all()
+        self.event.set()
+    
     def _put_many_in_queue(self,job_type,items,**keys):
-        """ items is iterable. returns ids not added / removed from the queue """
+        """ items is iterable of job tuples (with an optional priority at the
+        end). returns ids added / not added or removed from the queue.
+        Wakes up as many job_type waiters as jobs added."""
         if job_type in self._queues:
             q = self._queues[job_type]
         else:
-            q = self._queues[job_type] = deque(maxlen=self.queue_max)
+            q = self._queues[job_type] = _JobQueue(self.queue_max,self.queue_type)
         
-        idsAdded = dict()
-        idsRemoved = tuple() # ids not in the queue
-        items = (i for i in items) # make generator
-        # if there's a limit
-        if q.maxlen:
-            
-            if self.queue_type == QUEUE_FIFO:
-                # if FIFO stop appending till full
-                #q.extend(items.next() for i in xrange(q.maxlen-len(q)))
-                try:
-                    for i in xrange(q.maxlen-len(q)):
-                        q.append(items.next())
-                        idsAdded[q[-1][0]] = None # job id
-                except StopIteration: pass
-                else:
-                    # we still might have some records
-                    idsRemoved = tuple(i[0] for i in items)
-            else:
-                # if LIFO, remove needed from queue
-                d = dict()
-                for item in items:
-                    if q.maxlen == len(q): d[q.pop()[0]] = None
-                    q.appendleft(item)
-                
-                idsRemoved = tuple(d.keys())
-                
-        # if queue is limitless, append everything!
-        else:
-            for i in items:
-                q.append(i)
-                idsAdded[i[0]] = None # job id
+        # if there's a limit, the lowest priority jobs are dropped
+        idsAdded,idsRemoved = q.push_many(items)
         
-        # wake up threads or let them sleep
+        # more in the db than fits? then it's worth populating again
+        if idsRemoved or (q.maxlen and len(q)==q.maxlen):
+            self._refill[job_type] = True
+        
+        # wake up only as many threads as there are new jobs
+        if idsAdded: self._get_condition(job_type).notify(len(idsAdded))
         if q: self.event.set()
-        #else: self.event.clear()
         
-        return tuple(idsAdded.keys()),idsRemoved
+        return idsAdded,idsRemoved
     
     def get_next_job(self,job_type):
         return self.get_next_jobs(job_type,count=1)[0]
@@ -345,12 +1003,22 @@ class MyDb(MyLoggingBase):
         another thread yet.  Returns the standard job tuple.  Raises
         StopIteration if:
             1. the queue was never created (no job_type added)
-            2. wait is false and the queue is empty
+            2. the queue is empty and populating it didn't add anything
+        Use wait_for_jobs(job_type) to wait for more jobs.
         Params:
             job_type: the type of the job
         NOTES:
             queues are thread-safe, so this method is too!
+            if leasing (lease_time), the jobs are claimed from the db.
         """
+        if self._lease_time is not None:
+            items = self.claim_jobs(job_type,count)
+            if self._archive and items:
+                now = time.time()
+                for i in items: self._started[i[0]] = now
+            if items or count <= 0: return items
+            else: raise StopIteration
+        
         # try to get the next item
         items = list()
         cont = True
@@ -358,33 +1026,194 @@ class MyDb(MyLoggingBase):
         self._queue_lock.acquire()
         
         while cont and count > 0:
-            try: item = self._queues[job_type].popleft()
+            try: item = self._queues[job_type].pop()
             except (KeyError,IndexError), e:
-                if self.event.is_set():
-                    self.event.clear() # no data in queue
+                self.event.clear() # no data in queue
+                # only worth populating once, unless more might be in the db
+                # (or the refill thread is part way through)
+                if self._refill.get(job_type,True) or job_type in self._refilling:
+                    self._refill[job_type] = False
+                    self._stall_count += 1
                     # log something
                     self.logger.warning('no "%s" jobs in queue yet...'
                                         if type(e) == IndexError else
                                         '"%s" queue not initialized...',job_type)
                     
                     self._queue_lock.release()
-                    if not self.populate_queues(job_type):
-                        # if returns false -> no more jobs
-                        cont = False
-                    
+                    populated = self.populate_queues(job_type)
                     self._queue_lock.acquire()
                     
+                    # if returns false -> no more jobs (unless the refill
+                    # thread got them first)
+                    if not (populated or self._queues.get(job_type)): cont = False
+                    
                 else: cont = False # stop
             else:
                 
                 items.append(item) # fastest item - dict
                 count -= 1 # we got one - keep going
         
+        if self._low_watermark is not None and items:
+            self._check_watermark(job_type)
         self._queue_lock.release()
+        
+        # for the history's duration
+        if self._archive and items:
+            now = time.time()
+            for i in items: self._started[i[0]] = now
          
         if cont or items: return items
         else: raise StopIteration
     
+    #===========================================================================
+    # Background Refill
+    #===========================================================================
+    def _check_watermark(self,job_type):
+        """asks the refill thread to top up job_type's queue if it's below the
+        low watermark (and there might be more in the db). Assumes you have
+        the queue lock."""
+        q = self._queues.get(job_type)
+        if (q is None or len(q) < self._low_watermark) and \
+                self._refill.get(job_type,True) and job_type not in self._refill_wanted:
+            self._refill_wanted[job_type] = time.time()
+            if self._refiller is None:
+                self._refiller = threading.Thread(target=self._refill_loop,
+                                                  name='MyDbRefiller')
+                self._refiller.daemon = True
+                self._refiller.start()
+            self._refill_event.set()
+    
+    def _refill_loop(self):
+        """(refill thread) populates the queues asked for by _check_watermark."""
+        while not self._refiller_stop:
+            self._refill_event.wait()
+            self._refill_event.clear()
+            if self._refiller_stop: break
+            
+            with self._queue_lock:
+                wanted,self._refill_wanted = self._refill_wanted,{}
+                # same as get_next_jobs: populate again only if it fills up
+                for job_type in wanted: self._refill[job_type] = False
+                self._refilling.update(wanted)
+            
+            for job_type,t in wanted.iteritems():
+                try:
+                    if self.is_open(): self.populate_queues(job_type)
+                finally:
+                    with self._queue_lock: self._refilling.discard(job_type)
+                latency = time.time()-t
+                self._refill_count += 1
+                self._refill_latency += latency
+                self._refill_latency_max = max(self._refill_latency_max,latency)
+    
+    def _stop_refiller(self):
+        """stops the refill thread (if there is one)."""
+        with self._queue_lock:
+            refiller,self._refiller = self._refiller,None
+        if refiller is not None:
+            self._refiller_stop = True
+            self._refill_event.set()
+            refiller.join()
+            self._refiller_stop = False
+    
+    #===========================================================================
+    # Timers (parked jobs)
+    #===========================================================================
+    def _add_timer(self,run_at,job_type=None):
+        """makes sure the timer thread wakes at run_at (for job_type, None if
+        not known).  Assumes you have the queue lock."""
+        heapq.heappush(self._timers,(run_at,job_type))
+        if self._timer_thread is None:
+            self._timer_thread = threading.Thread(target=self._timer_loop,
+                                                  name='MyDbTimer')
+            self._timer_thread.daemon = True
+            self._timer_thread.start()
+        elif self._timers[0][0] == run_at: self._timer_cond.notify() # sooner
+    
+    def _load_timers(self):
+        """adds a timer for the first parked job in the db (if any)."""
+        try:
+            with self._lock:
+                run_at = self._db.execute('''SELECT MIN(run_at) FROM jobs
+                    WHERE in_queue=-1''').fetchone()[0]
+        except sql.Error as e:
+            self.logger.warning('loading timers failed! %r',e)
+        else:
+            if run_at is not None: self._set_timer(run_at)
+    
+    def _set_timer(self,run_at):
+        """takes the queue lock and adds a timer for run_at."""
+        with self._queue_lock: self._add_timer(run_at)
+    
+    def _timer_loop(self):
+        """(timer thread) sleeps till the next parked job is due, then
+        releases the due jobs."""
+        with self._queue_lock:
+            while not self._timer_stop:
+                if not self._timers:
+                    self._timer_cond.wait()
+                    continue
+                wait = self._timers[0][0]-time.time()
+                if wait > 0:
+                    self._timer_cond.wait(wait)
+                    continue
+                
+                now = time.time()
+                while self._timers and self._timers[0][0] <= now:
+                    heapq.heappop(self._timers)
+                self._queue_lock.release()
+                try: self._release_due()
+                finally: self._queue_lock.acquire()
+    
+    def _release_due(self):
+        """moves the due parked jobs to waiting and wakes (populates) their
+        job_types.  Returns the job_types released."""
+        now = time.time()
+        try:
+            with self._writing() as conn:
+                rows = conn.execute('''SELECT id,job_type,run_at FROM jobs
+                    WHERE in_queue=-1 AND run_at<=?''',(now,)).fetchall()
+                conn.executemany('UPDATE jobs SET in_queue=0 WHERE id=?',
+                                 ((i[0],) for i in rows))
+                # parked without a timer (failed_job backs off) wait for this one
+                run_at = conn.execute('''SELECT MIN(run_at) FROM jobs
+                    WHERE in_queue=-1''').fetchone()[0]
+                if run_at is not None: self._after_commit(self._set_timer,run_at)
+        except sql.Error as e:
+            self.logger.warning('releasing parked jobs failed! %r',e)
+            return ()
+        
+        if rows:
+            self._jobs_released_count += len(rows)
+            delays = [now-i[2] for i in rows]
+            self._dispatch_delay += sum(delays)
+            self._dispatch_delay_max = max(self._dispatch_delay_max,max(delays))
+        
+        job_types = set(i[1] for i in rows)
+        self._wake_waiting(job_types)
+        return job_types
+    
+    def _wake_waiting(self,job_types):
+        """job_types have jobs waiting again: populates their queues (if
+        leasing, wakes their waiters to claim them)."""
+        for job_type in job_types:
+            if self._lease_time is not None:
+                with self._queue_lock: self._get_condition(job_type).notify_all()
+            else:
+                self._clear_refill() # the queue may be full - let it populate again
+                self.populate_queues(job_type)
+    
+    def _stop_timer(self):
+        """stops the timer thread (if there is one)."""
+        with self._queue_lock:
+            timer,self._timer_thread = self._timer_thread,None
+            if timer is not None:
+                self._timer_stop = True
+                self._timer_cond.notify_all()
+        if timer is not None:
+            timer.join()
+            self._timer_stop = False
+    
     #===========================================================================
     # Populate Queues
     #===========================================================================
@@ -396,34 +1225,42 @@ class MyDb(MyLoggingBase):
         success = True
         
         try:
-            with self._lock,self._db as conn:
-                # clear "in_queue" flag if first run
-                if first_call: conn.execute('UPDATE jobs SET in_queue=0')
+            with self._writing() as conn:
+                # write pending checkpoints (failed jobs need to be out of queue)
+                self._flush_updates(conn)
                 
-                # get how many we're able to add
-                out_queue,total = conn.execute("""SELECT
-                    ifnull(-1*SUM(in_queue-1),0) "not_in_queue",
-                    COUNT(in_queue) "total" FROM jobs""").fetchone()
+                # a new run - what earlier runs queued is waiting again
+                if first_call:
+                    self._next_run(conn)
+                    self._after_commit(self._clear_refill)
                 
-                self.logger.debug('not in_queue=%s / total=%s',out_queue,total)
+                # what's waiting per job_type: {job_type: {in_queue: cnt}}
+                out_queue = {}
+                for jt,in_queue,cnt in conn.execute('''SELECT job_type,in_queue,cnt
+                        FROM job_counts WHERE in_queue>=0 AND in_queue<? AND cnt>0''',
+                        (self._run,)):
+                    out_queue.setdefault(jt,{})[in_queue] = cnt
+                
+                self.logger.debug('not in_queue=%s',sum(sum(i.itervalues())
+                                                    for i in out_queue.itervalues()))
                 
                 # are there items not in queues?
-                if out_queue==0:
+                if not out_queue:
                     # there are no jobs to add...
                     success = False
                     raise RuntimeError('stopped b/c no data to get')
                 
                 # get all job types (or use the one given)
-                job_types = tuple(i[0] for i in conn.execute(
-                        'SELECT distinct job_type FROM jobs')) \
+                job_types = tuple(out_queue) \
                     if job_type is None else ((job_type,) \
                     if job_types is None else job_types)
                 
-                # if there's no jobs, we failed to populate the queues
-                if not job_types: success = False
-                
                 for job_type in job_types:
                     with self._queue_lock:
+                        # nothing in the db for this job_type
+                        if not out_queue.get(job_type):
+                            if not self._queues.get(job_type): success = False
+                            continue
                     
                         # find how many records the queue needs
                         if self.queue_max: # if there's a limit for queues,
@@ -437,13 +1274,8 @@ class MyDb(MyLoggingBase):
                         else: limit = -1
                         
                         # insert into queues
-                        added,removed = self._put_many_in_queue(job_type,conn.execute(
-                            """ SELECT * FROM (
-                                SELECT id,item_id,init_data,start_value,end_value
-                                FROM jobs WHERE in_queue=0 AND job_type=? """+
-                                'ORDER BY id '+
-                                ('' if self.queue_type==QUEUE_FIFO else 'DESC ')+
-                                'LIMIT ?) a ORDER BY id ASC',(job_type,limit)))
+                        added,removed = self._put_many_in_queue(job_type,
+                                self._get_waiting(conn,job_type,out_queue[job_type],limit))
                         
                         if removed:
                             self.logger.warning(
@@ -451,9 +1283,11 @@ class MyDb(MyLoggingBase):
                         
                         # update db
                         def g(idsIn,idsOut):
-                            for i in idsIn: yield (1,i)
+                            for i in idsIn: yield (self._run,i)
                             for i in idsOut: yield (0,i)     
                         conn.executemany('UPDATE jobs SET in_queue=? WHERE id=?',g(added,removed))
+                        # they're in the queue now - even if the transaction isn't kept
+                        if added: self._on_rollback(self._mark_in_queue,added)
                         
                         # is there anything?
                         if len(self._queues[job_type]) == 0: success = False
@@ -467,6 +1301,25 @@ class MyDb(MyLoggingBase):
             raise e
             
         return success
+    
+    def _get_waiting(self,conn,job_type,in_queues,limit):
+        """returns up to limit (-1 for all) waiting job_type jobs, in queue
+        order.  One query per in_queue value (run) they're waiting with, so
+        each is highest priority first off jobs_refill_idx - no sorting."""
+        query = '''SELECT id,item_id,init_data,start_value,end_value,priority
+            FROM jobs WHERE job_type=? AND in_queue=?
+            ORDER BY priority DESC,id {}LIMIT ?'''.format(
+                                '' if self.queue_type==QUEUE_FIFO else 'DESC ')
+        if len(in_queues) == 1:
+            return conn.execute(query,(job_type,next(iter(in_queues)),limit))
+        
+        rows = []
+        for in_queue in in_queues:
+            rows.extend(conn.execute(query,(job_type,in_queue,limit)))
+        sign = 1 if self.queue_type==QUEUE_FIFO else -1
+        rows.sort(key=lambda r: (-(r[5] or 0),sign*r[0]))
+        return rows if limit < 0 else rows[:limit]
+    
     #'''
     #===========================================================================
     #=============================== JOB THINGS ================================
@@ -474,92 +1327,197 @@ class MyDb(MyLoggingBase):
     #===========================================================================
     # Add Job
     #===========================================================================
-    def add_job(self,item_id,job_type,init_data=None):#,start_value=None,end_value=None):
-        """Adds job and returns job_id.  Returns None if failed to add!"""
-        job_ids = self.add_jobs(((item_id,job_type,init_data),))
+    def add_job(self,item_id,job_type,init_data=None,priority=0,run_at=None,
+                after=None):#,start_value=None,end_value=None):
+        """Adds job and returns job_id.  Returns None if failed to add!
+        Higher priority jobs are handed out first.  If run_at (a time.time())
+        is passed, the job isn't handed out before then.  If after (job_ids)
+        is passed, not till those jobs are done."""
+        job_ids = self.add_jobs(((item_id,job_type,init_data,priority,run_at,after),))
         return job_ids[0] if job_ids else False
     
     def add_jobs(self,items):
-        """The non thread-safe way of adding a job... used internally."""
-        job_ids = {}
+        """Adds many jobs at once and returns the list of new job_ids.
+        items is an iterable of (item_id,job_type[,init_data[,priority
+        [,run_at[,after]]]]) tuples (priority defaults to 0 - higher is handed
+        out first).  Jobs with a run_at (time.time()) in the future are parked
+        till then.  Jobs with after (parent job_ids) are blocked till all of
+        those are removed (done) - parents already done are ignored.
+        The batch is staged in a temp table and checked against the jobs
+        table in one statement.  A job isn't added if the same
+        item_id,job_type is already waiting (not started) or if its
+        init_data isn't newer than what's already there."""
+        job_ids = []
         attempt_cnt = 0
-        with self._lock,self._db as conn:
-            
-            '''
-            t = conn.total_changes
-            conn.executemany("""INSERT OR IGNORE INTO jobs (item_id,job_type,init_data)
-                VALUES (:iId,:jType,:data)""",
-                (dict(iId=i[0],jType=i[1],data=i[2]) for i in items))
-            if conn.total_changes != t:
-                self.populate_queues()
-            '''
-            try_to_add_again = dict()
-            for item in items:
-                attempt_cnt += 1
-                item_id = item[0]
-                job_type = item[1]
-                init_data = item[2] if len(item)>2 else None
+        after = {} # seq: parent job_ids
+        q = 0 if self._lease_time is not None else self._run
+        try:
+            with self._writing() as conn:
                 try:
-                    #------ see if the jobs already there ------
-                    add_to_db = True
-                    max_init_data = None
-                    for row in conn.execute('''SELECT init_data,start_value
-                            FROM jobs WHERE item_id=? AND job_type=?''',(item_id,job_type)):
-                        # keep track of max init_data. if >= init_data ==> no need to add
-                        max_init_data = max(max_init_data,row[0])
-                        # job hasn't started so no need to add
-                        if row[1] is None:
-                            # this means there is a similar job but it hasn't been started,
-                            # so there's no need to add one
-                            add_to_db = False
-                            # if init_data isn't used, there's no reason to add a new one
-                            break
-                            #if init_data is None: break
-                            #else: pass # keep tracking jobs init_data to see if necessary to add
+                    attempt_cnt = self._stage_jobs(conn,items,after)
                     
-                    #------ to insert or not to insert? ------
-                    if add_to_db:
-                        if init_data==None or init_data > max_init_data:
-                            #insert job into db
-                            job_id = conn.execute('INSERT INTO jobs (item_id,job_type,init_data) values (?,?,?)',
-                                         (item_id,job_type,init_data)).lastrowid
-                            job_ids[job_id] = None # track the jobs we've added
-                            self._jobs_added_count += 1
-                                  
-                            # no FIFO if don't add asap...     
-                            # REMOVED: will let waiting threads populate in batch  
-                            # add job to queue (will also wake up any waiting threads)
-                            added,removed = self.put_in_queue(job_type,(job_id,item_id,init_data,None,None)) # @UnusedVariable
-                            # update the db to sync with what's in use / in the queue.
-                            if removed: conn.execute('UPDATE jobs SET in_queue=0 WHERE id=?',removed) # only 1 at most
-                            #conn.executemany('UPDATE jobs SET in_queue=0 WHERE id=?',((i,) for i in removed))
-                            
-                        else: self.logger.debug('no need to add %s. init_data is less',item_id) 
-                    else:
-                        try_to_add_again[item_id] = None
+                    # new ids are always greater (AUTOINCREMENT never reuses ids)
+                    last_id = conn.execute('SELECT ifnull(MAX(id),0) FROM jobs').fetchone()[0]
                     
-                except sql.Error, e: self.logger.warning('added job %s failed! %r',item,e)
-            
-            if try_to_add_again:
-                self.logger.warning("tried to add %d jobs again, but original "+
-                                    "hasn't started yet!",len(try_to_add_again))
+                    #------ insert the first valid job for each item_id,job_type ------
+                    conn.execute('''INSERT INTO jobs (item_id,job_type,init_data,priority,
+                            run_at,in_queue)
+                        SELECT item_id,job_type,init_data,priority,ifnull(run_at,0),
+                            CASE WHEN blocked THEN -2 WHEN run_at>:now THEN -1
+                            ELSE :q END FROM jobs_stage
+                        WHERE seq IN (
+                            SELECT MIN(s.seq) FROM jobs_stage s
+                            WHERE NOT EXISTS (SELECT 1 FROM jobs j
+                                    WHERE j.item_id=s.item_id AND j.job_type=s.job_type
+                                    AND j.start_value IS NULL)
+                                AND (s.init_data IS NULL OR NOT EXISTS (SELECT 1 FROM jobs j
+                                    WHERE j.item_id=s.item_id AND j.job_type=s.job_type
+                                    AND j.init_data>=s.init_data))
+                            GROUP BY s.item_id,s.job_type)
+                        ORDER BY seq''',dict(now=time.time(),q=q))
+                    if after: self._add_deps(conn,last_id,after,q)
+                finally:
+                    # (even if it failed - in a transaction it isn't rolled back)
+                    conn.execute('DELETE FROM jobs_stage')
+                
+                #------ put the new jobs in their queues (or timers) ------
+                queues = dict()
+                parked = []
+                for row in conn.execute('''SELECT id,item_id,init_data,start_value,
+                        end_value,priority,job_type,in_queue,run_at FROM jobs
+                        WHERE id>? ORDER BY id''',(last_id,)):
+                    job_ids.append(row[0])
+                    if row[7] == self._BLOCKED: continue
+                    if row[7] == self._PARKED: parked.append((row[8],row[6]))
+                    else:
+                        try: queues[row[6]].append(row[:6])
+                        except KeyError: queues[row[6]] = [row[:6]]
+                
+                if self._in_transaction():
+                    self._after_commit(self._queue_new_jobs,queues,None,parked)
+                else: self._queue_new_jobs(queues,conn,parked)
+                self._jobs_added_count += len(job_ids)
                 
+        except sql.Error as e:
+            self.logger.warning('adding jobs failed! %r',e)
+            return []
+        
+        if attempt_cnt != len(job_ids):
+            self.logger.debug('%d jobs not added - already waiting or init_data is less',
+                              attempt_cnt-len(job_ids))
         self.logger.debug('%d / %d jobs added',len(job_ids),attempt_cnt)
-        return job_ids.keys()
+        return job_ids
+    
+    def _queue_new_jobs(self,queues,conn=None,parked=()):
+        """puts the new jobs ({job_type: rows}) in their queues and marks the
+        ones that didn't fit as not in_queue (with conn, or its own write).
+        parked is [(run_at,job_type)] of the new parked jobs for the timers."""
+        removed = []
+        with self._queue_lock:
+            for run_at,job_type in parked: self._add_timer(run_at,job_type)
+            for job_type,rows in queues.iteritems():
+                # leasing: they're claimed from the db, just wake waiters
+                if self._lease_time is not None:
+                    self._get_condition(job_type).notify(len(rows))
+                else:
+                    removed.extend(self._put_many_in_queue(job_type,rows)[1])
+        
+        # update the db to sync with what's in use / in the queue.
+        if removed:
+            if conn is None: self._mark_in_queue(removed,0)
+            else: conn.executemany('UPDATE jobs SET in_queue=0 WHERE id=?',
+                                   ((i,) for i in removed))
+    
+    def _stage_jobs(self,conn,items,after):
+        """loads the items into the (temp) staging table and returns how many
+        there are.  The parents of items with after are put in after
+        ({seq: parent job_ids}).  Assumes you have the lock - and that the
+        table's there (see _create_stage)."""
+        def rows():
+            for seq,i in enumerate(items,1):
+                if len(i)>5 and i[5]: after[seq] = tuple(i[5])
+                yield (seq,i[0],i[1],i[2] if len(i)>2 else None,
+                       (i[3] or 0) if len(i)>3 else 0,i[4] if len(i)>4 else None,
+                       seq in after)
+        return conn.executemany('''INSERT INTO jobs_stage (seq,item_id,job_type,
+                init_data,priority,run_at,blocked) VALUES (?,?,?,?,?,?,?)''',
+                                rows()).rowcount
+    
+    #===========================================================================
+    # Dependencies (job_deps)
+    #===========================================================================
+    def _add_deps(self,conn,last_id,after,q):
+        """adds the edges of the new (id > last_id) blocked jobs from
+        after ({seq: parent job_ids}) - only to parents still in jobs - and
+        releases the ones left without any (to in_queue q).  Assumes you're
+        writing and jobs_stage still has the batch."""
+        # the row a job came from is the first staged with its values
+        edges = [(p,job_id) for job_id,seq in conn.execute('''SELECT j.id,MIN(s.seq)
+                FROM jobs j JOIN jobs_stage s ON s.item_id=j.item_id AND
+                    s.job_type=j.job_type AND s.init_data IS j.init_data
+                WHERE j.id>? AND j.in_queue=-2 GROUP BY j.id''',(last_id,)).fetchall()
+                 for p in after.get(seq,())]
+        conn.executemany('''INSERT OR IGNORE INTO job_deps (parent_id,child_id)
+            SELECT ?,? WHERE EXISTS (SELECT 1 FROM jobs WHERE id=?)''',
+                         ((p,c,p) for p,c in edges))
+        self._deps = True
+        self._unblock(conn,set(c for _,c in edges),q)
+    
+    def _release_children(self,conn,job_ids):
+        """deletes the edges from the (removed) jobs and releases their
+        children that have no parents left.  Assumes you're writing.
+        Returns what _unblock(...) does."""
+        children,parents = set(),[]
+        for job_id in job_ids:
+            c = conn.execute('SELECT child_id FROM job_deps WHERE parent_id=?',
+                             (job_id,)).fetchall()
+            if c:
+                children.update(i[0] for i in c)
+                parents.append((job_id,))
+        if not parents: return []
+        conn.executemany('DELETE FROM job_deps WHERE parent_id=?',parents)
+        return self._unblock(conn,children)
+    
+    def _unblock(self,conn,job_ids,q=0):
+        """moves the blocked jobs (of job_ids) with no parents left to
+        in_queue q (waiting), or parked if their run_at is still to come.
+        Assumes you're writing.  Returns their [(id,job_type,in_queue,run_at)]."""
+        now = time.time()
+        rows = []
+        for job_id in job_ids:
+            r = conn.execute('''SELECT job_type,run_at FROM jobs WHERE id=? AND
+                in_queue=-2 AND NOT EXISTS (SELECT 1 FROM job_deps WHERE child_id=?)''',
+                             (job_id,job_id)).fetchone()
+            if r: rows.append((job_id,r[0],self._PARKED if r[1]>now else q,r[1]))
+        conn.executemany('UPDATE jobs SET in_queue=? WHERE id=?',
+                         ((i[2],i[0]) for i in rows))
+        self._jobs_unblocked_count += len(rows)
+        return rows
+    
+    def _wake_released(self,rows):
+        """sets the timers of the parked and wakes the waiters of the waiting
+        released jobs ([(id,job_type,in_queue,run_at)] from _unblock)."""
+        parked = [i[3] for i in rows if i[2]==self._PARKED]
+        if parked: self._set_timer(min(parked))
+        self._wake_waiting(set(i[1] for i in rows if i[2]!=self._PARKED))
     
     #===========================================================================
     # Update Job 
     #===========================================================================
-    def update_job(self,job_id,start_value,end_value=None):
+    def update_job(self,job_id,start_value,end_value=None,flush=None):
         """updates job with new data, start_value and end_value
-        Returns True for success."""
+        Returns True for success.  If buffering checkpoints (checkpoint_delay),
+        it's written later unless flush is True (True means it was buffered)."""
+        if self._checkpoint_delay is not None:
+            self._jobs_updated_count += 1
+            return self._buffer_update(job_id,start_value,end_value,False,flush)
+        
         success = False
-        with self._lock,self._db as conn:
+        with self._writing() as conn:
             t = self._db.total_changes
             try:
-                conn.execute('''UPDATE jobs SET start_value=?,
-                        end_value=ifnull(?,end_value) 
-                    WHERE id=?''',(start_value,end_value,job_id))
+                conn.execute(self._checkpoint_sql(False),
+                        self._checkpoint_params(job_id,start_value,end_value))
                     
                 self._jobs_updated_count += 1
             except sql.Error as e: self.logger.warning('updating job failed! %r',e)
@@ -570,41 +1528,154 @@ class MyDb(MyLoggingBase):
     #===========================================================================
     # Remove Job
     #===========================================================================
-    def remove_job(self,job_id):
+    def remove_job(self,job_id,rows=None):
         """Removed job from the table.  Assuming b/c the job is done!
         Returns True for success."""
-        return self.remove_jobs((job_id,))
+        return self.remove_jobs((job_id,),None if rows is None else {job_id:rows})
     
-    def remove_jobs(self,job_ids):
-        success = False
-        with self._lock, self._db as conn:
-            t = self._db.total_changes
-            try: conn.executemany('DELETE FROM jobs WHERE id=?',
-                                  ((job_id,) for job_id in job_ids))
-            except sql.Error as e:
-                self.logger.warning('removing jobs failed! %r',e)
-            else:
-                self.logger.debug('%d / %d jobs removed',
-                    self._db.total_changes-t,-1 if 'generator' in 
-                    job_ids.__class__.__name__ else len(job_ids))
-                self._jobs_removed_count += self._db.total_changes-t
-                success = t!=self._db.total_changes # success if changes
+    def remove_jobs(self,job_ids,rows=None):
+        """Removes the jobs (they're done!).  If archiving, they're moved to
+        jobs_history; rows is an optional {job_id: rows processed} for it.
+        Their children with no other parents left are released.  It's all
+        one write - if any of it fails, none of it's kept.
+        Returns True for success."""
+        released = ()
+        job_ids = tuple(job_ids)
+        try:
+            with self._writing() as conn:
+                # no need to write checkpoints for jobs that are done
+                if self._pending: self._after_commit(self._drop_pending,job_ids)
+                if self._archive: self._archive_jobs(conn,job_ids,rows or {})
+                # NOTE: rowcount, total_changes counts the job_counts triggers too
+                removed = conn.executemany('DELETE FROM jobs WHERE id=?',
+                                  ((job_id,) for job_id in job_ids)).rowcount
+                # other processes might've added deps (leasing)
+                if self._deps or self._lease_time is not None:
+                    released = self._release_children(conn,job_ids)
+        except sql.Error as e:
+            self.logger.warning('removing jobs failed! %r',e)
+            return False
+        
+        self.logger.debug('%d / %d jobs removed',removed,len(job_ids))
+        self._jobs_removed_count += removed
+        # committed (unless in a transaction - then after that)
+        if released: self._after_commit(self._wake_released,released)
+        return removed > 0 # success if changes
+        
+    #===========================================================================
+    # Archive (jobs_history)
+    #===========================================================================
+    def _archive_jobs(self,conn,job_ids,rows):
+        """copies the jobs to jobs_history (assumes you're writing)."""
+        now = time.time()
+        started = self._started
+        cnt = conn.executemany('''INSERT OR REPLACE INTO jobs_history (id,job_type,
+                item_id,init_data,start_value,end_value,completed,duration,rows)
+            SELECT id,job_type,item_id,init_data,start_value,end_value,?,?,?
+            FROM jobs WHERE id=?''',((now,now-started.pop(i) if i in started else None,
+                                      rows.get(i),i) for i in job_ids)).rowcount
+        self._jobs_archived_count += cnt
+    
+    def compact(self,pages=None):
+        """applies the history retention (archive_max_age/archive_max_rows)
+        then gives back up to pages (all if None) free pages to the file
+        system with incremental_vacuum.  Returns the number of pages freed,
+        False if it failed (or in a transaction)."""
+        with self._lock:
+            if not self._is_open() or self._in_transaction(): return False
+            conn = self._db
+            try:
+                with conn:
+                    if self._archive:
+                        self._create_history(conn) # it might've been turned on
+                        if self._archive_max_age is not None:
+                            conn.execute('DELETE FROM jobs_history WHERE completed<?',
+                                         (time.time()-self._archive_max_age,))
+                        if self._archive_max_rows is not None:
+                            conn.execute('''DELETE FROM jobs_history WHERE id IN (
+                                SELECT id FROM jobs_history ORDER BY completed DESC,id DESC
+                                LIMIT -1 OFFSET ?)''',(self._archive_max_rows,))
                 
-        return success
+                free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+                if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2: # incremental
+                    conn.execute('PRAGMA incremental_vacuum({})'.format(
+                                    int(pages) if pages else 0)).fetchall()
+                freed = free-conn.execute('PRAGMA freelist_count').fetchone()[0]
+            except sql.Error as e:
+                self.logger.warning('compacting failed! %r',e)
+                return False
+            
+            self._compact_count += 1
+            self._pages_freed_count += freed
+        self.logger.debug('compacted - %d pages freed',freed)
+        return freed
+    
+    def iter_history(self,job_type=None,since=None,page_size=1000):
+        """iterate through the archived jobs (by id) a page at a time, like
+        iter_jobs: (id,job_type,item_id,init_data,start_value,end_value,
+        completed,duration,rows).  since is the time (time.time()) to get
+        jobs completed after."""
+        if not self._is_open(): return
+        where,params = ['id>?'],[]
+        if job_type is not None:
+            where.append('job_type=?'); params.append(job_type)
+        if since is not None:
+            where.append('completed>?'); params.append(since)
+        query = 'SELECT * FROM jobs_history WHERE {} ORDER BY id LIMIT ?'.format(
+                                                            ' AND '.join(where))
         
+        last_id = -1
+        while True:
+            with self._reading() as conn:
+                if not self._is_open(): return
+                try: rows = conn.execute(query,[last_id]+params+[page_size]).fetchall()
+                except sql.Error as e:
+                    self.logger.warning('failed!?!? %r',e)
+                    return
+            
+            for i in rows: yield i
+            if len(rows) < page_size: return
+            last_id = rows[-1][0]
+    
+    def export_history(self,filename,**keys):
+        """writes the archived jobs to a csv file (streamed - see iter_history
+        for keys).  Returns the number of jobs written."""
+        cnt = 0
+        with open(filename,'wb') as f:
+            w = csv.writer(f)
+            w.writerow(('id','job_type','item_id','init_data','start_value',
+                        'end_value','completed','duration','rows'))
+            for i in self.iter_history(**keys):
+                w.writerow([v.encode('utf-8') if isinstance(v,unicode) else v for v in i])
+                cnt += 1
+        return cnt
+    
     #===========================================================================
     # Failed Job
     #===========================================================================
-    def failed_job(self,job_id,start_value=None,end_value=None):
-        """Removed job from the table.  Assuming b/c the job is done!
-        Returns True for success."""
+    def retries_failed_jobs(self):
+        """returns True if failed jobs are retried with a limit or a backoff
+        (max_attempts or retry_backoff) - else a job that always fails would
+        be retried as fast as it can fail."""
+        return self._max_attempts is not None or self._retry_backoff is not None
+    
+    def failed_job(self,job_id,start_value=None,end_value=None,flush=None):
+        """Puts the job back in the table (not in a queue) so it can be tried
+        again, saving start_value and end_value if not None - parked for the
+        backoff if retry_backoff, or moved to jobs_dead if it's out of
+        attempts (max_attempts).  Returns True for success.  If buffering checkpoints (checkpoint_delay),
+        it's written later unless flush is True (True means it was buffered)."""
+        self._started.pop(job_id,None) # it'll be started again
+        if self._checkpoint_delay is not None:
+            return self._buffer_update(job_id,start_value,end_value,True,flush)
+        
         success = False
-        with self._lock,self._db as conn:
+        with self._writing() as conn:
             t = self._db.total_changes
-            try: conn.execute('''UPDATE jobs SET in_queue=0,
-                    start_value = ifnull(?,start_value),
-                    end_value = ifnull(?,end_value)
-                WHERE id=?''',(start_value,end_value,job_id))
+            try:
+                conn.execute(self._checkpoint_sql(True),
+                        self._checkpoint_params(job_id,start_value,end_value))
+                self._retry_failed(conn,(job_id,))
             except sql.Error as e:
                 self.logger.warning('failing job failed! %r',e)
             else:
@@ -612,6 +1683,332 @@ class MyDb(MyLoggingBase):
                 
         return success
     
+    def _checkpoint_sql(self,failed):
+        """returns the UPDATE for update_job (failed_job if failed). If leasing,
+        update_job renews the lease and failed_job releases it - only if the
+        lease is still ours."""
+        if failed:
+            sets = '''attempts=attempts+1,start_value=ifnull(:s,start_value),
+                end_value=ifnull(:e,end_value),'''
+            # attempts is the old value here: base, 2*base, 4*base, ...
+            sets += ('in_queue=0' if self._retry_backoff is None else '''in_queue=-1,
+                run_at=:now+min(:base*(1<<min(attempts,32)),:bmax)''')
+            if self._lease_time is not None:
+                sets += ',lease_owner=NULL,lease_expires=0'
+        else:
+            sets = 'start_value=:s,end_value=ifnull(:e,end_value)'
+            if self._lease_time is not None: sets += ',lease_expires=:exp'
+        return 'UPDATE jobs SET {} WHERE id=:id{}'.format(sets,
+                '' if self._lease_time is None else ' AND lease_owner=:owner')
+    
+    def _checkpoint_params(self,job_id,start_value,end_value):
+        """returns the params for _checkpoint_sql(...)"""
+        now = time.time()
+        return dict(id=job_id,s=start_value,e=end_value,owner=self._lease_owner,
+                    exp=None if self._lease_time is None else now+self._lease_time,
+                    now=now,base=self._retry_backoff,bmax=self._retry_backoff_max)
+    
+    def _retry_failed(self,conn,job_ids):
+        """after the failed_job UPDATE (assumes you're writing): moves the
+        jobs out of attempts to jobs_dead and sets a timer for the backed off
+        ones (or wakes what's waiting on them if there's no backoff)."""
+        self._jobs_failed_count += len(job_ids)
+        if self._max_attempts is not None:
+            now = time.time()
+            conn.executemany('''INSERT OR REPLACE INTO jobs_dead (id,item_id,
+                    job_type,init_data,start_value,end_value,priority,attempts,failed)
+                SELECT id,item_id,job_type,init_data,start_value,end_value,
+                    priority,attempts,? FROM jobs WHERE id=? AND attempts>=?''',
+                ((now,i,self._max_attempts) for i in job_ids))
+            dead = conn.executemany('DELETE FROM jobs WHERE id=? AND attempts>=?',
+                ((i,self._max_attempts) for i in job_ids)).rowcount
+            if dead:
+                self.logger.warning('%d jobs out of attempts - moved to jobs_dead',dead)
+                self._jobs_dead_count += dead
+        if self._retry_backoff is not None:
+            run_ats = [r[0] for r in (conn.execute('''SELECT run_at FROM jobs
+                WHERE id=? AND in_queue=-1''',(i,)).fetchone() for i in job_ids) if r]
+            if run_ats: self._after_commit(self._set_timer,min(run_ats))
+        else:
+            # they're waiting again - wake what's waiting on them
+            job_types = set(r[0] for r in (conn.execute('''SELECT job_type FROM jobs
+                WHERE id=? AND in_queue=0''',(i,)).fetchone() for i in job_ids) if r)
+            if job_types: self._after_commit(self._clear_refill,job_types)
+    
+    #===========================================================================
+    # Dead Jobs (jobs_dead)
+    #===========================================================================
+    def get_dead_jobs(self,job_type=None):
+        """returns the jobs that ran out of attempts (see max_attempts):
+        [(id,item_id,job_type,init_data,start_value,end_value,priority,
+        attempts,failed)].  None if something failed..."""
+        if not self._is_open(): return None
+        with self._reading() as conn:
+            try:
+                if job_type is None:
+                    return conn.execute('SELECT * FROM jobs_dead ORDER BY id').fetchall()
+                return conn.execute('SELECT * FROM jobs_dead WHERE job_type=? ORDER BY id',
+                                    (job_type,)).fetchall()
+            except sql.Error as e:
+                self.logger.warning('failed!?!? %r',e)
+                return None
+    
+    def requeue_dead(self,job_ids=None,job_type=None):
+        """moves dead jobs (job_ids, or all of job_type, or all if neither)
+        back to waiting with their attempts reset.  A job whose item_id,
+        job_type,init_data was added again since stays dead (the constraint
+        doesn't catch NULL init_data).  Returns the
+        number requeued."""
+        if job_ids is not None: where,params = 'id=?',[(i,) for i in job_ids]
+        elif job_type is not None: where,params = 'job_type=?',[(job_type,)]
+        else: where,params = '1',[()]
+        
+        with self._writing() as conn:
+            try:
+                job_types = set()
+                for p in params:
+                    job_types.update(i[0] for i in conn.execute(
+                        'SELECT DISTINCT job_type FROM jobs_dead WHERE '+where,p))
+                cnt = conn.executemany('''INSERT OR IGNORE INTO jobs (id,in_queue,
+                        item_id,job_type,init_data,start_value,end_value,priority)
+                    SELECT id,0,item_id,job_type,init_data,start_value,end_value,
+                        priority FROM jobs_dead d WHERE NOT EXISTS (SELECT 1
+                        FROM jobs j WHERE j.item_id=d.item_id AND
+                        j.job_type=d.job_type AND j.init_data IS d.init_data)
+                    AND '''+where,params).rowcount
+                conn.executemany('''DELETE FROM jobs_dead WHERE {} AND
+                    id IN (SELECT id FROM jobs)'''.format(where),params)
+            except sql.Error as e:
+                self.logger.warning('requeueing dead jobs failed! %r',e)
+                return 0
+        # after the with: it's committed (unless in a transaction - then after that)
+        self._after_commit(self._wake_waiting,job_types)
+        self.logger.info('%d dead jobs requeued',cnt)
+        return cnt
+    
+    #===========================================================================
+    # Transactions
+    #===========================================================================
+    @contextmanager
+    def transaction(self):
+        """with db.transaction(): ... groups the writes (add_job(s),
+        update_job, remove_job(s), failed_job, ...) made by this thread in the
+        block into one transaction and holds the lock the whole time (other
+        threads wait).  It commits at the end of the block and rolls back if
+        an exception is raised.  Queue side effects (jobs put in queues, wake
+        ups) are applied after it commits.  Nested calls join the outer one.
+        NOTE: methods that log and return failure (instead of raising) don't
+              roll back - raise if you want to undo the lot."""
+        t = self._txn
+        if getattr(t,'depth',0):
+            t.depth += 1
+            try: yield self
+            finally: t.depth -= 1
+            return
+        
+        with self._lock:
+            conn = self._db
+            # take the db's write lock now (don't fail half way through)
+            conn.execute('BEGIN IMMEDIATE')
+            t.depth,t.after,t.undo = 1,[],[]
+            try:
+                yield self
+                conn.commit()
+            except BaseException:
+                t.depth = 0
+                try: conn.rollback()
+                except sql.Error as e: self.logger.warning('rollback failed! %r',e)
+                for f,args in t.undo: f(*args)
+                raise
+            finally:
+                t.depth = 0
+                after,t.after,t.undo = t.after,None,None
+        
+        # committed - now the queues etc. can know
+        for f,args in after: f(*args)
+    
+    batch = transaction
+    
+    def _in_transaction(self):
+        """True if this thread is in a transaction(...)."""
+        return getattr(self._txn,'depth',0) > 0
+    
+    @contextmanager
+    def _writing(self):
+        """with self._writing() as conn: for writes - takes the lock and
+        commits at the end (rolls back on an exception), unless this thread
+        is in a transaction(...); then it's part of that."""
+        if getattr(self._txn,'depth',0): yield self._db
+        else:
+            with self._lock,self._db as conn: yield conn
+    
+    def _after_commit(self,f,*args):
+        """calls f(*args) now, or after the transaction commits if in one."""
+        if getattr(self._txn,'depth',0): self._txn.after.append((f,args))
+        else: f(*args)
+    
+    def _on_rollback(self,f,*args):
+        """calls f(*args) if the transaction this thread is in rolls back."""
+        if getattr(self._txn,'depth',0): self._txn.undo.append((f,args))
+    
+    def _clear_refill(self,job_types=()):
+        """the next empty queue should populate (something's back in the db) -
+        wakes what's waiting on job_types so they can."""
+        with self._queue_lock:
+            self._refill.clear()
+            for job_type in job_types: self._get_condition(job_type).notify_all()
+    
+    def _mark_in_queue(self,job_ids,in_queue=None):
+        """sets in_queue (default this run) for the jobs in its own write."""
+        if in_queue is None: in_queue = self._run
+        try:
+            with self._writing() as conn:
+                conn.executemany('UPDATE jobs SET in_queue=? WHERE id=?',
+                                 ((in_queue,i) for i in job_ids))
+        except sql.Error as e:
+            self.logger.warning('updating in_queue failed! %r',e)
+    
+    def _drop_pending(self,job_ids):
+        """forgets the buffered checkpoints of the jobs."""
+        with self._pending_lock:
+            for job_id in job_ids: self._pending.pop(job_id,None)
+    
+    def _rebuffer(self,pending):
+        """puts (unwritten) checkpoints back in the buffer - newer ones win."""
+        with self._pending_lock:
+            for k,v in pending.iteritems(): self._pending.setdefault(k,v)
+    
+    #===========================================================================
+    # Claim Jobs (lease)
+    #===========================================================================
+    def claim_jobs(self,job_type,count=1,owner=None,lease_time=None):
+        """claims up to count job_type jobs for owner in one transaction, so
+        no other process sharing the db file gets them till the lease expires
+        (lease_time seconds; update_job renews it).  Jobs with expired leases
+        are claimed first, then the rest by priority.  Returns the list of job
+        tuples (empty if there aren't any or it failed).
+        NOTE: meant for lease mode (MyDb lease_time); in-memory queues don't
+              know about claims."""
+        if owner is None: owner = self._lease_owner
+        if lease_time is None: lease_time = self._lease_time or 60
+        rows = []
+        
+        with self._lock:
+            if not self._is_open(): return rows
+            conn = self._db
+            now = time.time()
+            in_txn = self._in_transaction() # then it's part of that one
+            try:
+                # take the write lock now so other processes wait their turn
+                if not in_txn: conn.execute('BEGIN IMMEDIATE')
+                # parked jobs that are due can be claimed now
+                conn.execute('''UPDATE jobs SET in_queue=0 WHERE in_queue=-1
+                    AND run_at<=? AND job_type=?''',(now,job_type))
+                rows = conn.execute('''SELECT id,item_id,init_data,start_value,end_value
+                    FROM jobs WHERE job_type=? AND lease_expires>0 AND lease_expires<?
+                    ORDER BY lease_expires LIMIT ?''',(job_type,now,count)).fetchall()
+                if rows: self.logger.info('reclaiming %d expired %s jobs',len(rows),job_type)
+                if len(rows) < count:
+                    rows.extend(conn.execute('''SELECT id,item_id,init_data,start_value,
+                        end_value FROM jobs WHERE job_type=? AND lease_expires=0
+                        AND in_queue>=0 ORDER BY priority DESC,id LIMIT ?''',(job_type,count-len(rows))))
+                conn.executemany('UPDATE jobs SET lease_owner=?,lease_expires=? WHERE id=?',
+                                 ((owner,now+lease_time,r[0]) for r in rows))
+                if not in_txn: conn.commit()
+            except sql.Error as e:
+                if not in_txn: conn.rollback()
+                self.logger.warning('claiming jobs failed! %r',e)
+                return []
+            
+            self._jobs_claimed_count += len(rows)
+        return rows
+    
+    #===========================================================================
+    # Checkpoint Buffer
+    #===========================================================================
+    def _buffer_update(self,job_id,start_value,end_value,failed,flush=None):
+        """saves the update_job/failed_job call to be written later. Only the
+        last start_value (and end_value if not None) per job is kept."""
+        with self._pending_lock:
+            prev = self._pending.get(job_id)
+            if prev is None:
+                self._pending[job_id] = [start_value,end_value,failed]
+            else:
+                # failed_job doesn't overwrite with None
+                if not failed or start_value is not None: prev[0] = start_value
+                if end_value is not None: prev[1] = end_value
+                prev[2] = prev[2] or failed
+            pending_cnt = len(self._pending)
+            
+            # make sure it'll be flushed in time
+            if self._flusher is None and not flush:
+                self._flusher = threading.Thread(target=self._flush_loop,
+                                                 name='MyDbFlusher')
+                self._flusher.daemon = True
+                self._flusher.start()
+        
+        if flush or pending_cnt >= self._checkpoint_max:
+            return self.flush_updates() is not False
+        if pending_cnt == 1: self._flush_event.set()
+        return True
+    
+    def flush_updates(self):
+        """writes all the pending (buffered) update_job/failed_job calls in one
+        transaction.  Returns the number of jobs written, False if it failed."""
+        try:
+            with self._lock:
+                if not self._is_open(): return False
+                with self._writing() as conn: cnt = self._flush_updates(conn)
+        except sql.Error as e:
+            self.logger.warning('flushing checkpoints failed! %r',e)
+            return False
+        return cnt
+    
+    def _flush_updates(self,conn):
+        """writes the pending updates with conn (assumes you have the lock).
+        If it fails, they're put back to be tried again."""
+        with self._pending_lock:
+            if not self._pending: return 0
+            pending,self._pending = self._pending,{}
+        
+        try:
+            for failed in (False,True):
+                conn.executemany(self._checkpoint_sql(failed),
+                    (self._checkpoint_params(k,v[0],v[1]) for k,v
+                     in pending.iteritems() if v[2]==failed))
+            failed = [k for k,v in pending.iteritems() if v[2]]
+            if failed: self._retry_failed(conn,failed)
+        except sql.Error:
+            # put them back - anything newer wins
+            self._rebuffer(pending)
+            raise
+        
+        self._flush_count += 1
+        self._flushed_jobs_count += len(pending)
+        
+        # not written if the transaction isn't kept - buffer them again
+        self._on_rollback(self._rebuffer,pending)
+        return len(pending)
+    
+    def _flush_loop(self):
+        """(flusher thread) flushes pending updates within checkpoint_delay
+        seconds of the first one being buffered."""
+        while not self._flusher_stop.is_set():
+            self._flush_event.wait()
+            self._flush_event.clear()
+            if self._flusher_stop.wait(self._checkpoint_delay): break
+            self.flush_updates()
+    
+    def _stop_flusher(self):
+        """stops the flusher thread (if there is one)."""
+        with self._pending_lock:
+            flusher,self._flusher = self._flusher,None
+        if flusher is not None:
+            self._flusher_stop.set()
+            self._flush_event.set()
+            flusher.join()
+            self._flusher_stop.clear()
+    
     
     #===========================================================================
     # Get Summary info
@@ -625,9 +2022,26 @@ class MyDb(MyLoggingBase):
                                       if self._db else self.__total_changes),
             'jobs in jobs table: {:,}'.format(self.get_job_count()),
             'jobs added: {:,}'.format(self._jobs_added_count),
+            'jobs claimed: {:,}'.format(self._jobs_claimed_count),
             'jobs updated: {:,}'.format(self._jobs_updated_count),
+            'checkpoints flushed: {:,} in {:,} flushes'.format(
+                        self._flushed_jobs_count,self._flush_count),
             'jobs removed: {:,}'.format(self._jobs_removed_count),
-            'populate_queues call count: {:,}'.format(self._populate_count)))
+            'populate_queues call count: {:,}'.format(self._populate_count),
+            'queue empty stalls: {:,}'.format(self._stall_count),
+            'jobs archived: {:,}'.format(self._jobs_archived_count),
+            'jobs failed: {:,} ({:,} dead)'.format(self._jobs_failed_count,
+                                                  self._jobs_dead_count),
+            'blocked jobs released: {:,}'.format(self._jobs_unblocked_count),
+            'parked jobs released: {:,} (late avg {:.1f}ms max {:.1f}ms)'.format(
+                self._jobs_released_count,
+                1000.*self._dispatch_delay/(self._jobs_released_count or 1),
+                1000.*self._dispatch_delay_max),
+            'compactions: {:,} ({:,} pages freed)'.format(self._compact_count,
+                                                       self._pages_freed_count),
+            'background refills: {:,} (latency avg {:.1f}ms max {:.1f}ms)'.format(
+                self._refill_count,1000.*self._refill_latency/(self._refill_count or 1),
+                1000.*self._refill_latency_max)))
         return a
 
 #===============================================================================
@@ -653,7 +2067,9 @@ def main():
                 try:
                     items = self.db.get_next_jobs('main',count=self.size)
                 except StopIteration:
-                    if self.continue_waiting: self.db.event.wait()
+                    if self.continue_waiting:
+                        self.db.wait_for_jobs('main',until=lambda: not
+                                              self.continue_waiting)
                     else: break
                 else:
                     print self.name+str(len(items))#tuple(i[0] for i in items))
@@ -663,11 +2079,11 @@ def main():
             
         def stop(self):
             self.continue_waiting = self.continue_looping = False
-            self.db.event.set()
+            self.db.wake_up('main')
             
         def stop_waiting(self):
             self.continue_waiting = False
-            self.db.event.set()
+            self.db.wake_up('main')
     
     
     workers = [Worker(name='worker'+str(i)) for i in xrange(50)]
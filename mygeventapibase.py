@@ -0,0 +1,49 @@
+"""
+2026-10-18
+MyAPIBase for jobs run in greenlets (MyGeventThread) - one API object shared
+by all the jobs on a thread
+"""
+import gevent
+from gevent import monkey
+from requests.adapters import HTTPAdapter
+
+from myapibase import MyAPIBase
+
+class MyGeventAPIBase(MyAPIBase):
+    """
+    MyAPIBase that plays well with many jobs at once on one gevent hub (see
+    MyGeventThread): waiting to retry (rate limits, connection errors) lets
+    the other jobs run instead of blocking the thread, and the session keeps
+    up to pool_maxsize connections per host open so the jobs don't open a new
+    one every request.  Requests only go out concurrently if the socket
+    module is patched first - gevent.monkey.patch_all(thread=False) before
+    importing requests (a warning is logged if it isn't).
+    Override it the same as MyAPIBase.
+    """
+    _pool_maxsize = None # connections kept open per host
+
+    def __init__(self,*args,**keys):
+        """keys:
+            pool_maxsize=100: connections kept open per host (about the
+                number of jobs running at once - MyGeventThread greenlets).
+        See MyAPIBase for the rest."""
+        self._pool_maxsize = keys.pop('pool_maxsize',100)
+        super(MyGeventAPIBase, self).__init__(*args,**keys)
+        if not monkey.is_module_patched('socket'):
+            self.logger.warning('socket is not patched by gevent - requests '
+                                'will block every job on the thread')
+        for prefix in ('http://','https://'):
+            self.mount(prefix,HTTPAdapter(pool_maxsize=self._pool_maxsize))
+
+    #===========================================================================
+    # Generic waiting functions - using if connection issue
+    #===========================================================================
+    def wait_to_retry(self,try_count,t=None):
+        """Called whenever the API needs to wait, usually b/c a connection
+        issue or a rate limit was reached.  Only the waiting job sleeps."""
+        if t is None: t = self.DEFAULT_WAIT_DURATION
+        self.logger.debug('waiting {} seconds (attempt {}/{})'.format(
+                           t,try_count,self.MAX_TRY_COUNT))
+        self.before_sleeping(try_count,t)
+        gevent.sleep(t)
+        self.after_sleeping(try_count,t)
@@ -0,0 +1,177 @@
+"""
+2026-10-18
+a MyThread that works on many jobs at once, each in its own greenlet (gevent),
+for jobs that spend their time waiting on I/O (APIs - see MyGeventAPIBase)
+"""
+from mythread import MyThread
+import time
+import gevent
+from gevent.pool import Pool
+from gevent.local import local
+
+class _JobState(local):
+    """the job a greenlet is working on - what MyThread keeps for its one job
+    (MyThread.__current_job_id etc., and its job_type), kept per greenlet."""
+    job_id = None
+    start_v = None
+    end_v = None
+    updated_time = None
+    blocks_left = 0
+    fetched_at = None
+    job_type = None
+    metrics = None
+
+    def __init__(self,job_type=None,metrics=None):
+        """(called again in each greenlet) starts on job_type's metrics"""
+        self.job_type = job_type
+        self.metrics = metrics
+
+def _job_property(name):
+    """a property for the current greenlet's _JobState.name"""
+    return property(lambda self: getattr(self._job_state,name),
+                    lambda self,value: setattr(self._job_state,name,value))
+
+class MyGeventThread(MyThread):
+    """
+    MyThread that runs up to greenlets jobs at a time, each in a greenlet on
+    the thread's own gevent hub.  It's written (and overridden) the same as
+    MyThread: _process_item, _thread_block, _update_if_needed,
+    _complete_job, etc. work the same, but on the current greenlet's job.
+    Jobs only run concurrently while they're waiting on something gevent can
+    switch away from, so patch first - gevent.monkey.patch_all(thread=False)
+    (threads have to stay real threads: each MyGeventThread has its own hub,
+    and the db's locks are shared with other threads) - before importing
+    requests, etc.  A few of these threads with greenlets=250+ keep 1,000+
+    requests in flight.
+    NOTE: processes=N isn't supported (it's for CPU-bound jobs).
+    """
+
+    _greenlets = None # max number of jobs running at once
+    _job_state = None # _JobState - the job each greenlet's on
+    _running = None # gevent Pool of the running jobs' greenlets
+    _job_error = None # the first error raised by a job (re-raised by run)
+    _completing = None # greenlet that'll remove the completed jobs (batch_complete)
+
+    # MyThread's current job (name mangled) - one per greenlet
+    _MyThread__current_job_id = _job_property('job_id')
+    _MyThread__current_job_start_v = _job_property('start_v')
+    _MyThread__current_job_end_v = _job_property('end_v')
+    _MyThread__job_updated_time = _job_property('updated_time')
+    _MyThread__blocks_left = _job_property('blocks_left')
+    _fetched_at = _job_property('fetched_at')
+    _job = _job_property('job_type')
+    _metrics = _job_property('metrics')
+
+    def __init__(self,job,db,**keys):
+        """
+        params (required):
+            job: the job type the thread should process (or several, with
+                weights - see MyThread)
+            db: the db object to interface with (similar to MyDb)
+        keys:
+            greenlets=100: the most jobs to run at once.
+            batch_complete=False: if True, jobs that complete at about the
+                same time are removed from the db together instead of one
+                by one (see MyThread).
+        """
+        self._greenlets = keys.pop('greenlets',100)
+        if keys.pop('processes',None):
+            raise ValueError('processes=N is not supported by MyGeventThread')
+        self._job_state = _JobState()
+        MyThread.__init__(self,job,db,**keys)
+        # greenlets start on the first job_type (each job sets its own)
+        self._job_state = _JobState(self._job,self._metrics)
+
+    #===========================================================================
+    #============================= Thread runner! ==============================
+    #===========================================================================
+    def run(self):
+        """started when the thread does: gets as many jobs as there are free
+        greenlets and starts each in one.  While the queue's empty it waits
+        for the db in gevent's threadpool so the running jobs carry on."""
+        self._before_looping()
+        completed = [] if self._batch_complete else None
+        self._running = running = Pool(self._greenlets)
+
+        # start looping
+        while self._continue_looping:
+            if not running.free_count():
+                running.wait_available()
+                continue
+
+            # are there more jobs to do?
+            fetched_at = time.time()
+            try: items = self._next_jobs(running.free_count())
+            except StopIteration:
+                if self._continue_waiting:
+                    self._waiting = not len(running)
+                    gevent.get_hub().threadpool.apply(self._db.wait_for_jobs,
+                                (self._wait_key,),{'until':self._stop_waiting})
+                    self._waiting = False
+                elif len(running):
+                    # a running job might fail and go back in the queue
+                    gevent.wait(list(running),count=1)
+                else:
+                    self.logger.debug('queue is empty, and I am not waiting!')
+                    break
+            else:
+                # check for interupt
+                if self._interupt_process:
+                    self.logger.warning("we've been interrupted!")
+                else:
+                    for item in items:
+                        running.spawn(self._run_job,list(item),completed,
+                                      fetched_at,self._job)
+
+        # let the running jobs finish (or save, if interrupted)
+        running.join()
+        if completed: self._complete_done(completed)
+        self._running = None
+
+        # give us a change to finish a few things if needed
+        self._after_looping()
+        self._stop_checkpointer()
+        if self._job_error is not None: raise self._job_error
+
+    def _run_job(self,item,completed=None,fetched_at=None,job_type=None):
+        """runs _process_job (a job_type job) in the job's greenlet.  The
+        first error a job raises stops the thread (as it would MyThread) once
+        the other jobs are done, re-raised by run."""
+        self._fetched_at = fetched_at
+        if job_type is not None:
+            self._job = job_type
+            self._metrics = self._metrics_by_type[job_type]
+        try: self._process_job(item,completed)
+        except Exception as e:
+            self.logger.critical('job %s raised %r - stopping after the '
+                                 'running jobs',item[self._db.JOB_ID],e)
+            if self._job_error is None: self._job_error = e
+            self.stop_after_job()
+        if completed and self._completing is None:
+            self._completing = gevent.spawn(self._complete_done,completed)
+
+    def _complete_done(self,completed):
+        """(batch_complete) removes the jobs completed so far - it runs once
+        the greenlets ready to go have, so jobs done together go together."""
+        self._completing = None
+        done,completed[:] = completed[:],[]
+        if done: self._complete_jobs(*zip(*done))
+
+    #===========================================================================
+    # Override Get Summary info
+    #===========================================================================
+    def _get_summary_info(self):
+        """adds the number of jobs running right now."""
+        a = MyThread._get_summary_info(self)
+        a.append('jobs running: {:,}'.format(len(self._running or ())))
+        return a
+
+    #===========================================================================
+    #=========== Things that should be used when class is Inherited ============
+    #===========================================================================
+    def _thread_block(self,start_value):
+        """MyThread._thread_block, then lets the other jobs run so a job that
+        keeps busy between waits doesn't hold them all up."""
+        interrupted = MyThread._thread_block(self,start_value)
+        gevent.sleep(0)
+        return interrupted
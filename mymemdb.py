@@ -0,0 +1,564 @@
+"""
+2026-10-18
+a job store with the MyDb api (what MyThread uses) kept only in memory -
+no sql, no crash recovery.  Use save(...) to snapshot it to a MyDb file.
+"""
+import sqlite3 as sql
+import threading
+import time
+import heapq
+from contextlib import contextmanager
+from myloggingbase import MyLoggingBase
+from mydb import MyDb,QUEUE_FIFO,_JobQueue,_job_condition
+
+class MyMemDb(MyLoggingBase):
+    """
+    drop-in for MyDb when the jobs don't need to outlive the run: jobs are in
+    a dict, with an index on (item_id,job_type) for checking duplicates and a
+    set per job_type of the jobs not in a queue (to populate them).  Same
+    rules as MyDb: a job isn't added if the same item_id,job_type is waiting
+    (not started) or if its init_data isn't newer; queues hand out the highest
+    priority first and queue_max drops the lowest priority jobs back to the
+    store.  Jobs with a run_at in the future are parked (in_queue -1) till
+    then, and jobs added with after (parent job_ids) are blocked (-2) till
+    their parents are removed.  Failed jobs back off and die the same as
+    MyDb's (max_attempts, retry_backoff and retry_backoff_max).
+    NOTES:
+        one lock for everything - every call is quick (no io).
+        the other MyDb keys (wal, checkpoint_delay, ...) are accepted and
+            ignored, and flush_updates() does nothing - updates are always
+            "written".
+    """
+
+    #===========================================================================
+    # Class Constants
+    #===========================================================================
+    # job record (list): [in_queue,item_id,job_type,init_data,start_value,
+    #                       end_value,priority,run_at]
+    _IN_QUEUE,_ITEM_ID,_JOB_TYPE,_INIT_DATA = 0,1,2,3
+    _START_VALUE,_END_VALUE,_PRIORITY,_RUN_AT = 4,5,6,7
+    _COLUMNS = ('in_queue','item_id','job_type','init_data','start_value',
+                'end_value','priority','run_at')
+    _PARKED,_BLOCKED = MyDb._PARKED,MyDb._BLOCKED
+
+    JOB_ID,ITEM_ID,INIT_DATA,START_VALUE,END_VALUE = MyDb.JOB_ID,MyDb.ITEM_ID,\
+                        MyDb.INIT_DATA,MyDb.START_VALUE,MyDb.END_VALUE
+
+    #===========================================================================
+    # Variables
+    #===========================================================================
+    _jobs = None # job_id: job record
+    _index = None # (item_id,job_type): set of job_ids
+    _out_queue = None # job_type: set of job_ids not in a queue
+    _type_counts = None # job_type: number of jobs
+    _parked = None # heap of (run_at,job_id) of parked jobs
+    _parents = None # blocked job_id: set of parent job_ids left
+    _children = None # parent job_id: set of blocked job_ids
+    _attempts = None # job_id: times it's failed
+    _dead = None # job_id: (job record,attempts,failed) out of attempts
+    _max_attempts = None
+    _retry_backoff = None
+    _retry_backoff_max = None
+    _queues = None
+    queue_max = None
+    queue_type = None
+    _last_id = 0
+    _lock = None
+    _conditions = None # job_type (or tuple of): _JobCondition to wait for jobs
+    event = None # deprecated: use wait_for_jobs(...) and wake_up(...)
+    _open = None
+
+    #===========================================================================
+    # Tracked Metrics
+    #===========================================================================
+    _jobs_added_count = None
+    _jobs_updated_count = None
+    _jobs_removed_count = None
+    _populate_count = None
+    _jobs_failed_count = None
+    _jobs_dead_count = None
+    _jobs_unblocked_count = None
+
+    def __init__(self,queue_max=None,queue_type=QUEUE_FIFO,**keys):
+        """queue_max and queue_type are the same as MyDb's.  keys:
+            max_attempts, retry_backoff and retry_backoff_max: see MyDb.
+            the rest are ignored (so MyDb's can be passed)."""
+        super(MyMemDb,self).__init__()
+
+        self._jobs_added_count = 0
+        self._jobs_updated_count = 0
+        self._jobs_removed_count = 0
+        self._populate_count = 0
+        self._jobs_failed_count = 0
+        self._jobs_dead_count = 0
+        self._jobs_unblocked_count = 0
+
+        self._jobs = {}
+        self._index = {}
+        self._out_queue = {}
+        self._type_counts = {}
+        self._parked = []
+        self._parents = {}
+        self._children = {}
+        self._attempts = {}
+        self._dead = {}
+        self._max_attempts = keys.pop('max_attempts',None)
+        self._retry_backoff = keys.pop('retry_backoff',None)
+        self._retry_backoff_max = keys.pop('retry_backoff_max',3600)
+        self._queues = {}
+        self._conditions = {}
+        self._lock = threading.Lock()
+        self.event = threading.Event()
+        self.queue_max = queue_max if queue_max else None
+        self.queue_type = queue_type
+        self._open = True
+
+    #===========================================================================
+    #============================ GETTERS / SETTERS ============================
+    #===========================================================================
+    def is_open(self): return self._open
+
+    def close(self,commit=True):
+        """nothing to close - wakes up anything waiting. Returns True."""
+        self._open = False
+        self.wake_up()
+        return True
+
+    def get_filename(self): return None
+
+    def get_job_count(self,job_type=None):
+        """returns the number of jobs (of job_type if passed)."""
+        with self._lock:
+            if job_type is None: return len(self._jobs)
+            return self._type_counts.get(job_type,0)
+
+    def get_job_counts(self):
+        """returns the number of jobs per job_type and in_queue state:
+        {job_type: {in_queue: count}}."""
+        counts = {}
+        with self._lock:
+            for i in self._jobs.itervalues():
+                c = counts.setdefault(i[self._JOB_TYPE],{})
+                c[i[self._IN_QUEUE]] = c.get(i[self._IN_QUEUE],0) + 1
+        return counts
+
+    def iter_jobs(self,job_type=None,in_queue=None,started=None,columns=None,
+                  page_size=1000):
+        """iterate through the jobs (by id) as MyDb's jobs table columns:
+        (id,in_queue,item_id,job_type,init_data,start_value,end_value,priority)
+        Same filters and columns as MyDb.iter_jobs.  The lock is only held
+        while copying a page (page_size jobs)."""
+        names = ('id',)+self._COLUMNS
+        if columns is not None:
+            bad = [c for c in columns if c not in names]
+            if bad: raise ValueError('not columns of jobs: {}'.format(bad))
+            idx = [names.index(c) for c in columns]
+
+        with self._lock: job_ids = sorted(self._jobs)
+        for n in xrange(0,len(job_ids),page_size):
+            with self._lock:
+                page = [(k,)+tuple(self._jobs[k]) for k in job_ids[n:n+page_size]
+                        if k in self._jobs]
+            for i in page:
+                if job_type is not None and i[1+self._JOB_TYPE]!=job_type: continue
+                if in_queue is not None and i[1+self._IN_QUEUE]!=in_queue: continue
+                if started is not None and \
+                        (i[1+self._START_VALUE] is not None)!=started: continue
+                yield i if columns is None else tuple(i[j] for j in idx)
+
+    def get_event(self):
+        """deprecated: returns the event set whenever jobs are added (any
+        job_type).  Use wait_for_jobs(...) and wake_up(...)."""
+        return self.event
+
+    #===========================================================================
+    #============================= 'Queue' Things ==============================
+    #===========================================================================
+    def _get_condition(self,job_type):
+        """returns the condition to wait on for job_type jobs (creates it if
+        needed - a tuple of job_types is a group). Assumes you have the lock."""
+        return _job_condition(self._conditions,self._lock,job_type)
+
+    def wait_for_jobs(self,job_type,until=None,timeout=None):
+        """same as MyDb.wait_for_jobs: waits till job_type jobs are added,
+        wake_up(...) is called or timeout (job_type can be a tuple of
+        job_types - any of them). Returns True if there are jobs."""
+        job_types = job_type if isinstance(job_type,tuple) else (job_type,)
+        with self._lock:
+            self._release_due()
+            if not (any(self._queues.get(t) or self._out_queue.get(t) for t in job_types)
+                    or (until is not None and until())):
+                # wake up when the next parked job is due
+                if self._parked:
+                    due = max(self._parked[0][0]-time.time(),0)
+                    timeout = due if timeout is None else min(timeout,due)
+                self._get_condition(job_type).wait(timeout)
+                self._release_due()
+            has_jobs = any(self._queues.get(t) or self._out_queue.get(t) for t in job_types)
+        return has_jobs
+
+    def get_queue_size(self,job_type):
+        """same as MyDb.get_queue_size: the number of job_type jobs in the
+        queue (there may be more out of it)."""
+        return len(self._queues.get(job_type) or ())
+
+    def wake_up(self,job_type=None):
+        """wakes up everything waiting on job_type (all job_types if None, or
+        a tuple of job_types)."""
+        with self._lock:
+            if job_type is None:
+                for c in self._conditions.itervalues(): c.notify_all()
+            else: self._get_condition(job_type).notify_all()
+        self.event.set()
+
+    def _put_many_in_queue(self,job_type,job_ids):
+        """queues the jobs (assumes you have the lock). Jobs dropped from the
+        queue (queue_max) go back to the out of queue set. Wakes up as many
+        job_type waiters as jobs added. Returns the number added."""
+        if job_type in self._queues:
+            q = self._queues[job_type]
+        else:
+            q = self._queues[job_type] = _JobQueue(self.queue_max,self.queue_type)
+
+        jobs,out = self._jobs,self._out_queue.setdefault(job_type,set())
+        added,removed = q.push_many([(k,j[1],j[3],j[4],j[5],j[6]) for k,j in
+                                     ((k,jobs[k]) for k in job_ids)])
+        for k in added:
+            jobs[k][self._IN_QUEUE] = 1
+            out.discard(k)
+        for k in removed:
+            if k in jobs:
+                jobs[k][self._IN_QUEUE] = 0
+                out.add(k)
+
+        if added:
+            self._get_condition(job_type).notify(len(added))
+            self.event.set()
+        return len(added)
+
+    def get_next_job(self,job_type):
+        return self.get_next_jobs(job_type,count=1)[0]
+
+    def get_next_jobs(self,job_type,count=1):
+        """same as MyDb.get_next_jobs: returns a list of up to count job tuples.
+        Raises StopIteration if there aren't any job_type jobs left."""
+        items = []
+        with self._lock:
+            if self._parked: self._release_due()
+            q = self._queues.get(job_type)
+            while count > 0:
+                try: item = q.pop()
+                except (AttributeError,IndexError):
+                    # queue empty - anything left out of it?
+                    if not self._populate(job_type):
+                        self.event.clear()
+                        break
+                    q = self._queues[job_type]
+                else:
+                    # removed while it waited in the queue? skip it
+                    if item[0] not in self._jobs: continue
+                    items.append(item)
+                    count -= 1
+
+        if items or count <= 0: return items
+        else: raise StopIteration
+
+    def populate_queues(self,job_type=None,first_call=False,job_types=None):
+        """queues the jobs that aren't in a queue. first_call puts every job
+        back.  Returns False if nothing was queued."""
+        success = False
+        with self._lock:
+            self._release_due()
+            if first_call:
+                self._queues.clear()
+                for k,i in self._jobs.iteritems():
+                    if i[self._IN_QUEUE] < 0: continue # parked/blocked
+                    i[self._IN_QUEUE] = 0
+                    self._out_queue.setdefault(i[self._JOB_TYPE],set()).add(k)
+
+            job_types = tuple(self._out_queue) \
+                if job_type is None else ((job_type,) \
+                if job_types is None else job_types)
+            for job_type in job_types:
+                if self._populate(job_type): success = True
+        return success
+
+    def _release_due(self):
+        """moves the parked jobs that are due to out of queue and wakes their
+        job_types (assumes you have the lock)."""
+        parked,now = self._parked,time.time()
+        while parked and parked[0][0] <= now:
+            job_id = heapq.heappop(parked)[1]
+            job = self._jobs.get(job_id)
+            if job is None or job[self._IN_QUEUE] != self._PARKED: continue
+            job[self._IN_QUEUE] = 0
+            self._out_queue.setdefault(job[self._JOB_TYPE],set()).add(job_id)
+            self._get_condition(job[self._JOB_TYPE]).notify()
+
+    def _populate(self,job_type):
+        """queues job_type jobs not in the queue, highest priority first, as
+        many as fit (assumes you have the lock). Returns the number added."""
+        out = self._out_queue.get(job_type)
+        if not out: return 0
+        self._populate_count += 1
+
+        q = self._queues.get(job_type)
+        limit = (self.queue_max - (len(q) if q else 0)) if self.queue_max else None
+        if limit is not None and limit <= 0: return 0
+
+        # same order as MyDb: priority, then id (newest first if LIFO)
+        sign = 1 if self.queue_type==QUEUE_FIFO else -1
+        jobs,p = self._jobs,self._PRIORITY
+        key = lambda k: (-jobs[k][p],sign*k)
+        job_ids = sorted(out,key=key) if limit is None else heapq.nsmallest(limit,out,key=key)
+        return self._put_many_in_queue(job_type,job_ids)
+
+    #===========================================================================
+    #=============================== JOB THINGS ================================
+    #===========================================================================
+    def add_job(self,item_id,job_type,init_data=None,priority=0,run_at=None,
+                after=None):
+        """Adds job and returns job_id.  Returns False if not added."""
+        job_ids = self.add_jobs(((item_id,job_type,init_data,priority,run_at,after),))
+        return job_ids[0] if job_ids else False
+
+    def add_jobs(self,items):
+        """same as MyDb.add_jobs: adds the (item_id,job_type[,init_data
+        [,priority[,run_at[,after]]]]) items and returns the list of new
+        job_ids."""
+        job_ids = []
+        attempt_cnt = 0
+        now = time.time()
+        with self._lock:
+            jobs,index = self._jobs,self._index
+            seen = set() # only the first valid job per item_id,job_type
+            new = {}
+            for i in items:
+                attempt_cnt += 1
+                key = (i[0],i[1])
+                init_data = i[2] if len(i)>2 else None
+                if key in seen: continue
+                # waiting (not started) or init_data isn't newer?
+                if any(jobs[k][self._START_VALUE] is None or (init_data is not None
+                            and jobs[k][self._INIT_DATA] is not None
+                            and jobs[k][self._INIT_DATA] >= init_data)
+                       for k in index.get(key,())):
+                    continue
+                seen.add(key)
+
+                self._last_id += 1
+                run_at = (i[4] or 0) if len(i)>4 else 0
+                jobs[self._last_id] = [0,i[0],i[1],init_data,None,None,
+                                       (i[3] or 0) if len(i)>3 else 0,run_at]
+                job_ids.append(self._last_id)
+                parents = set(k for k in i[5] if k in jobs) if len(i)>5 and i[5] else None
+                if parents or run_at > now:
+                    if parents:
+                        jobs[self._last_id][self._IN_QUEUE] = self._BLOCKED
+                        self._parents[self._last_id] = parents
+                        for k in parents:
+                            self._children.setdefault(k,set()).add(self._last_id)
+                    else:
+                        jobs[self._last_id][self._IN_QUEUE] = self._PARKED
+                        heapq.heappush(self._parked,(run_at,self._last_id))
+                    # so the job_type's counted and indexed below
+                    new.setdefault(i[1],[])
+                    index.setdefault(key,set()).add(self._last_id)
+                    self._type_counts[i[1]] = self._type_counts.get(i[1],0)+1
+                else: new.setdefault(i[1],[]).append(self._last_id)
+
+            for job_type,ids in new.iteritems():
+                for k in ids:
+                    index.setdefault((jobs[k][self._ITEM_ID],job_type),set()).add(k)
+                self._out_queue.setdefault(job_type,set()).update(ids)
+                self._type_counts[job_type] = self._type_counts.get(job_type,0)+len(ids)
+                if ids: self._put_many_in_queue(job_type,ids)
+            self._jobs_added_count += len(job_ids)
+
+        self.logger.debug('%d / %d jobs added',len(job_ids),attempt_cnt)
+        return job_ids
+
+    def update_job(self,job_id,start_value,end_value=None,flush=None):
+        """updates job with start_value (and end_value if not None).
+        Returns True for success (flush does nothing)."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None: return False
+            job[self._START_VALUE] = start_value
+            if end_value is not None: job[self._END_VALUE] = end_value
+            self._jobs_updated_count += 1
+        return True
+
+    def remove_job(self,job_id,rows=None):
+        """Removes the job (it's done!). Returns True for success."""
+        return self.remove_jobs((job_id,))
+
+    def remove_jobs(self,job_ids,rows=None):
+        """Removes the jobs (they're done!) and releases their children with
+        no parents left. Returns True if any were.  rows is ignored (no
+        history)."""
+        removed = 0
+        with self._lock:
+            for job_id in job_ids:
+                if self._drop(job_id) is None: continue
+                removed += 1
+                for k in self._children.pop(job_id,()):
+                    parents = self._parents.get(k)
+                    if parents is None: continue
+                    parents.discard(job_id)
+                    if not parents: self._unblock(k)
+            self._jobs_removed_count += removed
+        return removed > 0
+
+    def _unblock(self,job_id):
+        """the blocked job's parents are all done: it's waiting (or parked
+        till its run_at). Assumes you have the lock."""
+        del self._parents[job_id]
+        job = self._jobs.get(job_id)
+        if job is None or job[self._IN_QUEUE] != self._BLOCKED: return
+        self._jobs_unblocked_count += 1
+        if job[self._RUN_AT] > time.time():
+            job[self._IN_QUEUE] = self._PARKED
+            heapq.heappush(self._parked,(job[self._RUN_AT],job_id))
+        else:
+            job[self._IN_QUEUE] = 0
+            self._out_queue.setdefault(job[self._JOB_TYPE],set()).add(job_id)
+        self._get_condition(job[self._JOB_TYPE]).notify_all()
+
+    def _drop(self,job_id):
+        """takes the job out of the store (assumes you have the lock).
+        Returns its record, None if it isn't there."""
+        job = self._jobs.pop(job_id,None)
+        if job is None: return None
+        key = (job[self._ITEM_ID],job[self._JOB_TYPE])
+        ids = self._index[key]
+        ids.discard(job_id)
+        if not ids: del self._index[key]
+        self._out_queue[job[self._JOB_TYPE]].discard(job_id)
+        self._type_counts[job[self._JOB_TYPE]] -= 1
+        self._attempts.pop(job_id,None)
+        return job
+
+    def retries_failed_jobs(self):
+        """same as MyDb.retries_failed_jobs (max_attempts or retry_backoff)."""
+        return self._max_attempts is not None or self._retry_backoff is not None
+
+    def failed_job(self,job_id,start_value=None,end_value=None,flush=None):
+        """Takes the job out of the queue so it can be tried again (saving
+        start_value and end_value if not None) - parked for the backoff or
+        dead if it's out of attempts, like MyDb. Returns True for success."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None: return False
+            if start_value is not None: job[self._START_VALUE] = start_value
+            if end_value is not None: job[self._END_VALUE] = end_value
+            self._jobs_failed_count += 1
+            attempts = self._attempts[job_id] = self._attempts.get(job_id,0)+1
+            job_type = job[self._JOB_TYPE]
+            if self._max_attempts is not None and attempts >= self._max_attempts:
+                self._drop(job_id)
+                self._dead[job_id] = (job,attempts,time.time())
+                self._jobs_dead_count += 1
+                self.logger.warning('job %s out of attempts - dead',job_id)
+            elif self._retry_backoff is not None:
+                job[self._IN_QUEUE] = self._PARKED
+                job[self._RUN_AT] = time.time()+min(
+                    self._retry_backoff*2**(attempts-1),self._retry_backoff_max)
+                heapq.heappush(self._parked,(job[self._RUN_AT],job_id))
+                # waiters recheck when the next parked job is due
+                self._get_condition(job_type).notify_all()
+            else:
+                job[self._IN_QUEUE] = 0
+                self._out_queue[job_type].add(job_id)
+                self._get_condition(job_type).notify()
+        return True
+
+    def get_dead_jobs(self,job_type=None):
+        """same as MyDb.get_dead_jobs: [(id,item_id,job_type,init_data,
+        start_value,end_value,priority,attempts,failed)]."""
+        with self._lock:
+            return [(k,)+tuple(job[1:7])+(attempts,failed) for k,(job,attempts,failed)
+                    in sorted(self._dead.iteritems())
+                    if job_type is None or job[self._JOB_TYPE]==job_type]
+
+    def requeue_dead(self,job_ids=None,job_type=None):
+        """same as MyDb.requeue_dead: dead jobs (job_ids, or all of job_type,
+        or all) are waiting again.  Returns the number requeued."""
+        cnt = 0
+        with self._lock:
+            for job_id in (sorted(self._dead) if job_ids is None else job_ids):
+                if job_id not in self._dead: continue
+                job = self._dead[job_id][0]
+                if job_type is not None and job[self._JOB_TYPE]!=job_type: continue
+                key = (job[self._ITEM_ID],job[self._JOB_TYPE])
+                # added again since? (MyDb's unique item_id,job_type,init_data)
+                if any(self._jobs[k][self._INIT_DATA]==job[self._INIT_DATA]
+                       for k in self._index.get(key,())): continue
+                del self._dead[job_id]
+                job[self._IN_QUEUE],job[self._RUN_AT] = 0,0
+                self._jobs[job_id] = job
+                self._index.setdefault(key,set()).add(job_id)
+                self._out_queue.setdefault(key[1],set()).add(job_id)
+                self._type_counts[key[1]] = self._type_counts.get(key[1],0)+1
+                self._get_condition(key[1]).notify()
+                cnt += 1
+        return cnt
+
+    @contextmanager
+    def transaction(self):
+        """for MyDb compatibility: every call is applied right away - nothing
+        is grouped or rolled back."""
+        yield self
+
+    batch = transaction
+
+    def flush_updates(self):
+        """nothing is buffered - returns 0 (for MyDb compatibility)."""
+        return 0
+
+    #===========================================================================
+    # Snapshot
+    #===========================================================================
+    def save(self,filename):
+        """writes all the jobs (with their ids and attempts) and the dead jobs
+        to a new MyDb file - open it with MyDb to carry on.  Will NOT
+        overwrite an existing file!  Returns True for success."""
+        db = MyDb()
+        if not db.new(filename): return False
+        try:
+            with db.get_db() as conn:
+                with self._lock:
+                    attempts = dict(self._attempts)
+                    edges = [(p,c) for c,parents in self._parents.iteritems()
+                             for p in parents]
+                # parked/blocked stay that way, the rest are waiting
+                conn.executemany('''INSERT INTO jobs (id,in_queue,item_id,job_type,
+                        init_data,start_value,end_value,priority,run_at,attempts)
+                    VALUES (?,?,?,?,?,?,?,?,?,?)''',((i[0],min(i[1],0))+i[2:]+
+                        (attempts.get(i[0],0),) for i in self.iter_jobs()))
+                conn.executemany('INSERT INTO job_deps (parent_id,child_id) VALUES (?,?)',
+                                 edges)
+                conn.executemany('''INSERT INTO jobs_dead (id,item_id,job_type,
+                        init_data,start_value,end_value,priority,attempts,failed)
+                    VALUES (?,?,?,?,?,?,?,?,?)''',self.get_dead_jobs())
+        except sql.Error as e:
+            self.logger.warning('saving jobs failed! %r',e)
+            return False
+        finally: db.close()
+        return True
+
+    #===========================================================================
+    # Get Summary info
+    #===========================================================================
+    def _get_summary_info(self):
+        """useful for printing summary information (see MyDb)."""
+        a = super(MyMemDb,self)._get_summary_info()
+        a.extend(('jobs in store: {:,}'.format(self.get_job_count()),
+            'jobs added: {:,}'.format(self._jobs_added_count),
+            'jobs updated: {:,}'.format(self._jobs_updated_count),
+            'jobs removed: {:,}'.format(self._jobs_removed_count),
+            'jobs failed: {:,} ({:,} dead)'.format(self._jobs_failed_count,
+                                                  self._jobs_dead_count),
+            'blocked jobs released: {:,}'.format(self._jobs_unblocked_count),
+            'populate count: {:,}'.format(self._populate_count)))
+        return a
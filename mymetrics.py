@@ -0,0 +1,137 @@
+"""
+2026-10-18
+cheap job timings (fixed bucket histograms) and counters for MyThread - each
+thread keeps its own, merged when they're read
+"""
+import bisect
+
+class MyHistogram(object):
+    """
+    a fixed bucket histogram of seconds: bucket i counts values up to
+    BOUNDS[i] (100us doubling to ~14 min), the last one anything bigger.
+    Adding is a bisect and a few adds.  Not thread-safe - one thread adds,
+    anyone can read (or merge it into another).
+    """
+    BOUNDS = tuple(.0001*2**i for i in xrange(24))
+    __slots__ = ('counts','count','total','max')
+
+    def __init__(self):
+        self.counts = [0]*(len(self.BOUNDS)+1)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self,seconds):
+        """counts one value (in seconds)."""
+        self.counts[bisect.bisect_left(self.BOUNDS,seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max: self.max = seconds
+
+    def merge(self,other):
+        """adds other's values to this one."""
+        for i,c in enumerate(list(other.counts)): self.counts[i] += c
+        self.count += other.count
+        self.total += other.total
+        if other.max > self.max: self.max = other.max
+
+    def percentile(self,p):
+        """returns the bucket bound p (0-100) percent of the values are under
+        (max for the last bucket), or None if there aren't any."""
+        if not self.count: return None
+        n = p/100.*self.count
+        seen = 0
+        for i,c in enumerate(self.counts):
+            seen += c
+            if c and seen >= n: break
+        return self.BOUNDS[i] if i < len(self.BOUNDS) else self.max
+
+    def to_dict(self):
+        """a snapshot: count, total, max and the non-empty buckets as
+        [upper bound (None for the last), count] pairs."""
+        return {'count':self.count,'total':self.total,'max':self.max,
+                'buckets':[[self.BOUNDS[i] if i < len(self.BOUNDS) else None,c]
+                           for i,c in enumerate(self.counts) if c]}
+
+    def get_summary_info(self):
+        """one line: count, average and percentiles."""
+        if not self.count: return '0'
+        return '{:,} avg {:.4f}s p50<{:.4f}s p90<{:.4f}s p99<{:.4f}s max {:.4f}s'.format(
+                    self.count,self.total/self.count,self.percentile(50),
+                    self.percentile(90),self.percentile(99),self.max)
+
+class MyJobMetrics(object):
+    """
+    one thread's timings and counters for its job_type (or several
+    threads' merged - see merged(...)):
+        queue_wait: asking the db for the job's batch till the job starts
+        process: finding the end value and _process_item
+        checkpoint: saving a job's progress (db and _flush_files)
+        complete: removing completed jobs (per remove - a batch at a time
+            with batch_complete)
+    jobs (completed), failed and rows are counted, and jobs/rows per second
+    are over the time from the first job starting to the last ending.
+    """
+    HISTOGRAMS = ('queue_wait','process','checkpoint','complete')
+
+    def __init__(self,job_type=None):
+        self.job_type = job_type
+        for k in self.HISTOGRAMS: setattr(self,k,MyHistogram())
+        self.jobs = 0
+        self.failed = 0
+        self.rows = 0
+        self.first = None # when the first job started (time.time())
+        self.last = None # when the last job ended
+
+    def job_done(self,started,ended,rows=0,completed=True,failed=False):
+        """counts a job that ran from started to ended (an interrupted job
+        is neither completed nor failed)."""
+        if completed: self.jobs += 1
+        elif failed: self.failed += 1
+        self.rows += rows or 0
+        if self.first is None: self.first = started
+        self.last = ended
+
+    def merge(self,other):
+        """adds other's timings and counters to these."""
+        for k in self.HISTOGRAMS: getattr(self,k).merge(getattr(other,k))
+        self.jobs += other.jobs
+        self.failed += other.failed
+        self.rows += other.rows
+        if other.first is not None and (self.first is None or other.first < self.first):
+            self.first = other.first
+        if other.last is not None and (self.last is None or other.last > self.last):
+            self.last = other.last
+
+    @classmethod
+    def merged(cls,metrics):
+        """returns {job_type: MyJobMetrics} with metrics merged by job_type."""
+        by_type = {}
+        for m in metrics:
+            if m.job_type not in by_type: by_type[m.job_type] = cls(m.job_type)
+            by_type[m.job_type].merge(m)
+        return by_type
+
+    def get_seconds(self):
+        """seconds from the first job starting to the last ending."""
+        return float(self.last-self.first) if self.first is not None else 0.
+
+    def to_dict(self):
+        """a snapshot (json-able) of the counters, rates and histograms."""
+        seconds = self.get_seconds()
+        d = {'job_type':self.job_type,'jobs':self.jobs,'failed':self.failed,
+             'rows':self.rows,'seconds':seconds,
+             'jobs_per_sec':self.jobs/seconds if seconds else None,
+             'rows_per_sec':self.rows/seconds if seconds else None}
+        for k in self.HISTOGRAMS: d[k] = getattr(self,k).to_dict()
+        return d
+
+    def get_summary_info(self):
+        """lines for a summary: rates, then a line per histogram."""
+        seconds = self.get_seconds() or 1e-9
+        a = ['{} jobs: {:,} ({:,} failed), {:,.1f} jobs/sec, {:,.1f} rows/sec'.format(
+                    self.job_type,self.jobs,self.failed,self.jobs/seconds,
+                    self.rows/seconds)]
+        a.extend('{} {}: {}'.format(self.job_type,k,getattr(self,k).get_summary_info())
+                 for k in self.HISTOGRAMS)
+        return a
@@ -5,8 +5,22 @@ a base thread class for doing jobs, to work with a mydb instance
 shared by all workers
 """
 from myloggingbase import MyLoggingBase
+from mymetrics import MyJobMetrics
+import os
 import threading
 import time
+import random
+import multiprocessing
+from multiprocessing.queues import SimpleQueue
+import traceback
+
+# a monotonic clock for checkpoint intervals - time.clock() is CPU time on
+# linux and time.time() jumps with the system clock.  os.times()[4] is wall
+# seconds from a fixed point (10ms ticks) and as quick as time.clock()
+try: _monotonic = time.monotonic # python 3.3+
+except AttributeError:
+    if os.name == 'posix': _monotonic = lambda: os.times()[4]
+    else: _monotonic = time.time # os.times()[4] is always 0 on windows
 
 class MyThread(MyLoggingBase,threading.Thread):
     """
@@ -16,7 +30,17 @@ class MyThread(MyLoggingBase,threading.Thread):
         _before_looping  (optional)
         _after_looping (optional)
         _flush_files (optional) 
+        _get_process_state (optional - processes=N only)
     Read the docs for each method for more details.    
+    processes=N runs _process_item in a pool of N processes (for CPU-bound
+    jobs the GIL would hold to one core).  The thread still does the
+    bookkeeping - getting jobs, _find_job_end_value, updating, completing
+    and interrupts - and the processes send their checkpoints
+    (_thread_block/_update_current_job) and _add_job calls back to it.
+    _process_item is written the same way, but it runs on a copy of the
+    thread (a new object of the same class with _get_process_state()
+    set on it), so the class has to be importable (module level) and
+    _flush_files is called by the thread, not the process.
     """
     
     # TODO: system to tell if the thread broke or not...
@@ -26,13 +50,35 @@ class MyThread(MyLoggingBase,threading.Thread):
     
     _db = None
     _batch_size = None
+    _batch_complete = None
+    _batch_target = None # seconds a batch should take (adaptive batch sizes)
+    _batch_min = None # smallest adaptive batch
+    _batch_max = None # largest adaptive batch
+    _item_time = None # average seconds per job (fetching and processing)
+    _batch_stats = None # batch sizes (1,2-3,4-7,...): [batches,jobs,seconds]
+    _metrics = None # MyJobMetrics - job timings and counters (current job_type's)
+    _metrics_by_type = None # job_type: MyJobMetrics
+    _jobs_running = None # job_id: saved since the interrupt (for drains)
+    _jobs_drained = None # job_id: how it ended after the interrupt
+    _fetched_at = None # when the db was asked for the current batch
+    
+    _pool = None # multiprocessing pool _process_item runs in (processes=N)
+    _progress = None # SimpleQueue the pool sends checkpoints/results on
+    _pool_interrupt = None # multiprocessing Event - set when interrupted
+    _POOL_POLL = 1 # seconds between checking the pool's processes are alive
+    _pool_broken = False # a job died with its process (the pool can't close)
     
     _my_id = None
-    _job = None
+    _job = None # the current job's job_type
+    _job_types = None # [(job_type,quantum)] in turn order (see _next_jobs)
+    _deficits = None # job_type: jobs it can still get this turn (several job_types)
+    _turn = 0 # index in _job_types of the job_type getting jobs
+    _wait_key = None # what to wait_for_jobs/wake_up (a tuple for several job_types)
     
     _CTRL_WAKE_UP,_CTRL_QUEUE,_CTRL_JOB,_CTRL_INTERRUPT = 0,1,2,3
     
     _interupt_process = None
+    _waiting = None # True while waiting for jobs (the queue's empty)
     _continue_waiting = None
     _continue_looping = None
     
@@ -43,34 +89,109 @@ class MyThread(MyLoggingBase,threading.Thread):
     _END_JOB = '<<END_JOB_COMPLETE_DO_NOT_PROCESS>>' # return this means the job shouldn't be processed - complete and move on
     __job_updated_time = None
     _update_interval = 30 # seconds
+    __blocks_left = 0 # _thread_block calls till the clock is looked at again
+    _checkpoint_every = 1 # look at the clock every N _thread_block calls
+    _checkpoint_jitter = None # fraction of _update_interval checkpoints come early by
+    _checkpoints = None # job_id: (start_value,end_value) for the checkpointer
+    _checkpoint_lock = None # for _checkpoints
+    _checkpoint_write_lock = None # held while writing checkpoints
+    _checkpointer = None # thread writing checkpoints (async_checkpoints)
+    _checkpoint_event = None # set when there are checkpoints to write
+    _checkpointer_stop = None
 
     def __init__(self,job,db,**keys):
         """
         params (required):
             job: the job type the thread should process; the same job_type for MyDb.add_job(...)
+                Or several: a dict of {job_type: weight} or a list of
+                job_types (weight 1 each).  Their queues take turns
+                (deficit round-robin) and each gets jobs in proportion to
+                its weight while it has any - the thread only waits when
+                they're all empty.  get_job_type() is the current job's.
             db: the db object to interface with (similar to MyDb)
+        keys:
+            batch=1: the number of jobs to get from the db at a time
+            batch_complete=False: if True, jobs completed in a batch are
+                removed from the db together (one remove_jobs call and one
+                _flush_files call per batch) instead of one by one.
+            processes=None: run _process_item in a pool of this many
+                processes (batch defaults to it so each gets a job).
+            batch_target=None: seconds each batch should take.  If set,
+                each batch's size is picked from the average time per job
+                (starting at batch), never more than half the queue (the
+                rest is left for other threads).
+            batch_min=1: the smallest batch (batch_target only).
+            batch_max=1000: the largest batch (batch_target only).
+            checkpoint_every=1: _thread_block only looks at the clock (and
+                for interrupts) every this many calls - the rest just save
+                the start_value.  For tight loops calling it every record.
+            checkpoint_jitter=.1: checkpoints come up to this fraction of
+                _update_interval early (at random), so threads started
+                together don't all write at once.
+            async_checkpoints=False: if True, _update_if_needed's
+                checkpoints are written to the db by a background thread
+                (files are still flushed right away).  They're all written
+                before the job's completed, failed or saved (flush=True).
         """
         # init logging base
         MyLoggingBase.__init__(self)
         
         # set my_id - unique identifier - and thread name (also unique)
         self._my_id = id(self)
-        self._thread_name = '{}{}'.format(job[:2],self.get_my_id())
+        if isinstance(job,basestring): weights = [(job,1)]
+        elif isinstance(job,dict): weights = sorted(job.iteritems())
+        else: weights = [(j,1) for j in job]
+        if not weights or min(w for j,w in weights) <= 0:
+            raise ValueError('job needs at least one job_type, all with weights > 0')
+        least = float(min(w for j,w in weights))
+        self._job_types = [(j,w/least) for j,w in weights]
+        self._job = weights[0][0]
+        if len(weights) > 1:
+            self._deficits = dict.fromkeys((j for j,w in weights),0)
+            self._wait_key = tuple(j for j,w in weights)
+        else: self._wait_key = self._job
+        self._thread_name = '{}{}'.format(self._job[:2],self.get_my_id())
         
         # init threading things...
         threading.Thread.__init__(self,name=self.get_thread_name())
         
         # set vars
         self._db = db
-        self._batch_size = keys.pop('batch',1)
-        self._job = job
+        processes = keys.pop('processes',None)
+        self._batch_size = keys.pop('batch',processes or 1)
+        self._batch_complete = keys.pop('batch_complete',False)
+        self._batch_target = keys.pop('batch_target',None)
+        self._batch_min = keys.pop('batch_min',1)
+        self._batch_max = keys.pop('batch_max',1000)
+        self._batch_stats = {}
+        self._metrics_by_type = dict((j,MyJobMetrics(j)) for j,w in weights)
+        self._metrics = self._metrics_by_type[self._job]
+        self._jobs_running = {}
+        self._jobs_drained = {}
+        self._checkpoint_every = keys.pop('checkpoint_every',1)
+        self._checkpoint_jitter = keys.pop('checkpoint_jitter',.1)
+        if keys.pop('async_checkpoints',False):
+            self._checkpoints = {}
+            self._checkpoint_lock = threading.Lock()
+            self._checkpoint_write_lock = threading.Lock()
+            self._checkpoint_event = threading.Event()
+            self._checkpointer_stop = False
         self._total_rows = 0
         self._jobs_completed = 0
         
         # make sure our run loop will loop... !
         self._interupt_process = False
+        self._waiting = False
         self._continue_waiting = True
         self._continue_looping = True
+        
+        # the pool is started now, not in run(): forking from a running
+        # thread could copy locks other threads are holding
+        if processes:
+            self._progress = SimpleQueue()
+            self._pool_interrupt = multiprocessing.Event()
+            self._pool = multiprocessing.Pool(processes,_init_process,
+                                    (self._progress,self._pool_interrupt))
     
     #===========================================================================
     #============================ GETTERS / SETTERS ============================
@@ -85,16 +206,37 @@ class MyThread(MyLoggingBase,threading.Thread):
         return self._my_id
     
     def get_job_type(self):
-        """returns the job type this thread does; find __init__ for more."""
+        """returns the job type this thread does (the current job's, if it
+        does several); find __init__ for more."""
         return self._job
     
+    def get_job_types(self):
+        """returns the job types this thread does, in turn order."""
+        return [j for j,q in self._job_types]
+    
+    def get_metrics(self,job_type=None):
+        """returns the thread's MyJobMetrics (timings and counters) for
+        job_type (default its first) - see MyJobMetrics.merged(...) to add
+        up several threads'."""
+        return self._metrics_by_type[job_type if job_type is not None
+                                     else self._job_types[0][0]]
+    
+    def is_waiting(self):
+        """returns True if the thread is idle - waiting for jobs."""
+        return self._waiting
+    
     #===========================================================================
     #========================= Thread Getters / Setters ========================
     #===========================================================================
     def __issue_stop(self,i):
-        """add something to the queue to wake up the thread"""
+        """wake up the thread if it's waiting for jobs"""
         #if i not in (self._CTRL_QUEUE,self._CTRL_JOB,self._CTRL_INTERRUPT)
-        self._db.get_event().set()
+        self._db.wake_up(self._wait_key)
+    
+    def _stop_waiting(self):
+        """returns True if the thread shouldn't wait for more jobs. Checked by
+        the db while holding the queue lock so a stop can't be missed."""
+        return not (self._continue_waiting and self._continue_looping)
     
     def stop(self,wait_for_empty_queue=True):
         """stops the thread, either when the queue is empty or right away
@@ -118,6 +260,7 @@ class MyThread(MyLoggingBase,threading.Thread):
         """Kills the thread ASAP!"""
         self._continue_looping = False
         self._interupt_process = True
+        if self._pool_interrupt is not None: self._pool_interrupt.set()
         self.__issue_stop(self._CTRL_INTERRUPT)
     
     #===========================================================================
@@ -132,10 +275,13 @@ class MyThread(MyLoggingBase,threading.Thread):
         while self._continue_looping:
             
             # is there another job to do?
-            try: items = self._db.get_next_jobs(self.get_job_type(),
-                                               count=self._batch_size)
+            self._fetched_at = time.time()
+            try: items = self._next_jobs()
             except StopIteration:
-                if self._continue_waiting: self._db.get_event().wait()
+                if self._continue_waiting:
+                    self._waiting = True
+                    self._db.wait_for_jobs(self._wait_key,until=self._stop_waiting)
+                    self._waiting = False
                 else:
                     self.logger.debug('queue is empty, and I am not waiting!')
                     break
@@ -146,6 +292,7 @@ class MyThread(MyLoggingBase,threading.Thread):
                 else:
                     
                     self._process_items(items)
+                    self._batch_done(len(items),time.time()-self._fetched_at)
                     '''
                     # start the job
                     self.__job_updated_time = job_start_time = time.clock()
@@ -194,6 +341,8 @@ class MyThread(MyLoggingBase,threading.Thread):
                       '''
         # give us a change to finish a few things if needed
         self._after_looping()
+        self._stop_pool()
+        self._stop_checkpointer()
     
     #===========================================================================
     #========== Things that should/can be Overwritten When Inherited ===========
@@ -209,45 +358,242 @@ class MyThread(MyLoggingBase,threading.Thread):
         """
         return self._DUMMY_END_VALUE
     
+    def _next_batch_size(self):
+        """the number of jobs to get next: batch, or with batch_target, as
+        many as should take batch_target seconds (within batch_min and
+        batch_max), but no more than half of what's in the queue."""
+        if self._batch_target is None: return self._batch_size
+        if self._item_time is None: n = self._batch_size
+        elif self._item_time: n = int(self._batch_target/self._item_time)
+        else: n = self._batch_max
+        queued = self._db.get_queue_size(self.get_job_type())
+        if queued: n = min(n,(queued+1)//2)
+        return max(self._batch_min,min(n,self._batch_max))
+    
+    def _next_jobs(self,count=None):
+        """gets the next batch of jobs (count, default _next_batch_size()).
+        For several job_types it's deficit round-robin: each job_type's turn
+        it can get its quantum (weight/smallest weight) of batches, then the
+        next one's turn comes.  Empty ones lose their turn (and what they
+        had left of it).  Sets the current job_type.  Raises StopIteration if
+        all the queues are empty."""
+        if self._deficits is None:
+            return self._db.get_next_jobs(self._job,count=count or self._next_batch_size())
+        empty = 0
+        while empty < len(self._job_types):
+            job_type,quantum = self._job_types[self._turn]
+            self._job = job_type
+            self._metrics = self._metrics_by_type[job_type]
+            size = count or self._next_batch_size()
+            if self._deficits[job_type] < 1: self._deficits[job_type] += quantum*size
+            n = min(size,int(self._deficits[job_type]))
+            try: items = self._db.get_next_jobs(job_type,count=n)
+            except StopIteration: items = ()
+            if items:
+                self._deficits[job_type] -= len(items)
+                if len(items) < n: self._deficits[job_type] = 0 # emptied it
+                if self._deficits[job_type] < 1:
+                    self._turn = (self._turn+1)%len(self._job_types)
+                return items
+            self._deficits[job_type] = 0
+            self._turn = (self._turn+1)%len(self._job_types)
+            empty += 1
+        raise StopIteration
+    
+    def _batch_done(self,n,seconds):
+        """records a batch of n jobs that took seconds (getting and
+        processing them) for the average time per job and the summary."""
+        if not n: return
+        t = seconds/n
+        self._item_time = t if self._item_time is None else .7*self._item_time+.3*t
+        stats = self._batch_stats.setdefault(1<<(n.bit_length()-1),[0,0,0.])
+        stats[0] += 1
+        stats[1] += n
+        stats[2] += seconds
+    
     def _process_items(self,items):
         """ For batch sizes>1, override this method.
-        items is a iterable object 
+        items is a iterable object.  If batch_complete, the completed jobs are
+        removed from the db when the batch is done (or stopped by an error).
         """
+        completed = [] if self._batch_complete else None
+        try:
+            if self._pool is not None:
+                self._process_pool_jobs([list(i) for i in items],completed)
+            else:
+                for item in (list(i) for i in items):
+                    self._process_job(item,completed)
+        finally:
+            if completed: self._complete_jobs(*zip(*completed))
+    
+    def _process_job(self,item,completed=None):
+        """processes one job (item).  If completed is a list, (job_id,rows) is
+        appended to it when the job is done instead of removing it right away.
+        """
+        # some logging
+        self.logger.debug('starting job %s with id=%s',
+                          item[self._db.JOB_ID],
+                          item[self._db.ITEM_ID])
         
+        # start the job
+        started = time.time()
+        self._metrics.queue_wait.add(started-(self._fetched_at or started))
+        self._reset_update_time()
+        self.__current_job_id = item[self._db.JOB_ID]
+        self._jobs_running[self.__current_job_id] = False
         
-        for item in (list(i) for i in items):
-            # some logging
-            self.logger.debug('starting job %s with id=%s',
-                          self.__current_job_id,
-                          item[self._db.ITEM_ID])
-            
-            # start the job
-            self.__job_updated_time = job_start_time = time.clock()
-            self.__current_job_id = item[self._db.JOB_ID]
-            
+        # look in db to see what the end value should be (only if end_value isn't set)
+        if item[self._db.END_VALUE] is None:
+            # add it item to pass to process_item
+            item[self._db.END_VALUE] = self.__current_job_end_v = self._find_job_end_value(*item[1:])
+        
+        if item[self._db.END_VALUE] == self._DUMMY_END_VALUE:
+            item[self._db.END_VALUE] = None
+        
+        if item[self._db.END_VALUE] == self._END_JOB:
+            job_completed,rows = True,0
+        else:
+            # process item
             job_completed,rows = self._process_item(*item[1:]) #item_id,init_data,start_value,end_value
                     
-            # track total rows
-            self._total_rows += rows
-            
-            job_id = self.__current_job_id
-            job_end_time = time.clock() # get time of completed job
-            # handle if job was successful
-            if job_completed:
-                # done processing task
-                self._complete_job() # flush files and update db
-                self._jobs_completed += 1 # track number of jobs
-                # log stats
-                self.logger.debug('job %s completed, %03d rows, %f seconds',
-                                                   job_id,rows,job_end_time-job_start_time)
+        # track total rows
+        self._total_rows += rows
+        
+        job_id = self.__current_job_id
+        ended = time.time() # get time of completed job
+        self._metrics.process.add(ended-started)
+        failed = not (job_completed or self._interupt_process)
+        # handle if job was successful
+        if job_completed:
+            # done processing task
+            if completed is None:
+                self._complete_job(rows) # flush files and update db
             else:
-                #self._update_current_job()
+                completed.append((job_id,rows))
                 self.__current_job_id = None
-                # log stats
-                self.logger.debug('job %s failed, %03d rows, %f seconds',
-                                                   job_id,rows,job_end_time-job_start_time)
-                
+            self._jobs_completed += 1 # track number of jobs
+            # log stats
+            self.logger.debug('job %s completed, %03d rows, %f seconds',
+                                               job_id,rows,ended-started)
+        else:
+            # interrupted jobs are picked up again later - they didn't fail
+            if failed: self._fail_job()
+            else: self.__current_job_id = None
+            # log stats
+            self.logger.debug('job %s failed, %03d rows, %f seconds',
+                                               job_id,rows,ended-started)
+        self._metrics.job_done(started,ended,rows,job_completed,failed)
+        self._job_ended(job_id,'completed' if job_completed else
+                               'failed' if failed else None)
                 
+    def _process_pool_jobs(self,items,completed=None):
+        """processes the jobs (items) in the pool (processes=N): the end
+        values are found here, then each job's _process_item is sent to the
+        pool.  Checkpoints, added jobs and results come back in order on one
+        queue: each is applied as it comes.  If one raises, the pool's
+        terminated (the rest of the batch is left as it was saved) and the
+        error's raised."""
+        running = {} # job_id: when it was sent to the pool
+        pids = {} # job_id: the pool process running it
+        for item in items:
+            job_id = item[self._db.JOB_ID]
+            started = time.time()
+            self._metrics.queue_wait.add(started-(self._fetched_at or started))
+            self.logger.debug('starting job %s with id=%s',job_id,item[self._db.ITEM_ID])
+            if item[self._db.END_VALUE] is None:
+                item[self._db.END_VALUE] = self._find_job_end_value(*item[1:])
+            if item[self._db.END_VALUE] == self._DUMMY_END_VALUE:
+                item[self._db.END_VALUE] = None
+            if item[self._db.END_VALUE] == self._END_JOB:
+                self._job_finished(job_id,True,0,completed,started)
+            else:
+                state = dict(self._get_process_state(),_job=self._job,
+                             _checkpoint_every=self._checkpoint_every)
+                self._pool.apply_async(_run_in_process,(type(self),
+                                       state,job_id,item[1:]))
+                running[job_id] = started
+                self._jobs_running[job_id] = False
+        
+        try:
+            while running:
+                kind,job_id,data = self._get_progress(running,pids,completed)
+                if kind is None: continue # (a job died)
+                if kind == _PROGRESS_START: pids[job_id] = data
+                elif kind == _PROGRESS_UPDATE:
+                    self.__current_job_start_v,end_value,flush = data
+                    self._db.update_job(job_id,self.__current_job_start_v,
+                                        end_value,flush=flush)
+                    self._flush_files()
+                    if self._interupt_process: self._jobs_running[job_id] = True
+                elif kind == _PROGRESS_ADD: self._add_job(*data[0],**data[1])
+                else:
+                    started = running.pop(job_id)
+                    pids.pop(job_id,None)
+                    if kind == _PROGRESS_ERROR: raise data
+                    self._job_finished(job_id,data[0],data[1],completed,started)
+        except BaseException:
+            self._stop_pool(terminate=True)
+            raise
+    
+    def _get_progress(self,running,pids,completed=None):
+        """(processes=N) returns the next (kind,job_id,data) from the pool.
+        While there isn't one, it checks every _POOL_POLL seconds that the
+        processes running jobs are alive: a job whose process died (killed,
+        segfault) never sends its result, so it's failed (kind is None)."""
+        # (SimpleQueue has no get timeout - poll its pipe)
+        while not self._progress._reader.poll(self._POOL_POLL):
+            alive = set(p.pid for p in self._pool._pool if p.is_alive())
+            for job_id,pid in pids.items():
+                if pid in alive: continue
+                self.logger.error('job %s died with its pool process (pid %s)',
+                                  job_id,pid)
+                del pids[job_id]
+                self._pool_broken = True
+                self._job_finished(job_id,False,0,completed,running.pop(job_id))
+                return None,job_id,None
+        return self._progress.get()
+    
+    def _job_finished(self,job_id,job_completed,rows,completed=None,started=None):
+        """(processes=N) the pool's done with job_id (started when it was
+        sent): completes it (or adds it to completed) or fails it, the same
+        as _process_job."""
+        ended = time.time()
+        if started is None: started = ended
+        self._metrics.process.add(ended-started)
+        failed = not (job_completed or self._interupt_process)
+        self._metrics.job_done(started,ended,rows,job_completed,failed)
+        self._total_rows += rows
+        if job_completed:
+            if completed is None: self._complete_jobs((job_id,),(rows,))
+            else: completed.append((job_id,rows))
+            self._jobs_completed += 1
+            self.logger.debug('job %s completed, %03d rows',job_id,rows)
+        else:
+            # (left queued if the db doesn't retry them - see _fail_job)
+            if failed and self._db.retries_failed_jobs(): self._db.failed_job(job_id)
+            self.logger.debug('job %s failed, %03d rows',job_id,rows)
+        self._job_ended(job_id,'completed' if job_completed else
+                               'failed' if failed else None)
+    
+    def _job_ended(self,job_id,outcome=None):
+        """job_id isn't running anymore.  If interrupted, keeps how it ended
+        for drains: outcome (completed or failed), else saved (checkpointed
+        since the interrupt) or interrupted (progress since its last
+        checkpoint is lost)."""
+        saved = self._jobs_running.pop(job_id,False)
+        if self._interupt_process:
+            self._jobs_drained[job_id] = outcome or ('saved' if saved else 'interrupted')
+    
+    def _stop_pool(self,terminate=False):
+        """closes the pool (processes=N) and waits for its processes (stops
+        them right away if terminate - or if a job died: close would wait
+        for its result forever)."""
+        pool,self._pool = self._pool,None
+        if pool is not None:
+            if terminate or self._pool_broken: pool.terminate()
+            else: pool.close()
+            pool.join()
+    
     def _process_item(self,item_id,init_data=None,
                       start_value=None,end_value=None):
         """
@@ -268,6 +614,12 @@ class MyThread(MyLoggingBase,threading.Thread):
         """
         return True,0
     
+    def _get_process_state(self):
+        """(processes=N) returns a dict of the attributes _process_item needs,
+        set on the copy it runs on in the pool (they have to pickle).  The
+        default is none - override to pass your settings along."""
+        return {}
+    
     def _before_looping(self):
         """the first method called by .run(), this method is the first
         to be run by the thread when it starts.  You should override and
@@ -294,6 +646,12 @@ class MyThread(MyLoggingBase,threading.Thread):
         a.extend(['jobs completed: {:,}'.format(self._jobs_completed),
                 'last data: {}'.format(self.__current_job_start_v),
                 'total rows: {:,}'.format(self._total_rows)])
+        for job_type,m in sorted(self._metrics_by_type.iteritems()):
+            a.extend(m.get_summary_info())
+        # batch sizes and how fast each went
+        for size,(batches,jobs,seconds) in sorted(self._batch_stats.iteritems()):
+            a.append('batches of {}-{}: {:,} ({:,} jobs, {:,.1f} jobs/sec)'.format(
+                     size,2*size-1,batches,jobs,jobs/(seconds or 1e-9)))
         return a
     
     #===========================================================================
@@ -303,8 +661,13 @@ class MyThread(MyLoggingBase,threading.Thread):
         """saves the start_value and updates if needed.  You just need to calls
         this method whenever the start_vlaue has changed to update if needed
         and check if you've been told to stop - interrupted.  returns True if
-        you've been interrupted, False otherwise."""
-        self._update_start_value(start_value)
+        you've been interrupted, False otherwise.
+        With checkpoint_every=N, only every Nth call does more than save the
+        start_value."""
+        self.__current_job_start_v = start_value
+        self.__blocks_left -= 1
+        if self.__blocks_left > 0: return False
+        self.__blocks_left = self._checkpoint_every
         if self._check_for_interrupt(): return True
         else: self._update_if_needed()
         return False
@@ -328,14 +691,21 @@ class MyThread(MyLoggingBase,threading.Thread):
         Returns False otherwise."""
         if self._interupt_process:
             self.logger.warning("we've been interrupted!")
-            self._update_current_job()
+            self._update_current_job(flush=True)
             return True
         else: return False
         
     def _update_if_needed(self):
         """updates the db if needed (self._update_interval time has passed)."""
-        if time.clock() - self.__job_updated_time > self._update_interval:
-            self._update_current_job()
+        if _monotonic() - self.__job_updated_time > self._update_interval:
+            self._update_current_job(flush=False if self._checkpoints is not None else None)
+    
+    def _reset_update_time(self):
+        """the job's just been saved (or started): the next checkpoint is
+        due in _update_interval, less up to checkpoint_jitter of it."""
+        self.__job_updated_time = _monotonic()-(random.random()*
+                                    self._checkpoint_jitter*self._update_interval
+                                    if self._checkpoint_jitter else 0)
                
     #===========================================================================
     # Before Raising Error
@@ -345,7 +715,7 @@ class MyThread(MyLoggingBase,threading.Thread):
         the current job's progress."""
         self.logger.warning("oops... well, I'll save my progress i guess...")
         # save progress!
-        self._update_current_job()
+        self._update_current_job(flush=True)
 
     #===========================================================================
     # Waiting Wrap
@@ -358,46 +728,135 @@ class MyThread(MyLoggingBase,threading.Thread):
     def _after_waiting(self):
         """call method after doing a wait. It updates the job updated time
         so we don't update more than needed."""
-        self.__job_updated_time = time.clock()
+        self._reset_update_time()
                  
     #===========================================================================
     #=============================== Job Things ================================
     #===========================================================================
-    def _complete_job(self):
-        """Tells the db the job is finished/complete and flush files"""
+    def _complete_job(self,rows=None):
+        """Flush files and tells the db the job is finished/complete"""
         #if there is a job being worked on...
         if self.__current_job_id is not None:
-            # updated db
-            self._db.remove_job(self.__current_job_id)
-            self.__current_job_id = None
-            # flush files
-            self._flush_files()
+            job_id,self.__current_job_id = self.__current_job_id,None
+            self._complete_jobs((job_id,),(rows,))
+    
+    def _fail_job(self):
+        """tells the db the current job failed - it's retried (after the db's
+        backoff) or dead once it's out of attempts (see MyDb max_attempts).
+        If the db doesn't retry failed jobs, it's only updated and left
+        queued (it's tried again once the db's reopened)."""
+        if self.__current_job_id is not None:
+            if not self._db.retries_failed_jobs():
+                self._update_current_job()
+                self.__current_job_id = None
+                return
+            job_id,self.__current_job_id = self.__current_job_id,None
+            self.__current_job_end_v = None
+            self._write_checkpoints()
+            self._db.failed_job(job_id)
+    
+    def _complete_jobs(self,job_ids,rows=None):
+        """Flush files and tells the db the jobs are finished/complete (files
+        are flushed first so they have everything before the jobs are gone).
+        rows is the number of rows processed for each job (for the db's
+        history)."""
+        t = time.time()
+        # flush files
+        self._flush_files()
+        # updated db (after any checkpoints still being written)
+        self._write_checkpoints()
+        if rows is None: self._db.remove_jobs(job_ids)
+        else: self._db.remove_jobs(job_ids,dict(zip(job_ids,rows)))
+        self._metrics.complete.add(time.time()-t)
           
     #===========================================================================
     # Update Job    
     #===========================================================================
-    def _update_current_job(self):
+    def _update_current_job(self,flush=None):
         """updates the current job with start_value and end_value
-        and flushes the files files (see self._flush_files()."""
+        and flushes the files files (see self._flush_files().
+        flush=True makes sure the db has it before returning, even if the db
+        buffers checkpoints (see MyDb checkpoint_delay).  flush=False hands
+        it to the checkpointer thread if async_checkpoints."""
         self.logger.info('updating job %s with data %r',self.__current_job_id,
                          self.__current_job_start_v)
         
         if self.__current_job_id is not None:
+            t = time.time()
             #update db (update end_time if able)
-            if self.__current_job_end_v is None:
-                self._db.update_job(self.__current_job_id,
-                                    self.__current_job_start_v)
-            else:
-                self._db.update_job(self.__current_job_id,
-                                    self.__current_job_start_v,
-                                    self.__current_job_end_v)
+            if self._checkpoints is not None and flush is False:
+                # the checkpointer writes it
+                self._put_checkpoint(self.__current_job_id,
+                            self.__current_job_start_v,self.__current_job_end_v)
                 self.__current_job_end_v = None
+            else:
+                # written now - after any the checkpointer has
+                self._write_checkpoints()
+                if self.__current_job_end_v is None:
+                    self._db.update_job(self.__current_job_id,
+                                        self.__current_job_start_v,flush=flush)
+                else:
+                    self._db.update_job(self.__current_job_id,
+                                        self.__current_job_start_v,
+                                        self.__current_job_end_v,flush=flush)
+                    self.__current_job_end_v = None
+            # saved after an interrupt? (see drain_threads)
+            if self._interupt_process and self.__current_job_id in self._jobs_running:
+                self._jobs_running[self.__current_job_id] = True
             
             # flush files
             self._flush_files()
             
             # save time
-            self.__job_updated_time = time.clock()
+            self._reset_update_time()
+            self._metrics.checkpoint.add(time.time()-t)
+    
+    #===========================================================================
+    # Async Checkpoints
+    #===========================================================================
+    def _put_checkpoint(self,job_id,start_value,end_value=None):
+        """(async_checkpoints) hands the checkpoint to the checkpointer
+        thread (starting it if needed) - only the last per job is kept."""
+        with self._checkpoint_lock:
+            prev = self._checkpoints.get(job_id)
+            if end_value is None and prev is not None: end_value = prev[1]
+            self._checkpoints[job_id] = (start_value,end_value)
+        if self._checkpointer is None:
+            self._checkpointer = threading.Thread(target=self._checkpoint_loop,
+                                        name=self.get_thread_name()+'Checkpointer')
+            self._checkpointer.daemon = True
+            self._checkpointer.start()
+        self._checkpoint_event.set()
+    
+    def _write_checkpoints(self):
+        """(async_checkpoints) writes the checkpoints waiting for the
+        checkpointer (or waits for the one it's writing) - call before
+        anything that has to come after them."""
+        if self._checkpoints is None: return
+        with self._checkpoint_write_lock:
+            with self._checkpoint_lock:
+                checkpoints,self._checkpoints = self._checkpoints,{}
+            for job_id,(start_value,end_value) in checkpoints.iteritems():
+                self._db.update_job(job_id,start_value,end_value)
+    
+    def _checkpoint_loop(self):
+        """(checkpointer thread) writes checkpoints as they're handed off."""
+        while not self._checkpointer_stop:
+            self._checkpoint_event.wait()
+            self._checkpoint_event.clear()
+            try: self._write_checkpoints()
+            except Exception as e:
+                self.logger.warning('writing checkpoints failed %r',e)
+    
+    def _stop_checkpointer(self):
+        """writes any checkpoints left and stops the checkpointer thread."""
+        self._write_checkpoints()
+        checkpointer,self._checkpointer = self._checkpointer,None
+        if checkpointer is not None:
+            self._checkpointer_stop = True
+            self._checkpoint_event.set()
+            checkpointer.join()
+            self._checkpointer_stop = False
 
     #===========================================================================
     # Add Job
@@ -413,9 +872,15 @@ class MyThread(MyLoggingBase,threading.Thread):
             init_data=None: a number, compared if a similar job is started to
                 determine if adding the job is necessary.  None means it's
                 necessary.  
+            priority=0: higher priority jobs are handed out first.
+            run_at=None: a time (time.time()) the job shouldn't start before.
+            after=None: job_ids that have to be done before the job starts.
         """
         # add job to db and get job_id
-        job_id = self._db.add_job(item_id,job_type,init_data)
+        job_id = self._db.add_job(item_id,job_type,init_data,
+                                  priority=keys.get('priority',0),
+                                  run_at=keys.get('run_at'),
+                                  after=keys.get('after'))
         
         # log if the job failed to be added
         if job_id is None:
@@ -423,7 +888,67 @@ class MyThread(MyLoggingBase,threading.Thread):
                               item_id,job_type,init_data)
             return False
         else: return True
+    
+    def _add_jobs(self,items):
+        """Adds many jobs in one go (one transaction) - items are the
+        (item_id,job_type[,init_data[,priority[,run_at[,after]]]]) tuples
+        MyDb.add_jobs takes.  Returns the list of new job_ids."""
+        return self._db.add_jobs(items)
+
+
+#===============================================================================
+# Process Pool (processes=N) - these run in the pool's processes
+#===============================================================================
+# (kind,job_id,data) sent on the queue
+_PROGRESS_UPDATE,_PROGRESS_ADD,_PROGRESS_DONE,_PROGRESS_ERROR,_PROGRESS_START = 0,1,2,3,4
+_progress = None # queue to send checkpoints/added jobs/results to the thread
+_interrupt = None # Event set when the thread's interrupted
+_workers = {} # MyThread subclass: its _ProcessWorker subclass
+
+def _init_process(progress,interrupt):
+    """the pool's initializer: keeps the queue and Event from the thread."""
+    global _progress,_interrupt
+    _progress,_interrupt = progress,interrupt
 
+def _run_in_process(cls,state,job_id,args):
+    """runs cls's _process_item(*args) for job_id on a stand-in object and
+    sends back (job_completed,rows) - or the error, as a RuntimeError with
+    the traceback (not every error pickles)."""
+    _progress.put((_PROGRESS_START,job_id,os.getpid()))
+    try:
+        try: worker_cls = _workers[cls]
+        except KeyError:
+            worker_cls = _workers[cls] = type(cls.__name__,(_ProcessWorker,cls),{})
+        worker = worker_cls(job_id,args[2],args[3])
+        worker.__dict__.update(state)
+        _progress.put((_PROGRESS_DONE,job_id,worker._process_item(*args)))
+    except Exception:
+        _progress.put((_PROGRESS_ERROR,job_id,RuntimeError('job {} failed in '
+                        'the pool:\n{}'.format(job_id,traceback.format_exc()))))
+
+class _ProcessWorker(object):
+    """mixed in front of a MyThread subclass in the pool's processes: no
+    thread or db - checkpoints and added jobs are sent back to the thread,
+    and it's interrupted when the thread is."""
+    _interupt_process = property(lambda self: _interrupt.is_set())
+    
+    def __init__(self,job_id,start_value,end_value):
+        MyLoggingBase.__init__(self)
+        self._job_id = job_id
+        self._MyThread__current_job_start_v = start_value
+        self._MyThread__current_job_end_v = end_value
+        self._MyThread__job_updated_time = _monotonic()
+    
+    def _update_current_job(self,flush=None):
+        _progress.put((_PROGRESS_UPDATE,self._job_id,
+                       (self._MyThread__current_job_start_v,
+                        self._MyThread__current_job_end_v,flush)))
+        self._MyThread__current_job_end_v = None
+        self._MyThread__job_updated_time = _monotonic()
+    
+    def _add_job(self,*args,**keys):
+        _progress.put((_PROGRESS_ADD,self._job_id,(args,keys)))
+        return True
 
 #===============================================================================
 # Main
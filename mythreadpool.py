@@ -0,0 +1,319 @@
+"""
+2026-10-18
+a pool of MyThreads (per job_type) that grows and shrinks with the backlog
+"""
+from myloggingbase import MyLoggingBase
+from mymetrics import MyJobMetrics
+from mythread import _monotonic
+import threading
+import time
+import math
+import json
+
+class _Workers(object):
+    """the threads (and numbers) for one job_type in a MyThreadPool"""
+    def __init__(self,job_type,cls,min_threads,max_threads,keys):
+        self.cls = cls
+        self.min_threads = min_threads
+        self.max_threads = max_threads
+        self.keys = keys
+        self.threads = [] # running (and retiring) threads
+        self.retiring = set() # told to stop_after_job
+        self.idle_since = {} # thread: when it was first seen waiting
+        self.started = 0
+        self.retired = 0
+        self.peak = 0 # most threads (not retiring) at once
+        self.jobs_done = 0 # jobs completed by threads that have finished
+        self.metrics = MyJobMetrics(job_type) # ...and their metrics
+
+class MyThreadPool(MyLoggingBase):
+    """
+    Owns the MyThreads for each job_type (add_workers) and scales them
+    between min_threads and max_threads: the supervisor thread checks every
+    interval seconds and starts as many as should get through the backlog
+    (the jobs ready to run - not parked by run_at or blocked by after) in
+    drain_time seconds at the seconds per job the threads are seeing, as
+    long as none are idle.  Threads idle (waiting for jobs) for idle_time
+    seconds are retired (stop_after_job) down to what's needed.
+    Use it like a thread: start(), stop(...) and join().  After
+    stop(wait_for_empty_queue=True) it keeps scaling till the backlog's done.
+    For restarts, drain(timeout) stops everything within timeout seconds and
+    reports what was saved.
+    """
+    _db = None
+    _types = None # job_type: _Workers
+    _lock = None # for _types
+
+    _interval = None # seconds between checks
+    _drain_time = None # seconds the backlog should take
+    _idle_time = None # seconds a thread is idle before it's retired
+
+    _supervisor = None # the thread doing the scaling
+    _stop_event = None # set to stop the supervisor
+    _stopping = None # True once stop(...) is called - threads stop when the queue's empty
+    _start_time = None
+    _end_time = None
+    _last_drain = None # drain(...)'s report
+
+    def __init__(self,db,**keys):
+        """
+        params (required):
+            db: the db object the threads share (similar to MyDb)
+        keys:
+            interval=1: seconds between checking the backlog.
+            drain_time=60: seconds the backlog should be done in - the
+                number of threads aimed for is backlog*seconds per job/drain_time.
+            idle_time=10: seconds a thread waits for jobs before it's retired
+                (if there are more than needed).
+        """
+        MyLoggingBase.__init__(self)
+        self._db = db
+        self._interval = keys.pop('interval',1)
+        self._drain_time = keys.pop('drain_time',60)
+        self._idle_time = keys.pop('idle_time',10)
+        self._types = {}
+        self._lock = threading.RLock()
+        self._stop_event = threading.Event()
+        self._stopping = False
+
+    #===========================================================================
+    #============================ GETTERS / SETTERS ============================
+    #===========================================================================
+    def add_workers(self,job_type,cls,min_threads=1,max_threads=None,**keys):
+        """the pool runs min_threads to max_threads (min_threads if None) cls
+        threads - cls(job_type,db,**keys) - for job_type.  They're started
+        now if the pool has been."""
+        with self._lock:
+            self._types[job_type] = _Workers(job_type,cls,min_threads,
+                        min_threads if max_threads is None else max_threads,keys)
+            if self._supervisor is not None: self._scale(job_type)
+
+    def get_workers(self,job_type=None):
+        """returns the threads running for job_type (all if None), not
+        counting ones that have been retired."""
+        with self._lock:
+            return [t for k,w in self._types.iteritems()
+                    if job_type is None or k == job_type
+                    for t in w.threads if t not in w.retiring]
+
+    def get_metrics(self):
+        """returns {job_type: MyJobMetrics} - every thread's (finished ones
+        too) added up."""
+        with self._lock:
+            return MyJobMetrics.merged([w.metrics for w in self._types.itervalues()]+
+                [t.get_metrics() for w in self._types.itervalues() for t in w.threads])
+
+    def export_metrics(self,filename):
+        """writes a snapshot of the metrics (see MyJobMetrics.to_dict) to a
+        json file: {"time": time.time(), "job_types": {job_type: metrics}}.
+        Returns the snapshot."""
+        snapshot = {'time':time.time(),
+                    'job_types':dict((k,m.to_dict())
+                                     for k,m in self.get_metrics().iteritems())}
+        with open(filename,'wb') as f: json.dump(snapshot,f,indent=1,sort_keys=True)
+        return snapshot
+
+    #===========================================================================
+    #============================== Start / Stop ===============================
+    #===========================================================================
+    def start(self):
+        """starts min_threads for each job_type and the supervisor."""
+        with self._lock:
+            self._start_time = time.time()
+            for job_type in self._types: self._scale(job_type)
+            self._supervisor = threading.Thread(target=self._supervise,
+                                                name='MyThreadPoolSupervisor')
+            self._supervisor.daemon = True
+            self._supervisor.start()
+
+    def stop(self,wait_for_empty_queue=True):
+        """stops every thread (see MyThread.stop).  If wait_for_empty_queue,
+        threads are still added (and stopped when the queue's empty) till
+        the backlog's done, otherwise scaling stops too."""
+        with self._lock:
+            self._stopping = True
+            if not wait_for_empty_queue: self._stop_event.set()
+            for t in self.get_workers(): t.stop(wait_for_empty_queue)
+
+    def join(self,timeout=None):
+        """waits for every thread to finish (or timeout seconds) - call
+        stop(...) first.  Returns True if they all have."""
+        end = None if timeout is None else time.time()+timeout
+        while True:
+            with self._lock:
+                for job_type in self._types: self._reap(job_type)
+                threads = [t for w in self._types.itervalues() for t in w.threads]
+            if not threads or (end is not None and time.time() >= end): break
+            for t in threads:
+                t.join(None if end is None else max(end-time.time(),0))
+        if threads: return False
+        if self._supervisor is not None:
+            self._supervisor.join(None if end is None else max(end-time.time(),0))
+            if self._supervisor.isAlive(): return False
+        if self._end_time is None: self._end_time = time.time()
+        return True
+
+    def drain(self,timeout=30):
+        """stops scaling and interrupts every thread, giving them timeout
+        seconds to save their jobs (see drain_threads - returns its report,
+        also kept for get_summary_info)."""
+        with self._lock:
+            self._stopping = True
+            self._stop_event.set()
+            threads = [t for w in self._types.itervalues() for t in w.threads]
+        report = self._last_drain = drain_threads(threads,self._db,timeout)
+        self.join(0) # forget the ones that stopped
+        self.logger.info('drained in %.2fs: %s',report['seconds'],
+                         _drain_counts(report))
+        if report['in_progress']:
+            self.logger.warning('%d jobs were still running after %ss: %r',
+                    len(report['in_progress']),timeout,report['in_progress'])
+        return report
+
+    #===========================================================================
+    #================================ Scaling ==================================
+    #===========================================================================
+    def _supervise(self):
+        """(supervisor thread) scales each job_type every interval seconds,
+        till it's stopped or (stopping) every thread has finished."""
+        while not self._stop_event.wait(self._interval):
+            with self._lock:
+                if self._stop_event.is_set(): break # (drained while waiting)
+                if self._stopping:
+                    for job_type in self._types: self._reap(job_type)
+                    if not any(w.threads for w in self._types.itervalues()): break
+                for job_type in self._types:
+                    try: self._scale(job_type)
+                    except Exception as e:
+                        self.logger.warning('scaling %s failed %r',job_type,e)
+
+    def _reap(self,job_type):
+        """forgets job_type's threads that have finished (keeping their
+        numbers).  Assumes you have the lock."""
+        w = self._types[job_type]
+        for t in [t for t in w.threads if not t.isAlive()]:
+            w.threads.remove(t)
+            w.retiring.discard(t)
+            w.idle_since.pop(t,None)
+            w.jobs_done += t._jobs_completed
+            w.metrics.merge(t.get_metrics())
+
+    def _get_backlog(self,job_type):
+        """returns the number of job_type jobs ready to run: queued or
+        waiting (in_queue >= 0), not parked (run_at) or blocked (after)."""
+        counts = (self._db.get_job_counts() or {}).get(job_type,{})
+        return sum(c for in_queue,c in counts.iteritems() if in_queue >= 0)
+
+    def _scale(self,job_type):
+        """starts or retires job_type threads to what the backlog needs.
+        Assumes you have the lock."""
+        self._reap(job_type)
+        w = self._types[job_type]
+        active = [t for t in w.threads if t not in w.retiring]
+
+        # how many should there be?
+        backlog = self._get_backlog(job_type)
+        times = [t._item_time for t in active if t._item_time is not None]
+        if not backlog: target = 0
+        elif times:
+            target = int(math.ceil(backlog*sum(times)/len(times)/self._drain_time))
+        else: target = len(active)+1 # no idea yet - one more
+        target = min(target,backlog,w.max_threads) # (no more than could run)
+        # stopping: only what's needed to finish the backlog
+        if not self._stopping: target = max(w.min_threads,target)
+
+        # who's idle?
+        now = time.time()
+        idle = []
+        for t in active:
+            if t.is_waiting():
+                if now-w.idle_since.setdefault(t,now) >= self._idle_time: idle.append(t)
+            else: w.idle_since.pop(t,None)
+
+        if target > len(active) and not any(t.is_waiting() for t in active):
+            for _ in xrange(target-len(active)):
+                t = w.cls(job_type,self._db,**w.keys)
+                if self._stopping: t.stop()
+                t.start()
+                w.threads.append(t)
+                w.started += 1
+            self.logger.debug('%s: %d more threads (backlog %s)',job_type,
+                              target-len(active),backlog)
+        elif target < len(active) and not self._stopping: # (stopping ones exit)
+            for t in idle[:len(active)-target]:
+                t.stop_after_job()
+                w.retiring.add(t)
+                w.idle_since.pop(t,None)
+                w.retired += 1
+        w.peak = max(w.peak,len(w.threads)-len(w.retiring))
+
+    #===========================================================================
+    # Get Summary info
+    #===========================================================================
+    def get_summary_info(self):
+        """threads and throughput per job_type and for the pool."""
+        a = MyLoggingBase.get_summary_info(self)
+        seconds = ((self._end_time or time.time())-self._start_time
+                   if self._start_time is not None else 0)
+        total = 0
+        with self._lock:
+            for job_type,w in sorted(self._types.iteritems()):
+                done = w.jobs_done+sum(t._jobs_completed for t in w.threads)
+                total += done
+                a.append('{}: {:,} threads ({}-{}, peak {:,}), {:,} started, '
+                         '{:,} retired, {:,} jobs, {:,.1f} jobs/sec'.format(
+                            job_type,len(w.threads)-len(w.retiring),
+                            w.min_threads,w.max_threads,w.peak,w.started,
+                            w.retired,done,done/(seconds or 1e-9)))
+        a.append('pool: {:,} jobs, {:,.1f} jobs/sec'.format(total,
+                                                    total/(seconds or 1e-9)))
+        # timings
+        for job_type,m in sorted(self.get_metrics().iteritems()):
+            a.extend(m.get_summary_info())
+        if self._last_drain is not None:
+            a.append('last drain: {:.2f}s, {}'.format(self._last_drain['seconds'],
+                                                     _drain_counts(self._last_drain)))
+        return a
+
+#===============================================================================
+# Drain
+#===============================================================================
+_DRAIN_OUTCOMES = ('saved','completed','failed','interrupted','in_progress')
+
+def _drain_counts(report):
+    """'n saved, n completed, ...' for a drain report"""
+    return ', '.join('{:,} {}'.format(len(report[k]),k.replace('_',' '))
+                     for k in _DRAIN_OUTCOMES)
+
+def drain_threads(threads,db=None,timeout=30):
+    """
+    interrupts the threads (MyThreads) and waits up to timeout seconds for
+    them to stop - their jobs save themselves (_thread_block or
+    _check_for_interrupt call _update_current_job) - then writes any
+    checkpoints still pending (async_checkpoints and db.flush_updates()).
+    Returns a report of the jobs running when interrupted (or started after):
+        seconds: how long the drain took
+        alive: names of the threads still running at the deadline
+        flushed: pending db checkpoints written at the end
+        saved: job_ids checkpointed after the interrupt
+        completed/failed: job_ids that finished anyway
+        interrupted: job_ids that stopped without saving (they'll redo
+            what they did since their last checkpoint)
+        in_progress: job_ids still running at the deadline (or whose
+            thread died) - their last checkpoint is all that's saved
+    """
+    start = _monotonic()
+    for t in threads: t.interupt()
+    for t in threads: t.join(max(start+timeout-_monotonic(),0))
+    alive = [t for t in threads if t.isAlive()]
+    for t in alive: t._write_checkpoints()
+    flushed = db.flush_updates() if db is not None else 0
+
+    report = dict((k,[]) for k in _DRAIN_OUTCOMES)
+    for t in threads:
+        for job_id,outcome in t._jobs_drained.items(): report[outcome].append(job_id)
+        report['in_progress'].extend(t._jobs_running.keys())
+    for k in _DRAIN_OUTCOMES: report[k].sort()
+    report.update(seconds=_monotonic()-start,flushed=flushed or 0,
+                  alive=[t.get_thread_name() for t in alive])
+    return report
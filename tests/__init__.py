@@ -6,12 +6,17 @@ test classes for pymybase
 
 import testbase
 import test_mydb
+import test_mymemdb
 import test_myloggingbase
 from tests import test_myjson2csv
 import test_mythread
+import test_mygeventthread
+import test_mythreadpool
+import test_mymetrics
 
-__all__ = ['test_myloggingbase','test_mydb','test_mythread',
-           'test_myjson2csv']
+__all__ = ['test_myloggingbase','test_mydb','test_mymemdb','test_mythread',
+           'test_myjson2csv','test_mygeventthread','test_mythreadpool',
+           'test_mymetrics']
 
 def run_test():
     import unittest
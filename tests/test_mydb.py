@@ -112,6 +112,176 @@ class Test_MyDb(TestBase):
         self.assertEqual(item[a.START_VALUE],None,msg="start value isn't the same")
         self.assertEqual(item[a.END_VALUE],None,msg="end value isn't the same")
         
+    def test_add_jobs_bulk(self):
+        """test adding many jobs at once skips duplicates correctly"""
+        a = MyDb(':memory:')
+        
+        # only the first of each item_id,job_type in a batch is added
+        job_ids = a.add_jobs((('1','main',3),('1','main',4),('2','main'),
+                              ('2','main'),('1','sub',1)))
+        self.assertEqual(len(job_ids),3,msg="only 3 jobs should've been added")
+        self.assertEqual(job_ids,sorted(job_ids),msg="job ids should be in order")
+        
+        # the same job hasn't been started, so it isn't added
+        self.assertEqual(a.add_jobs((('1','main',5),)),[],msg="job is already waiting...")
+        
+        # once started, only a newer init_data is added
+        a.get_next_jobs('main',count=2)
+        a.update_job(job_ids[0],'start')
+        new_ids = a.add_jobs((('1','main',3),('1','main',9),('1','main',10)))
+        self.assertEqual(len(new_ids),1,msg="only init_data=9 should've been added")
+        self.assertEqual(a.get_next_job('main')[a.INIT_DATA],9,msg="wrong job queued")
+        self.assertEqual(a._jobs_added_count,4,msg="added count is off")
+        a.close()
+    
+    def test_wal_readers(self):
+        """test reads don't wait on the writer with wal=True"""
+        import threading
+        for fname in (':memory:',self.get_new_file_name('aaa.db')):
+            a = MyDb(fname,wal=True)
+            a.add_jobs((str(i),'main') for i in xrange(10))
+
+            # read from another thread while the writer is locked
+            counts = []
+            with a._lock:
+                t = threading.Thread(target=lambda: counts.append(
+                            (a.get_job_count(),len(list(a.iter_jobs())))))
+                t.start(); t.join(5)
+            self.assertEqual(counts,[(10,10)],msg='{} read was blocked or wrong'.format(fname))
+            
+            # the connections are pooled - not one per thread
+            threads = [threading.Thread(target=a.get_job_count) for _ in xrange(50)]
+            for t in threads: t.start()
+            for t in threads: t.join(5)
+            self.assertLessEqual(len(a._reader_conns),a._readers)
+            self.assertEqual(len(a._reader_idle),len(a._reader_conns))
+            
+            # memory dbs' readers see uncommitted writes, files' don't
+            with a.transaction():
+                a.add_job('new','main')
+                t = threading.Thread(target=lambda: counts.append(a.get_job_count()))
+                t.start(); t.join(5)
+            self.assertEqual(counts[-1],11 if fname == ':memory:' else 10)
+            a.close()
+            self.assertEqual(a._reader_conns,[])
+
+    def test_wait_for_jobs(self):
+        """test adding a job only wakes one waiter of that job_type"""
+        import threading
+        import time
+        a = MyDb(':memory:')
+        for job_type in ('a','b'): # nothing to populate - waiters will wait
+            self.assertRaises(StopIteration,a.get_next_jobs,job_type)
+
+        woke = []
+        def wait(job_type):
+            t = time.time()
+            a.wait_for_jobs(job_type,timeout=2)
+            if time.time()-t < 1: woke.append(job_type)
+        threads = [threading.Thread(target=wait,args=(j,)) for j in 'aaabb']
+        for t in threads: t.start()
+        time.sleep(0.2)
+
+        a.add_job('1','a')
+        for t in threads: t.join()
+        self.assertEqual(woke,['a'],msg='woke up {} instead of one "a"'.format(woke))
+
+        # waiting on several job_types - any of them wakes it
+        threads = [threading.Thread(target=wait,args=(j,)) for j in (('b','c'),)*2]
+        for t in threads: t.start()
+        time.sleep(0.2)
+        a.add_job('1','c')
+        a.wake_up(('b','c'))
+        for t in threads: t.join()
+        self.assertEqual(woke,['a',('b','c'),('b','c')])
+        self.assertTrue(a.wait_for_jobs(('b','c'),timeout=0))
+        a.close()
+
+    def test_checkpoint_buffer(self):
+        """test buffered updates are coalesced and flushed"""
+        import time
+        fname = self.get_new_file_name('aaa.db')
+        a = MyDb(fname,checkpoint_delay=0.2)
+        job_ids = a.add_jobs((str(i),'main') for i in xrange(3))
+        a.get_next_jobs('main',count=3)
+
+        # nothing written yet - last write per job wins
+        for i in xrange(5): a.update_job(job_ids[0],str(i),'end')
+        a.update_job(job_ids[1],'x')
+        a.failed_job(job_ids[1])
+        a.remove_job(job_ids[2])
+        self.assertEqual(a._db.execute('SELECT start_value FROM jobs WHERE id=?',
+                    (job_ids[0],)).fetchone()[0],None,msg="update shouldn't be written yet")
+
+        # written within the delay, in one flush
+        time.sleep(0.5)
+        self.assertEqual(a._flush_count,1,msg='should be one flush')
+        self.assertEqual(a._flushed_jobs_count,2,msg='removed jobs shouldn\'t be written')
+        self.assertEqual(a._db.execute('''SELECT id,in_queue,start_value,end_value
+                    FROM jobs ORDER BY id''').fetchall(),
+                    [(job_ids[0],1,'4','end'),(job_ids[1],0,'x',None)])
+
+        # flush=True writes right away & close writes the rest
+        a.update_job(job_ids[0],'flushed',flush=True)
+        a.update_job(job_ids[1],'closed')
+        self.assertEqual(a._db.execute('SELECT start_value FROM jobs WHERE id=?',
+                    (job_ids[0],)).fetchone()[0],'flushed')
+        a.close()
+        a = MyDb(fname)
+        self.assertEqual([i[a.START_VALUE] for i in a.get_next_jobs('main',count=2)],
+                         ['flushed','closed'],msg="close didn't write the pending update")
+        a.close()
+
+    def test_priority(self):
+        """test higher priority jobs are handed out first, even if the queue is full"""
+        a = MyDb(':memory:',queue_max=3)
+        a.add_jobs((('1','main'),('2','main',None,5),('3','main'),('4','main')))
+        a.add_job('5','main',priority=9) # pushes out the lowest (newest) job
+        
+        self.assertEqual([i[a.ITEM_ID] for i in a.get_next_jobs('main',count=3)],
+                         ['5','2','1'],msg="jobs weren't in priority order")
+        self.assertEqual(a._db.execute('SELECT item_id FROM jobs WHERE in_queue=0 '+
+                         'ORDER BY id').fetchall(),[('3',),('4',)],msg='wrong jobs left out')
+        self.assertEqual([i[a.ITEM_ID] for i in a.get_next_jobs('main',count=3)],
+                         ['3','4'],msg="the rest should've been populated")
+        a.close()
+    
+    def test_job_counts(self):
+        """test job_counts stays in sync with the jobs table"""
+        a = MyDb(':memory:',queue_max=2)
+        job_ids = a.add_jobs((str(i),'main' if i%2 else 'sub') for i in xrange(7))
+        self.assertEqual(a.get_job_counts(),{'main':{1:2,0:1},'sub':{1:2,0:2}})
+        
+        a.remove_jobs(i[a.JOB_ID] for i in a.get_next_jobs('sub',count=2))
+        a.failed_job(a.get_next_job('main')[a.JOB_ID])
+        self.assertEqual(a.get_job_counts(),{'main':{0:2,1:1},'sub':{0:2}})
+        self.assertEqual(a.get_job_count(),5,msg='wrong total')
+        self.assertEqual(a.get_job_count('main'),3,msg='wrong main total')
+        
+        actual = {}
+        for job_type,in_queue,cnt in a._db.execute('''SELECT job_type,in_queue,
+                COUNT(*) FROM jobs GROUP BY job_type,in_queue'''):
+            actual.setdefault(job_type,{})[in_queue] = cnt
+        self.assertEqual(a.get_job_counts(),actual,msg="counts don't match the table")
+        a.close()
+    
+    def test_upgrade_db(self):
+        """test an older db (no priority) is upgraded when opened"""
+        import sqlite3
+        fname = self.get_new_file_name('aaa.db')
+        conn = sqlite3.connect(fname)
+        conn.execute('''CREATE TABLE jobs(id INTEGER PRIMARY KEY AUTOINCREMENT,
+            in_queue INTEGER DEFAULT 1,item_id TEXT NOT NULL,job_type TEXT NOT NULL,
+            init_data INTEGER,start_value TEXT,end_value TEXT)''')
+        conn.execute("INSERT INTO jobs (item_id,job_type) VALUES ('1','main')")
+        conn.commit(); conn.close()
+        
+        a = MyDb(fname)
+        self.assertEqual(a.get_job_count(),1,msg="job_counts wasn't filled")
+        self.assertEqual(a.get_next_job('main')[a.ITEM_ID],'1',msg="old job wasn't queued")
+        self.assertTrue(a.add_job('2','main',priority=1),msg="couldn't add a job")
+        a.close()
+    
     #===========================================================================
     # Recover Test
     #===========================================================================
@@ -176,7 +346,384 @@ class Test_MyDb(TestBase):
         # check no jobs
         job_count = db.get_job_count()
         self.assertEqual(job_count,0,'there are {} jobs when there should be 0!'.format(job_count))
+    
+    def test_transaction(self):
+        """test transaction() commits once, queues after commit and rolls back"""
+        a = MyDb(':memory:')
+        job_id = a.add_job('0','main')
+        a.get_next_job('main')
+        
+        # the queue doesn't know about the jobs till it commits
+        with a.transaction():
+            a.update_job(job_id,'1')
+            a.remove_job(job_id)
+            with a.batch(): # nested joins the outer one
+                job_ids = a.add_jobs((str(i),'main') for i in xrange(1,4))
+            self.assertEqual(len(a._queues['main']),0,msg='queued before commit')
+            self.assertEqual(a.get_job_count(),3,msg="can't see own writes")
+        self.assertEqual(len(a._queues['main']),3,msg='not queued after commit')
+        
+        # an exception undoes everything
+        try:
+            with a.transaction():
+                a.add_job('4','main')
+                a.remove_jobs(job_ids)
+                raise ValueError('oops')
+        except ValueError: pass
+        self.assertEqual(a.get_job_count(),3,msg="didn't roll back")
+        self.assertEqual([i[a.ITEM_ID] for i in a.get_next_jobs('main',count=5)],
+                         ['1','2','3'],msg='rolled back jobs were queued')
+        
+        # writes before add_jobs are rolled back too (no DDL commits them)
+        try:
+            with a.transaction():
+                a.update_job(job_ids[0],'changed')
+                a.add_jobs((('5','main'),))
+                a.remove_job(job_ids[1])
+                raise ValueError('oops')
+        except ValueError: pass
+        self.assertEqual(list(a.iter_jobs(columns=('item_id','start_value'))),
+                         [('1',None),('2',None),('3',None)],msg="didn't roll back")
+        
+        # populating in a rolled back transaction leaves the jobs queued
+        a.failed_job(job_ids[0])
+        try:
+            with a.transaction():
+                a.populate_queues('main')
+                raise ValueError('oops')
+        except ValueError: pass
+        self.assertEqual(a.get_job_counts(),{'main':{1:3}},msg='in_queue is off')
+        
+        # a failed add_jobs doesn't leave its batch staged
+        a.logger.disabled = True # (it's expected)
+        with a.transaction():
+            self.assertEqual(a.add_jobs((('4','main'),(None,'main'))),[])
+        a.logger.disabled = False
+        self.assertEqual(len(a.add_jobs((('4','main'),))),1)
+        self.assertTrue(a.add_job('5','main'))
+        a.close()
+    
+    def test_iter_jobs(self):
+        """test iter_jobs filters, pages and doesn't hold the lock"""
+        import threading
+        a = MyDb(':memory:',queue_max=5)
+        job_ids = a.add_jobs((str(i),'main' if i%2 else 'sub') for i in xrange(20))
+        a.update_job(job_ids[1],'s')
+        
+        self.assertEqual([i[0] for i in a.iter_jobs(page_size=3)],job_ids)
+        self.assertEqual(list(a.iter_jobs('main',started=True,columns=('item_id','start_value'))),
+                         [('1','s')],msg='wrong started jobs')
+        self.assertEqual(len(list(a.iter_jobs('sub',in_queue=0,page_size=2))),5)
+        self.assertEqual(len(list(a.iter_jobs(started=False,columns=['id']))),19)
+        self.assertRaises(ValueError,list,a.iter_jobs(columns=('id;--',)))
+        
+        # others can write while it's part way through
+        it = a.iter_jobs(page_size=2)
+        next(it)
+        t = threading.Thread(target=a.remove_jobs,args=(job_ids[10:],))
+        t.start(); t.join(5)
+        self.assertFalse(t.isAlive(),msg='iter_jobs held the lock')
+        self.assertEqual(len(list(it)),9,msg="removed jobs shouldn't be seen")
+        
+        # checking columns doesn't commit an open transaction
+        try:
+            with a.transaction():
+                a.add_job('x','main')
+                list(a.iter_jobs(columns=('item_id',)))
+                raise ValueError('oops')
+        except ValueError: pass
+        self.assertEqual(a.get_job_count(),10,msg="didn't roll back")
+        a.close()
+    
+    def test_low_watermark(self):
+        """test queues are refilled in the background below the low watermark"""
+        import time
+        a = MyDb(':memory:',queue_max=10,low_watermark=5)
+        a.add_jobs((str(i),'main') for i in xrange(100))
+        
+        ids = [i[0] for i in a.get_next_jobs('main',count=6)]
+        t = time.time()
+        while len(a._queues['main']) < 10 and time.time()-t < 5: time.sleep(.01)
+        self.assertEqual(len(a._queues['main']),10,msg="queue wasn't refilled")
+        
+        try:
+            while True: ids.extend(i[0] for i in a.get_next_jobs('main',count=3))
+        except StopIteration: pass
+        self.assertEqual(sorted(ids),range(1,101),msg='jobs missed or handed out twice')
+        self.assertEqual(a.get_job_counts(),{'main':{1:100}})
+        self.assertGreater(a._refill_count,0,msg="refills weren't counted")
+        self.assertTrue(any(i.startswith('background refills:') for i in a._get_summary_info()))
+        a.close()
+        self.assertIsNone(a._refiller,msg="refill thread wasn't stopped")
+    
+    def test_archive(self):
+        """test removed jobs are archived, compacted and exported"""
+        import os,time,csv
+        fname = self.get_new_file_name('aaa.db')
+        a = MyDb(fname,archive=True,archive_max_rows=150)
+        a.add_jobs((str(i),'main',None) for i in xrange(200))
+        items = a.get_next_jobs('main',count=200)
+        a.remove_jobs((i[0] for i in items[:100]),dict((i[0],5) for i in items))
+        a.remove_jobs(i[0] for i in items[100:])
+        self.assertEqual(a.get_job_count(),0,msg='jobs not removed')
+        
+        history = list(a.iter_history(page_size=30))
+        self.assertEqual([i[0] for i in history],[i[0] for i in items],msg='history is off')
+        self.assertEqual((history[0][8],history[-1][8]),(5,None),msg='wrong rows')
+        self.assertTrue(all(i[7] is not None and i[7]>=0 for i in history),msg='no duration')
+        self.assertEqual(len(list(a.iter_history(since=time.time()+1))),0)
+        
+        # retention (keeps the newest) and vacuum
+        self.assertEqual(a._db.execute('PRAGMA auto_vacuum').fetchone()[0],2)
+        self.assertIsNot(a.compact(),False,msg='compacting failed')
+        self.assertEqual(len(list(a.iter_history())),150,msg='retention not applied')
+        self.assertEqual(a._db.execute('PRAGMA freelist_count').fetchone()[0],0)
+        
+        out = self.get_new_file_name('history.csv')
+        self.assertEqual(a.export_history(out),150)
+        with open(out,'rb') as f: rows = list(csv.reader(f))
+        self.assertEqual(len(rows),151,msg='export is off')
+        self.assertEqual(rows[1][:3],[str(items[50][0]),'main','50'])
+        a.close()
+        
+        # an existing db archived for the first time is switched (VACUUM)
+        fname = self.get_new_file_name('bbb.db')
+        a = MyDb(fname)
+        a.add_jobs((str(i),'main','x'*1000) for i in xrange(200))
+        self.assertEqual(a._db.execute('PRAGMA auto_vacuum').fetchone()[0],0)
+        a.close()
+        a = MyDb(fname,archive=True,archive_max_rows=0)
+        self.assertEqual(a._db.execute('PRAGMA auto_vacuum').fetchone()[0],2)
+        a.remove_jobs(i[0] for i in a.get_next_jobs('main',count=200))
+        size = os.path.getsize(fname)
+        self.assertGreater(a.compact(),0,msg='no pages freed')
+        self.assertLess(os.path.getsize(fname),size,msg="file didn't shrink")
+        a.close()
+    
+    def test_reopen_runs(self):
+        """test reopening doesn't rewrite the jobs but queues them again"""
+        fname = self.get_new_file_name('aaa.db')
+        a = MyDb(fname,queue_max=4)
+        a.add_jobs((str(i),'main',None,i%2) for i in xrange(10))
+        a.remove_job(a.get_next_job('main')[0])
+        self.assertEqual(a.get_job_counts(),{'main':{1:3,0:6}})
+        a.close()
+        
+        a = MyDb(fname,queue_max=4)
+        self.assertEqual(a._run,2,msg='new run not started')
+        # only the (4) jobs put in the queue were written
+        self.assertEqual(a._db.execute('SELECT COUNT(*) FROM jobs WHERE in_queue=2').fetchone()[0],4)
+        self.assertEqual(a.get_job_counts(),{'main':{1:4,0:5}})
+        self.assertEqual(len(list(a.iter_jobs(in_queue=0))),5)
+        
+        # all handed out (priority order across runs), none twice
+        items = []
+        try:
+            while True: items.extend(a.get_next_jobs('main',count=2))
+        except StopIteration: pass
+        self.assertEqual(sorted(i[1] for i in items),[str(i) for i in xrange(10) if i!=1])
+        self.assertEqual([i[1] for i in items[:4]],['3','5','7','9'],msg='priority order is off')
+        a.close()
+        
+        # job_counts doesn't keep a row for every run
+        for run in xrange(3,6):
+            a = MyDb(fname,queue_max=4)
+            a.get_next_job('main')
+            a.close()
+        a = MyDb(fname,queue_max=4)
+        # (only the last run's - emptied by this run's populate)
+        self.assertEqual(a._db.execute('''SELECT COUNT(*) FROM job_counts
+                WHERE cnt=0 AND in_queue>0 AND in_queue<?''',(a._run-1,)
+                ).fetchone()[0],0,msg='empty rows kept')
+        self.assertEqual(a.get_job_count(),9)
+        a.close()
+    
+    def test_run_at(self):
+        """test jobs aren't handed out before their run_at"""
+        import time
+        fname = self.get_new_file_name('aaa.db')
+        a = MyDb(fname)
+        now = time.time()
+        a.add_jobs((('0','main'),('1','main',None,0,now+.3),('2','main',None,0,now+60)))
+        self.assertEqual(a.get_job_counts(),{'main':{1:1,-1:2}})
+        self.assertEqual([i[1] for i in a.get_next_jobs('main',count=5)],['0'])
+        self.assertRaises(StopIteration,a.get_next_jobs,'main')
+        
+        # the waiter is woken when it's due
+        self.assertTrue(a.wait_for_jobs('main',timeout=5),msg="wasn't woken")
+        self.assertGreaterEqual(time.time(),now+.3,msg='woken too soon')
+        self.assertEqual([i[1] for i in a.get_next_jobs('main',count=5)],['1'])
+        self.assertEqual(a._jobs_released_count,1)
+        self.assertLess(a._dispatch_delay_max,1,msg='released late')
+        a.close()
+        
+        # still parked after reopening - and released once due
+        a = MyDb(fname)
+        self.assertEqual(a.get_job_counts(),{'main':{1:2,-1:1}})
+        with a.get_db() as conn: conn.execute('UPDATE jobs SET run_at=? WHERE item_id=?',(time.time(),'2'))
+        self.assertEqual(a._release_due(),set(['main']))
+        self.assertEqual(sorted(i[1] for i in a.get_next_jobs('main',count=5)),['0','1','2'])
+        a.close()
+    
+    def test_retry(self):
+        """test failed jobs back off, die after max_attempts and are requeued"""
+        import time
+        a = MyDb(':memory:',max_attempts=3,retry_backoff=.1,retry_backoff_max=.15)
+        job_id = a.add_job('1','main')
+        a.add_job('2','main')
+        for backoff in (.1,.15): # doubled, but not past retry_backoff_max
+            self.assertEqual(a.get_next_jobs('main',count=5)[0][0],job_id)
+            t = time.time()
+            self.assertTrue(a.failed_job(job_id,'half'))
+            self.assertEqual(a.get_job_counts()['main'][-1],1,msg='not parked')
+            run_at = list(a.iter_jobs(columns=('run_at',)))[0][0]
+            self.assertAlmostEqual(run_at-t,backoff,delta=.02)
+            self.assertRaises(StopIteration,a.get_next_jobs,'main')
+            self.assertTrue(a.wait_for_jobs('main',timeout=5),msg="wasn't woken")
+            self.assertGreaterEqual(time.time(),run_at,msg='woken too soon')
+        
+        # 3rd failure - it's dead
+        self.assertEqual(a.get_next_job('main')[0],job_id)
+        a.failed_job(job_id)
+        self.assertEqual(a.get_job_count(),1,msg="dead job wasn't removed")
+        dead = a.get_dead_jobs()
+        self.assertEqual([(i[0],i[1],i[4],i[7]) for i in dead],[(job_id,'1','half',3)])
+        self.assertEqual(a.get_dead_jobs('other'),[])
+        self.assertEqual(a._jobs_failed_count,3)
+        
+        # requeued with its attempts reset
+        self.assertEqual(a.requeue_dead(job_type='main'),1)
+        self.assertEqual(a.get_dead_jobs(),[])
+        self.assertEqual(a.get_next_job('main')[0],job_id)
+        self.assertEqual(list(a.iter_jobs(columns=('id','attempts'))),[(1,0),(2,0)])
+        a.close()
+        
+        # buffered failures too - and a re-added job stays dead
+        a = MyDb(':memory:',max_attempts=1,checkpoint_delay=60)
+        job_id = a.add_job('1','main')
+        a.get_next_job('main')
+        a.failed_job(job_id)
+        self.assertEqual(a.flush_updates(),1)
+        self.assertEqual(len(a.get_dead_jobs()),1)
+        a.add_job('1','main')
+        self.assertEqual(a.requeue_dead((job_id,)),0)
+        self.assertEqual(len(a.get_dead_jobs()),1)
+        a.close()
+        
+        # no backoff: a failed job wakes what's waiting on it (buffered too)
+        import threading
+        for keys in ({},{'checkpoint_delay':60}):
+            a = MyDb(':memory:',**keys)
+            job_id = a.add_job('1','main')
+            a.get_next_job('main')
+            self.assertRaises(StopIteration,a.get_next_job,'main')
+            def fail():
+                time.sleep(.1)
+                a.failed_job(job_id,flush=True)
+            threading.Thread(target=fail).start()
+            t = time.time()
+            a.wait_for_jobs('main',timeout=3)
+            self.assertLess(time.time()-t,1,msg="wasn't woken {}".format(keys))
+            self.assertEqual(a.get_next_job('main')[0],job_id)
+            a.close()
+    
+    def test_deps(self):
+        """test jobs wait for their parents and are released when they're done"""
+        import time
+        fname = self.get_new_file_name('aaa.db')
+        a = MyDb(fname)
+        parents = a.add_jobs((str(i),'fetch') for i in xrange(3))
+        child = a.add_job('x','export',after=parents)
+        self.assertEqual(a.get_job_counts()['export'],{-2:1})
+        self.assertRaises(StopIteration,a.get_next_jobs,'export')
+        # parents already done don't block
+        self.assertEqual(a.add_job('y','export',after=(12345,)),child+1)
+        self.assertEqual(a.get_next_job('export')[1],'y')
+        
+        a.remove_jobs(parents[:2])
+        self.assertEqual(a.get_job_counts()['export'],{-2:1,1:1})
+        # rolled back - still blocked
+        try:
+            with a.transaction():
+                a.remove_job(parents[2])
+                raise ValueError
+        except ValueError: pass
+        self.assertEqual(a.get_job_counts()['export'],{-2:1,1:1})
+        
+        with a.transaction(): a.remove_job(parents[2])
+        self.assertEqual(a.get_next_job('export')[0],child)
+        self.assertEqual(a.get_job_counts()['export'],{1:2})
+        
+        # still blocked after reopening; released to parked if it's not time
+        p = a.add_job('p','fetch')
+        child = a.add_job('z','export',None,0,time.time()+60,(p,))
+        a.close()
+        a = MyDb(fname)
+        self.assertEqual(a.get_job_counts()['export'][-2],1)
+        a.remove_job(p)
+        self.assertEqual(a.get_job_counts()['export'][-1],1)
+        with a.get_db() as conn:
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM job_deps').fetchone()[0],0)
+        a.close()
+    
+    def test_lease_processes(self):
+        """test several processes sharing one db file with leases"""
+        import multiprocessing
+        fname = self.get_new_file_name('aaa.db')
+        
+        db = MyDb(fname,lease_time=30)
+        self.assertEqual(len(db.add_jobs((str(i),'main') for i in xrange(300))),300)
+        
+        # claims are in the db - another MyDb can't take the same jobs
+        a = MyDb(fname,lease_time=30,lease_owner='a')
+        b = MyDb(fname,lease_time=30,lease_owner='b')
+        ids_a = set(i[0] for i in a.get_next_jobs('main',count=5))
+        ids_b = set(i[0] for i in b.get_next_jobs('main',count=5))
+        self.assertEqual(len(ids_a),5)
+        self.assertEqual(len(ids_b),5)
+        self.assertFalse(ids_a & ids_b,msg='both claimed the same jobs!')
+        
+        # update_job renews a's lease, not b's - b can't update a's jobs
+        job_id = min(ids_a)
+        self.assertTrue(a.update_job(job_id,'1'))
+        self.assertFalse(b.update_job(job_id,'2'))
+        
+        # expired leases are claimed again
+        c = MyDb(fname,lease_time=-1,lease_owner='c')
+        ids_c = set(i[0] for i in c.get_next_jobs('main',count=5))
+        self.assertEqual(len(ids_c),5)
+        self.assertEqual(set(i[0] for i in b.get_next_jobs('main',count=5)),ids_c,
+                         msg="the expired leases weren't reclaimed first!")
+        # closing releases the leases
+        for i in (a,b,c): i.close()
+        
+        # let processes do all the jobs
+        done = multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=_lease_worker,args=(fname,done))
+                 for _ in xrange(4)]
+        for p in procs: p.start()
+        item_ids = []
+        while len(item_ids) < 300:
+            item_ids.append(done.get(timeout=30))
+        for p in procs:
+            p.join(30)
+            self.assertEqual(p.exitcode,0)
+        
+        self.assertEqual(len(item_ids),len(set(item_ids)),msg='a job was processed twice!')
+        self.assertEqual(set(item_ids),set(str(i) for i in xrange(300)))
+        self.assertEqual(db.get_job_count(),0)
+        db.close()
         
+def _lease_worker(fname,done):
+    """processes jobs from fname (in a new process) - puts item_id's on done"""
+    db = MyDb(fname,lease_time=30)
+    try:
+        while True:
+            items = db.get_next_jobs('main',count=5)
+            for item in items: done.put(item[MyDb.ITEM_ID])
+            db.remove_jobs(item[MyDb.JOB_ID] for item in items)
+    except StopIteration: pass
+    finally: db.close()
         
 #===============================================================================
 # Run Test
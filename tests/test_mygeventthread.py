@@ -0,0 +1,126 @@
+"""
+2026-10-18
+unit test for mygeventthread
+"""
+
+import sys
+import time
+import unittest
+if '..' not in sys.path: sys.path.append('..')
+from testbase import TestBase
+from mydb import MyDb
+try:
+    import gevent
+    from mygeventthread import MyGeventThread
+except ImportError: gevent = MyGeventThread = None
+else:
+    class MyTestThread(MyGeventThread):
+        _update_interval = -1 # update every time
+
+        def _process_item(self,item_id,init_data=None,start_value=None,end_value=None):
+            if item_id.startswith('slow'):
+                while not self._thread_block(item_id): gevent.sleep(.01)
+                return False,0
+            # other jobs run while this one waits - its checkpoints are its own
+            if self._thread_block(item_id): return False,0
+            gevent.sleep(.2)
+            if self._thread_block(item_id): return False,0
+            return not item_id.startswith('bad'),1
+
+#===============================================================================
+# Test MyGeventThread
+#===============================================================================
+@unittest.skipIf(gevent is None,'gevent is not installed')
+class Test_MyGeventThread(TestBase):
+    def test_run(self):
+        """test many jobs run at once, each with its own checkpoints"""
+        for batch_complete in (False,True):
+            a = MyDb(':memory:',max_attempts=1)
+            a.add_jobs((str(i),'main') for i in xrange(300))
+            a.add_jobs(('bad{}'.format(i),'main') for i in xrange(20))
+            t = MyTestThread('main',a,greenlets=200,batch_complete=batch_complete)
+            s = time.time()
+            t.start()
+            t.stop()
+            t.join(10)
+            self.assertFalse(t.isAlive(),msg='thread timed-out')
+            self.assertLess(time.time()-s,2,msg="jobs didn't run at once")
+            self.assertEqual(a.get_job_count(),0,msg='jobs were left')
+            self.assertEqual(t._jobs_completed,300)
+            dead = a.get_dead_jobs()
+            self.assertEqual(len(dead),20)
+            self.assertTrue(all(i[1] == i[4] for i in dead),
+                            msg="a job was saved with another job's data")
+            a.close()
+
+    def test_interrupt(self):
+        """test interrupting saves every running job and leaves it queued"""
+        a = MyDb(':memory:')
+        a.add_jobs(('slow{}'.format(i),'main') for i in xrange(50))
+        t = MyTestThread('main',a,greenlets=100)
+        t.start()
+        time.sleep(.2)
+        t.interupt()
+        t.join(10)
+        self.assertFalse(t.isAlive(),msg='thread timed-out')
+        self.assertEqual(a.get_job_count(),50,msg='interrupted jobs were removed')
+        self.assertEqual(a.get_dead_jobs(),[])
+        self.assertTrue(all(i == v for i,v in a.iter_jobs(columns=('item_id','start_value'))),
+                        msg="jobs weren't saved (with their own data)")
+        a.close()
+
+    def test_async_checkpoints(self):
+        """test the checkpointer writes the last checkpoints and stops with the thread"""
+        import threading
+        a = MyDb(':memory:')
+        self.addCleanup(a.close) # clean up!
+        a.add_jobs(('slow{}'.format(i),'main') for i in xrange(5))
+        t = MyTestThread('main',a,greenlets=10,async_checkpoints=True)
+        t.start()
+        time.sleep(.2)
+        t.interupt()
+        t.join(10)
+        self.assertFalse(t.isAlive(),msg='thread timed-out')
+        self.assertFalse([i for i in threading.enumerate()
+                          if i.name.endswith('Checkpointer')],msg='checkpointer is still running')
+        self.assertEqual(t._checkpoints,{},msg='checkpoints were left')
+        self.assertTrue(all(i == v for i,v in a.iter_jobs(columns=('item_id','start_value'))),
+                        msg="jobs weren't saved")
+
+    def test_job_types(self):
+        """test jobs of several job_types run at once, each knowing its own"""
+        seen = []
+        class MyTypesThread(MyGeventThread):
+            def _process_item(self,item_id,init_data=None,start_value=None,end_value=None):
+                gevent.sleep(.1) # the others start meanwhile
+                seen.append((item_id[0],self.get_job_type()))
+                return True,1
+
+        a = MyDb(':memory:')
+        self.addCleanup(a.close) # clean up!
+        a.add_jobs(('a{}'.format(i),'a') for i in xrange(50))
+        a.add_jobs(('b{}'.format(i),'b') for i in xrange(50))
+        t = MyTypesThread(['a','b'],a,greenlets=100)
+        s = time.time()
+        t.start()
+        t.stop()
+        t.join(10)
+        self.assertFalse(t.isAlive(),msg='thread timed-out')
+        self.assertLess(time.time()-s,1,msg="jobs didn't run at once")
+        self.assertEqual(len(seen),100)
+        self.assertTrue(all(i == j for i,j in seen),msg='a job saw the wrong job_type')
+        self.assertEqual((t.get_metrics('a').jobs,t.get_metrics('b').jobs),(50,50))
+
+#===============================================================================
+# Run Test
+#===============================================================================
+def run_test():
+    import os; os.chdir('..')
+    suite = unittest.TestLoader().loadTestsFromTestCase(Test_MyGeventThread)
+    unittest.TextTestRunner().run(suite)
+
+#===============================================================================
+# Main
+#===============================================================================
+if __name__ == '__main__':
+    run_test()
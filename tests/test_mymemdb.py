@@ -0,0 +1,188 @@
+"""
+2026-10-18
+unit test for mymemdb
+"""
+
+from testbase import TestBase
+import sys
+if '..' not in sys.path: sys.path.append('..')
+from mymemdb import MyMemDb
+from mydb import MyDb
+
+#===============================================================================
+# Test MyMemDb
+#===============================================================================
+class Test_MyMemDb(TestBase):
+    def test_add_jobs(self):
+        """test adding jobs skips duplicates the same as MyDb"""
+        a = MyMemDb()
+
+        # only the first of each item_id,job_type in a batch is added
+        job_ids = a.add_jobs((('1','main',3),('1','main',4),('2','main'),
+                              ('2','main'),('1','sub',1)))
+        self.assertEqual(job_ids,[1,2,3],msg="only 3 jobs should've been added")
+
+        # the same job hasn't been started, so it isn't added
+        self.assertEqual(a.add_jobs((('1','main',5),)),[],msg="job is already waiting...")
+
+        # once started, only a newer init_data is added
+        a.get_next_jobs('main',count=2)
+        a.update_job(job_ids[0],'start')
+        new_ids = a.add_jobs((('1','main',3),('1','main',9),('1','main',10)))
+        self.assertEqual(len(new_ids),1,msg="only init_data=9 should've been added")
+        self.assertEqual(a.get_next_job('main')[a.INIT_DATA],9,msg="wrong job queued")
+        self.assertEqual(a.get_job_count(),4,msg="job count is off")
+        a.close()
+
+    def test_queues(self):
+        """test priority, queue_max and failed jobs going back in the queue"""
+        a = MyMemDb(queue_max=3)
+        a.add_jobs((('1','main'),('2','main',None,5),('3','main'),('4','main')))
+        a.add_job('5','main',priority=9) # pushes out the lowest (newest) job
+        self.assertEqual(a.get_queue_size('main'),3,msg='only the queue counts')
+
+        self.assertEqual([i[a.ITEM_ID] for i in a.get_next_jobs('main',count=3)],
+                         ['5','2','1'],msg="jobs weren't in priority order")
+        self.assertEqual(a.get_job_counts(),{'main':{1:3,0:2}})
+
+        items = a.get_next_jobs('main',count=3)
+        self.assertEqual([i[a.ITEM_ID] for i in items],['3','4'],
+                         msg="the rest should've been populated")
+        self.assertRaises(StopIteration,a.get_next_jobs,'main')
+
+        # failed jobs are handed out again, removed ones are gone
+        a.failed_job(items[0][a.JOB_ID],'half')
+        a.remove_job(items[1][a.JOB_ID])
+        self.assertTrue(a.wait_for_jobs('main',timeout=0))
+        item = a.get_next_job('main')
+        self.assertEqual((item[a.ITEM_ID],item[a.START_VALUE]),('3','half'))
+        self.assertEqual(a.get_job_count('main'),4)
+        a.close()
+
+    def test_run_at(self):
+        """test parked jobs are handed out once they're due"""
+        import time
+        a = MyMemDb()
+        a.add_jobs((('0','main'),('1','main',None,0,time.time()+.2)))
+        self.assertEqual(a.get_job_counts(),{'main':{1:1,-1:1}})
+        self.assertEqual([i[a.ITEM_ID] for i in a.get_next_jobs('main',count=2)],['0'])
+        self.assertTrue(a.wait_for_jobs('main',timeout=5))
+        self.assertEqual(a.get_next_job('main')[a.ITEM_ID],'1')
+        a.close()
+
+    def test_retry(self):
+        """test failed jobs back off, die after max_attempts and are requeued"""
+        import time
+        a = MyMemDb(max_attempts=2,retry_backoff=.1)
+        job_id = a.add_job('1','main')
+        a.get_next_job('main')
+        a.failed_job(job_id,'half')
+        self.assertEqual(a.get_job_counts(),{'main':{-1:1}},msg='not parked')
+        self.assertRaises(StopIteration,a.get_next_jobs,'main')
+        t = time.time()
+        self.assertTrue(a.wait_for_jobs('main',timeout=5))
+        self.assertGreaterEqual(time.time()-t,.05,msg='woken too soon')
+        
+        a.get_next_job('main')
+        a.failed_job(job_id)
+        self.assertEqual(a.get_job_count(),0,msg="dead job wasn't removed")
+        self.assertEqual([(i[0],i[1],i[4],i[7]) for i in a.get_dead_jobs()],
+                         [(job_id,'1','half',2)])
+        self.assertEqual(a.requeue_dead(),1)
+        self.assertEqual(a.get_next_job('main')[a.JOB_ID],job_id)
+        a.close()
+
+    def test_deps(self):
+        """test jobs wait for their parents and are released when they're done"""
+        fname = self.get_new_file_name('aaa.db')
+        a = MyMemDb()
+        parents = a.add_jobs((str(i),'fetch') for i in xrange(3))
+        child = a.add_job('x','export',after=parents)
+        self.assertEqual(a.get_job_counts()['export'],{-2:1})
+        self.assertRaises(StopIteration,a.get_next_jobs,'export')
+        a.remove_jobs(parents[:2])
+        self.assertRaises(StopIteration,a.get_next_jobs,'export')
+        
+        # saved with its edges
+        self.assertTrue(a.save(fname))
+        b = MyDb(fname)
+        b.remove_job(parents[2])
+        self.assertEqual(b.get_next_job('export')[0],child)
+        b.close()
+        
+        a.remove_job(parents[2])
+        self.assertEqual(a.get_next_job('export')[0],child)
+        a.close()
+
+    def test_save(self):
+        """test saving a snapshot that MyDb can open"""
+        fname = self.get_new_file_name('aaa.db')
+        a = MyMemDb(max_attempts=2)
+        job_ids = a.add_jobs(((str(i),'main',i,i%3) for i in xrange(10)))
+        a.update_job(job_ids[0],'start','end')
+        a.remove_job(job_ids[1])
+        a.failed_job(job_ids[2])
+        a.failed_job(job_ids[3]); a.failed_job(job_ids[3]) # dead
+        self.assertTrue(a.save(fname))
+        self.assertFalse(a.save(fname),msg="shouldn't overwrite the file")
+
+        b = MyDb(fname)
+        cols = ('id','item_id','job_type','init_data','start_value','end_value','priority')
+        self.assertEqual(list(b.iter_jobs(columns=cols)),list(a.iter_jobs(columns=cols)),
+                         msg="saved jobs don't match")
+        self.assertEqual(b.get_job_counts(),{'main':{1:8}})
+        self.assertEqual([i for i in b.iter_jobs(columns=('id','attempts')) if i[1]],
+                         [(job_ids[2],1)],msg='attempts not saved')
+        self.assertEqual(b.get_dead_jobs(),a.get_dead_jobs())
+        b.close()
+        a.close()
+
+    def test_mythread(self):
+        """test MyThread works with MyMemDb"""
+        from mythread import MyThread
+        class MyTestThread(MyThread):
+            def _process_item(self,item_id,init_data=None,start_value=None,end_value=None):
+                return True,1
+
+        a = MyMemDb()
+        a.add_jobs((str(i),'main') for i in xrange(50))
+        threads = [MyTestThread('main',a) for _ in xrange(3)]
+        for t in threads: t.start()
+        for t in threads: t.stop()
+        for t in threads:
+            t.join(10)
+            self.assertFalse(t.isAlive(),msg='thread timed-out')
+        self.assertEqual(a.get_job_count(),0,msg='jobs were left')
+        a.close()
+
+        # failed jobs go back through failed_job and die
+        class MyFailThread(MyThread):
+            def _process_item(self,item_id,init_data=None,start_value=None,end_value=None):
+                return item_id!='bad',1
+
+        a = MyMemDb(max_attempts=3)
+        a.add_jobs((str(i),'main') for i in xrange(10))
+        a.add_job('bad','main')
+        t = MyFailThread('main',a)
+        t.start()
+        t.stop()
+        t.join(10)
+        self.assertFalse(t.isAlive(),msg='thread timed-out')
+        self.assertEqual(a.get_job_count(),0,msg='jobs were left')
+        self.assertEqual([i[1] for i in a.get_dead_jobs()],['bad'])
+        a.close()
+
+#===============================================================================
+# Run Test
+#===============================================================================
+def run_test():
+    import os; os.chdir('..')
+    import unittest
+    suite = unittest.TestLoader().loadTestsFromTestCase(Test_MyMemDb)
+    unittest.TextTestRunner().run(suite)
+
+#===============================================================================
+# Main
+#===============================================================================
+if __name__ == '__main__':
+    run_test()
@@ -0,0 +1,61 @@
+"""
+2026-10-18
+unit test for mymetrics
+"""
+
+import sys
+if '..' not in sys.path: sys.path.append('..')
+from mymetrics import MyHistogram,MyJobMetrics
+from testbase import TestBase
+
+#===============================================================================
+# Test MyMetrics
+#===============================================================================
+class Test_MyMetrics(TestBase):
+    def test_histogram(self):
+        """test values land in the right buckets and percentiles"""
+        a = MyHistogram()
+        for v in [.00005]*90+[.05]*9+[5000]: a.add(v)
+        self.assertEqual((a.count,a.max),(100,5000))
+        self.assertEqual(a.percentile(50),.0001)
+        self.assertEqual(a.percentile(95),.0512)
+        self.assertEqual(a.percentile(100),5000,msg='the last bucket is max')
+        self.assertEqual(a.to_dict()['buckets'],[[.0001,90],[.0512,9],[None,1]])
+
+        b = MyHistogram()
+        b.add(.05)
+        a.merge(b)
+        self.assertEqual((a.count,a.counts[9]),(101,10))
+        self.assertEqual(MyHistogram().percentile(50),None)
+
+    def test_job_metrics(self):
+        """test counters and merging threads' metrics by job_type"""
+        a,b,c = MyJobMetrics('main'),MyJobMetrics('main'),MyJobMetrics('sub')
+        a.job_done(10,11,5)
+        a.job_done(11,12,0,False,True)
+        b.job_done(12,14,5)
+        b.job_done(14,15,0,False) # interrupted
+        b.process.add(1)
+        c.job_done(0,1)
+        m = MyJobMetrics.merged((a,b,c))
+        self.assertEqual(sorted(m),['main','sub'])
+        d = m['main'].to_dict()
+        self.assertEqual((d['jobs'],d['failed'],d['rows'],d['seconds']),(2,1,10,5))
+        self.assertEqual(d['jobs_per_sec'],.4)
+        self.assertEqual(d['process']['count'],1)
+        self.assertEqual(a.jobs,1,msg='merging changed a thread\'s metrics')
+
+#===============================================================================
+# Run Test
+#===============================================================================
+def run_test():
+    import os; os.chdir('..')
+    import unittest
+    suite = unittest.TestLoader().loadTestsFromTestCase(Test_MyMetrics)
+    unittest.TextTestRunner().run(suite)
+
+#===============================================================================
+# Main
+#===============================================================================
+if __name__ == '__main__':
+    run_test()
@@ -11,6 +11,25 @@ from testbase import TestBase
 
 #TODO: test MyThread more/better!
 
+# the pool (processes=N) pickles the class, so it has to be module level
+class MyPoolTestThread(MyThread):
+    _rows = 1
+    
+    def _get_process_state(self):
+        return dict(_rows=self._rows,_update_interval=-1) # update every time
+    
+    def _process_item(self,item_id,init_data=None,start_value=None,end_value=None):
+        import os,time
+        if item_id == 'slow':
+            while not self._thread_block(os.getpid()): time.sleep(.01)
+            return False,0
+        if self._thread_block(os.getpid()): return False,0
+        if item_id == 'bad': return False,0
+        if item_id == 'die': os.kill(os.getpid(),9)
+        if item_id == 'raise': raise ValueError('oops')
+        if item_id == '0': self._add_job('child','sub')
+        return True,self._rows
+
 #===============================================================================
 # Test MyThread
 #===============================================================================
@@ -95,6 +114,243 @@ class Test_MyThread(TestBase):
         self.assertEqual(db.get_job_count(),0,'not all jobs were processed/removed...')
         
         
+    def test_batch_complete(self):
+        """make sure batch_complete removes each batch of jobs at once, after
+        the files are flushed."""
+        from mydb import MyDb
+        calls = []
+        
+        class MyTestDb(MyDb):
+            def remove_jobs(self,job_ids,rows=None):
+                calls.append(('remove',len(job_ids)))
+                return MyDb.remove_jobs(self,job_ids,rows)
+        
+        class MyTestThread(MyThread):
+            def _flush_files(self):
+                calls.append(('flush',))
+        
+        db = MyTestDb(':memory:')
+        self.addCleanup(db.close) # clean up!
+        db.add_jobs((i,'main') for i in xrange(10))
+        
+        a = MyTestThread('main',db,batch=5,batch_complete=True)
+        a.start()
+        a.stop(wait_for_empty_queue=True)
+        a.join()
+        
+        self.assertEqual(a._jobs_completed,10,'not all jobs were completed...')
+        self.assertEqual(calls,[('flush',),('remove',5)]*2,
+                         'should flush then remove once per batch: {}'.format(calls))
+        self.assertEqual(db.get_job_count(),0,'not all jobs were removed...')
+        
+        
+    def test_batch_target(self):
+        """test batch_target sizes batches from the time per job, within
+        batch_min/batch_max and half the queue"""
+        import time
+        from mydb import MyDb
+        class MyTestThread(MyThread):
+            def _process_item(self,item_id,init_data=None,start_value=None,end_value=None):
+                time.sleep(.002)
+                return True,1
+        
+        db = MyDb(':memory:')
+        self.addCleanup(db.close) # clean up!
+        db.add_jobs((str(i),'main') for i in xrange(300))
+        a = MyTestThread('main',db,batch_target=.1,batch_max=8)
+        self.assertEqual(a._next_batch_size(),1,msg='should start at batch')
+        a.start()
+        a.stop(wait_for_empty_queue=True)
+        a.join(30)
+        self.assertFalse(a.isAlive(),msg='thread timed-out')
+        self.assertEqual(a._jobs_completed,300)
+        self.assertEqual(sorted(a._batch_stats)[-1],8,msg='batches never grew to batch_max {}'.format(a._batch_stats))
+        self.assertTrue(any(i.startswith('batches of 8-15: ') for i in a._get_summary_info()))
+        
+        # never more than half the queue
+        db.add_jobs((str(i),'more') for i in xrange(6))
+        db.populate_queues('more')
+        a._job = 'more'
+        self.assertEqual(a._next_batch_size(),3)
+        
+    def test_failed_job(self):
+        """test a job that always fails isn't retried over and over when the
+        db doesn't retry failed jobs (no max_attempts/retry_backoff)"""
+        import time
+        from mydb import MyDb
+        class MyTestThread(MyThread):
+            _tries = 0
+            def _process_item(self,item_id,init_data=None,start_value=None,end_value=None):
+                self._tries += 1
+                return False,0
+        
+        db = MyDb(':memory:')
+        self.addCleanup(db.close) # clean up!
+        job_id = db.add_job('1','main')
+        a = MyTestThread('main',db)
+        a.start()
+        time.sleep(.5)
+        a.stop()
+        a.join(30)
+        self.assertFalse(a.isAlive(),msg='thread timed-out')
+        self.assertEqual(a._tries,1,msg='failed job was retried {} times'.format(a._tries))
+        self.assertEqual([i[0] for i in db.iter_jobs(columns=('id',))],[job_id])
+        
+    def test_checkpointing(self):
+        """test checkpoint_every samples every N calls and async_checkpoints
+        writes them from another thread, all before the job's completed"""
+        import threading,time
+        from mydb import MyDb
+        calls = []
+        class MyTestDb(MyDb):
+            def update_job(self,job_id,start_value,end_value=None,flush=None):
+                time.sleep(.01) # slow disk
+                calls.append(('update',start_value,threading.current_thread().name))
+                return MyDb.update_job(self,job_id,start_value,end_value,flush)
+            def remove_jobs(self,job_ids,rows=None):
+                calls.append(('remove',))
+                return MyDb.remove_jobs(self,job_ids,rows)
+        
+        class MyTestThread(MyThread):
+            _update_interval = -1 # update every time it looks
+            def _process_item(self,item_id,init_data=None,start_value=None,end_value=None):
+                for i in xrange(1,1001):
+                    if self._thread_block(i): return False,0
+                    if i % 100 == 0: time.sleep(.02)
+                return True,1
+        
+        db = MyTestDb(':memory:')
+        self.addCleanup(db.close) # clean up!
+        db.add_job('1','main')
+        a = MyTestThread('main',db,checkpoint_every=100)
+        a.start()
+        a.stop()
+        a.join(30)
+        self.assertEqual([i[1] for i in calls[:-1]],range(1,1000,100))
+        self.assertEqual(calls[-1],('remove',))
+        
+        del calls[:]
+        db.add_job('2','main')
+        a = MyTestThread('main',db,checkpoint_every=100,async_checkpoints=True)
+        a.start()
+        a.stop()
+        a.join(30)
+        self.assertFalse(a.isAlive(),msg='thread timed-out')
+        self.assertEqual(calls[-1],('remove',),msg='checkpoint written after completing')
+        self.assertEqual(calls[-2][1],901,msg="the last checkpoint wasn't written")
+        self.assertTrue(any(i[2].endswith('Checkpointer') for i in calls[:-1]),
+                        msg='checkpoints were written by the thread')
+        self.assertEqual(db.get_job_count(),0)
+        
+    def test_processes(self):
+        """test _process_item running in a process pool (processes=N)"""
+        import os
+        from mydb import MyDb
+        db = MyDb(':memory:',max_attempts=1)
+        self.addCleanup(db.close) # clean up!
+        db.add_jobs((str(i),'main') for i in xrange(10))
+        bad_id = db.add_job('bad','main')
+        
+        a = MyPoolTestThread('main',db,processes=2)
+        a._rows = 3
+        a.start()
+        a.stop(wait_for_empty_queue=True)
+        a.join(30)
+        self.assertFalse(a.isAlive(),msg='thread timed-out')
+        
+        self.assertEqual(a._jobs_completed,10)
+        self.assertEqual(a._total_rows,30,msg="state wasn't passed to the pool")
+        self.assertEqual(db._jobs_updated_count,11,msg="checkpoints weren't sent back")
+        self.assertEqual(db.get_job_count('sub'),1,msg="added job wasn't sent back")
+        # the failed job was checkpointed by a pool process, then failed
+        dead = db.get_dead_jobs()
+        self.assertEqual([i[0] for i in dead],[bad_id])
+        self.assertNotEqual(int(dead[0][4]),os.getpid())
+        
+    def test_processes_died(self):
+        """test a job whose pool process dies is failed (not waited on
+        forever) and a job's error stops the pool"""
+        from mydb import MyDb
+        db = MyDb(':memory:',max_attempts=1)
+        self.addCleanup(db.close) # clean up!
+        db.add_jobs((str(i),'main') for i in xrange(1,5))
+        die_id = db.add_job('die','main')
+        
+        a = MyPoolTestThread('main',db,processes=2)
+        a._POOL_POLL = .1
+        a.start()
+        a.stop(wait_for_empty_queue=True)
+        a.join(30)
+        self.assertFalse(a.isAlive(),msg='thread hung on the dead job')
+        self.assertEqual(a._jobs_completed,4)
+        self.assertEqual([i[0] for i in db.get_dead_jobs()],[die_id])
+        
+        # an error raised in the pool stops its processes too
+        db.add_job('raise','main')
+        a = MyPoolTestThread('main',db,processes=2)
+        processes = list(a._pool._pool)
+        a.logger.disabled = True # (it's expected)
+        a.start()
+        a.join(30)
+        self.assertFalse(a.isAlive(),msg='thread timed-out')
+        self.assertIsNone(a._pool)
+        self.assertFalse(any(p.is_alive() for p in processes),msg='pool was left running')
+        
+    def test_processes_interrupt(self):
+        """test interrupting a thread interrupts its pool processes"""
+        import time
+        from mydb import MyDb
+        db = MyDb(':memory:')
+        self.addCleanup(db.close) # clean up!
+        db.add_jobs((('slow','main'),('slow','other')))
+        
+        a = MyPoolTestThread('main',db,processes=1)
+        a.start()
+        time.sleep(.5)
+        a.interupt()
+        a.join(30)
+        self.assertFalse(a.isAlive(),msg="thread wasn't interrupted")
+        # saved, not failed or completed
+        self.assertEqual(list(db.iter_jobs('main',columns=('attempts',))),[(0,)])
+        self.assertEqual(a._jobs_completed,0)
+        
+    def test_job_types(self):
+        """test a thread doing several job_types takes turns by weight and
+        only waits when they're all empty"""
+        import time
+        from mydb import MyDb
+        done = []
+        class MyTestThread(MyThread):
+            def _process_item(self,item_id,init_data=None,start_value=None,end_value=None):
+                done.append(self.get_job_type())
+                return True,1
+        
+        db = MyDb(':memory:')
+        self.addCleanup(db.close) # clean up!
+        db.add_jobs((str(i),'a') for i in xrange(60))
+        db.add_jobs((str(i),'b') for i in xrange(10))
+        a = MyTestThread({'a':3,'b':1},db,batch=2)
+        self.assertEqual(a.get_job_types(),['a','b'])
+        a.start()
+        t = time.time()
+        while len(done) < 70 and time.time()-t < 10: time.sleep(.01)
+        self.assertEqual(''.join(done[:16]),'aaaaaabbaaaaaabb',msg='not weighted')
+        self.assertEqual(done.count('b'),10)
+        self.assertEqual(done[-20:],['a']*20,msg="'a' didn't get b's turns")
+        
+        # waits on both - either wakes it
+        time.sleep(.1)
+        self.assertTrue(a.is_waiting())
+        db.add_job('x','b')
+        t = time.time()
+        while len(done) < 71 and time.time()-t < 5: time.sleep(.01)
+        self.assertEqual(done[70:],['b'])
+        a.stop()
+        a.join(10)
+        self.assertFalse(a.isAlive(),msg='thread timed-out')
+        self.assertEqual((a.get_metrics('a').jobs,a.get_metrics('b').jobs),(60,11))
+        self.assertRaises(ValueError,MyTestThread,{'a':1,'b':0},db)
+        
 #===============================================================================
 # Run Test
 #===============================================================================
@@ -0,0 +1,163 @@
+"""
+2026-10-18
+unit test for mythreadpool
+"""
+
+import sys
+import time
+if '..' not in sys.path: sys.path.append('..')
+from mythread import MyThread
+from mythreadpool import MyThreadPool, drain_threads
+from mydb import MyDb
+from testbase import TestBase
+
+class MyTestThread(MyThread):
+    def _process_item(self,item_id,init_data=None,start_value=None,end_value=None):
+        time.sleep(.01)
+        return True,1
+
+class MyDrainThread(MyThread):
+    _update_interval = 60 # only checkpoints when interrupted
+    
+    def _process_item(self,item_id,init_data=None,start_value=None,end_value=None):
+        if item_id == 'stuck': # never checks for the interrupt
+            time.sleep(1)
+            return False,0
+        while not self._thread_block(item_id): time.sleep(.01)
+        return False,0
+
+#===============================================================================
+# Test MyThreadPool
+#===============================================================================
+class Test_MyThreadPool(TestBase):
+    def test_scaling(self):
+        """test threads are added for a backlog and retired once idle"""
+        db = MyDb(':memory:')
+        self.addCleanup(db.close) # clean up!
+        db.add_jobs((str(i),'main') for i in xrange(300))
+
+        pool = MyThreadPool(db,interval=.05,drain_time=.2,idle_time=.2)
+        pool.add_workers('main',MyTestThread,min_threads=1,max_threads=4)
+        pool.start()
+        self.assertEqual(len(pool.get_workers('main')),1,msg='min_threads not started')
+
+        # scales up for the backlog, then back down once it's done
+        t = time.time()
+        while db.get_job_count() and time.time()-t < 10: time.sleep(.05)
+        self.assertEqual(db.get_job_count(),0,msg="jobs weren't done")
+        self.assertEqual(pool._types['main'].peak,4,msg="didn't scale up")
+        t = time.time()
+        while len(pool.get_workers('main')) > 1 and time.time()-t < 5: time.sleep(.05)
+        self.assertEqual(len(pool.get_workers('main')),1,msg="didn't retire idle threads")
+
+        # another job_type is started right away, and everything stops
+        pool.add_workers('other',MyTestThread,min_threads=2)
+        self.assertEqual(len(pool.get_workers()),3)
+        pool.stop()
+        self.assertTrue(pool.join(10),msg='threads timed-out')
+        self.assertEqual(pool.get_workers(),[])
+
+        info = pool.get_summary_info()
+        self.assertTrue(info[0].startswith('main: 0 threads (1-4, peak 4), 4 started, '
+                                           '3 retired, 300 jobs'),msg=info[0])
+        self.assertTrue('pool: 300 jobs' in info[2],msg=info[2])
+        
+        # every thread's metrics, retired ones too
+        import json
+        fname = self.get_new_file_name('metrics.json')
+        pool.export_metrics(fname)
+        with open(fname) as f: snapshot = json.load(f)['job_types']['main']
+        self.assertEqual((snapshot['jobs'],snapshot['rows'],snapshot['process']['count'],
+                          snapshot['queue_wait']['count']),(300,300,300,300))
+        self.assertGreater(snapshot['complete']['count'],0)
+
+    def test_stop(self):
+        """test stop(wait_for_empty_queue=True) still scales for the backlog"""
+        db = MyDb(':memory:')
+        self.addCleanup(db.close) # clean up!
+        db.add_jobs((str(i),'main') for i in xrange(200))
+
+        pool = MyThreadPool(db,interval=.05,drain_time=.2)
+        pool.add_workers('main',MyTestThread,max_threads=4)
+        pool.start()
+        pool.stop()
+        self.assertTrue(pool.join(10),msg='threads timed-out')
+        self.assertEqual(db.get_job_count(),0,msg="jobs weren't done")
+        self.assertEqual(pool._types['main'].peak,4,msg="didn't scale up")
+        self.assertFalse(pool._supervisor.isAlive())
+
+    def test_not_ready(self):
+        """test parked (run_at) and blocked (after) jobs aren't scaled for"""
+        db = MyDb(':memory:')
+        self.addCleanup(db.close) # clean up!
+        parent = db.add_job('parent','other')
+        db.add_jobs((str(i),'main',None,0,time.time()+3600) for i in xrange(200))
+        db.add_jobs((str(i),'main',None,0,None,[parent]) for i in xrange(200,400))
+        db.add_job('slow','main') # keeps a thread busy (not idle)
+        self.assertEqual(db.get_job_count('main'),401)
+
+        class MySlowThread(MyThread):
+            def _process_item(self,item_id,init_data=None,start_value=None,end_value=None):
+                time.sleep(1)
+                return True,1
+        pool = MyThreadPool(db,interval=.05,drain_time=.2)
+        pool.add_workers('main',MySlowThread,max_threads=4)
+        pool.start()
+        self.addCleanup(pool.stop,False) # (even if it fails)
+        time.sleep(.5)
+        self.assertEqual(pool._get_backlog('main'),1) # (just slow)
+        self.assertEqual(pool._types['main'].peak,1,msg='scaled for jobs that can\'t run')
+        pool.stop(wait_for_empty_queue=False)
+        self.assertTrue(pool.join(10),msg='threads timed-out')
+
+    def test_drain(self):
+        """test draining saves the jobs that stop and reports the ones that don't"""
+        db = MyDb(':memory:')
+        self.addCleanup(db.close) # clean up!
+        ids = [db.add_job(str(i),'main') for i in xrange(3)]
+        stuck = db.add_job('stuck','main')
+        threads = [MyDrainThread('main',db,batch_size=1) for _ in xrange(4)]
+        for t in threads: t.start()
+        time.sleep(.2)
+
+        report = drain_threads(threads,db,timeout=.3)
+        self.assertEqual(report['saved'],sorted(ids))
+        self.assertEqual(report['in_progress'],[stuck])
+        self.assertEqual(report['completed']+report['failed']+report['interrupted'],[])
+        self.assertEqual(len(report['alive']),1)
+        self.assertTrue(.25 < report['seconds'] < 1,msg=report['seconds'])
+        self.assertEqual(db.get_job_count(),4,msg='drained jobs were removed')
+        self.assertEqual(sorted(v for v, in db.iter_jobs(columns=('start_value',))
+                                if v is not None),[str(i) for i in xrange(3)],
+                         msg="drained jobs weren't saved")
+        for t in threads: t.join(5)
+
+        # a pool reports its last drain
+        db = MyDb(':memory:')
+        self.addCleanup(db.close) # clean up!
+        db.add_jobs((str(i),'main') for i in xrange(3))
+        stuck = db.add_job('stuck','main')
+        pool = MyThreadPool(db,interval=.05)
+        pool.add_workers('main',MyDrainThread,min_threads=4,max_threads=4,batch_size=1)
+        pool.start()
+        time.sleep(.2)
+        report = pool.drain(timeout=2)
+        self.assertEqual((len(report['saved']),len(report['in_progress'])),(3,0))
+        self.assertEqual(report['interrupted'],[stuck],msg='stuck job was saved?')
+        self.assertTrue(pool.join(5),msg='threads timed-out')
+        self.assertTrue(pool.get_summary_info()[-1].startswith('last drain: '))
+
+#===============================================================================
+# Run Test
+#===============================================================================
+def run_test():
+    import os; os.chdir('..')
+    import unittest
+    suite = unittest.TestLoader().loadTestsFromTestCase(Test_MyThreadPool)
+    unittest.TextTestRunner().run(suite)
+
+#===============================================================================
+# Main
+#===============================================================================
+if __name__ == '__main__':
+    run_test()